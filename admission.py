@@ -0,0 +1,246 @@
+"""
+Controllo di ammissione e scarto del carico in sovraccarico
+
+Limita le richieste eseguite contemporaneamente da un worker, in totale e per
+classe di rotta (chat, stream, compare, batch). Le richieste oltre il limite
+attendono in una coda limitata ordinata per priorità (a parità, per ordine di
+arrivo): quando si libera uno slot entra la richiesta in attesa con priorità
+più alta la cui classe ha ancora posto. Le chat senza ragionamento esteso
+passano quindi davanti a /compare e /batch.
+
+Se la coda è piena, o l'attesa supera max_wait secondi, la richiesta viene
+scartata subito (503 con Retry-After) invece di accumularsi fino ai timeout di
+uvicorn e dei provider.
+
+I limiti valgono per worker: con serve.py --workers N la capacità totale è N
+volte quella configurata.
+"""
+
+import asyncio
+import itertools
+import os
+import time
+from typing import Optional, Dict, Any, Callable, List
+
+
+# Priorità di default delle classi di rotta (valore più basso = servita prima)
+DEFAULT_PRIORITIES = {"chat": 0, "stream": 0, "compare": 2, "batch": 3}
+
+# Penalità di priorità delle richieste con ragionamento esteso (più lunghe da servire)
+THINKING_PENALTY = 1
+
+
+class AdmissionRejected(Exception):
+    """La richiesta è stata scartata perché il worker è in sovraccarico"""
+
+    def __init__(self, route: str, reason: str, retry_after: float):
+        super().__init__(f"Server overloaded ({route}: {reason}), retry later")
+        self.route = route
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    """Richiesta in coda in attesa di uno slot"""
+
+    __slots__ = ("priority", "seq", "route", "future")
+
+    def __init__(self, priority: int, seq: int, route: str, future: "asyncio.Future"):
+        self.priority = priority
+        self.seq = seq
+        self.route = route
+        self.future = future
+
+
+class AdmissionController:
+    """
+    Slot di esecuzione per classe di rotta con coda di attesa a priorità
+
+    Args:
+        max_concurrency: Richieste eseguite contemporaneamente in totale (0 = illimitate)
+        route_limits: Richieste contemporanee per classe di rotta (assente o 0 = solo il limite totale)
+        priorities: Priorità di ogni classe (valore più basso = servita prima)
+        queue_size: Richieste in attesa oltre le quali le nuove vengono scartate
+        max_wait: Secondi massimi di attesa in coda prima dello scarto
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 64,
+        route_limits: Optional[Dict[str, int]] = None,
+        priorities: Optional[Dict[str, int]] = None,
+        queue_size: int = 128,
+        max_wait: float = 10.0
+    ):
+        self.max_concurrency = max_concurrency
+        self.route_limits = dict(route_limits or {})
+        self.priorities = {**DEFAULT_PRIORITIES, **(priorities or {})}
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self._active: Dict[str, int] = {}
+        self._total = 0
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        # Durata media (EWMA) di uno slot, usata per stimare il Retry-After
+        self._avg_hold = 1.0
+        self.admitted: Dict[str, int] = {}
+        self.queued: Dict[str, int] = {}
+        self.shed: Dict[str, Dict[str, int]] = {}
+        self.wait_seconds: Dict[str, float] = {}
+
+    def priority_for(self, route: str, thinking: bool = False) -> int:
+        return self.priorities.get(route, max(self.priorities.values())) + (THINKING_PENALTY if thinking else 0)
+
+    def _has_room(self, route: str) -> bool:
+        if self.max_concurrency and self._total >= self.max_concurrency:
+            return False
+        limit = self.route_limits.get(route, 0)
+        return not limit or self._active.get(route, 0) < limit
+
+    def _occupy(self, route: str) -> None:
+        self._total += 1
+        self._active[route] = self._active.get(route, 0) + 1
+        self.admitted[route] = self.admitted.get(route, 0) + 1
+
+    def _wake_waiters(self) -> None:
+        """Assegna gli slot liberi alle richieste in coda, in ordine di priorità"""
+        for waiter in sorted(self._waiters, key=lambda w: (w.priority, w.seq)):
+            if self.max_concurrency and self._total >= self.max_concurrency:
+                return
+            if waiter.future.done() or not self._has_room(waiter.route):
+                continue
+            # Lo slot è occupato subito, prima che la richiesta riprenda l'esecuzione
+            self._occupy(waiter.route)
+            self._waiters.remove(waiter)
+            waiter.future.set_result(None)
+
+    def _shed(self, route: str, reason: str) -> AdmissionRejected:
+        counts = self.shed.setdefault(route, {})
+        counts[reason] = counts.get(reason, 0) + 1
+        # Stima: il tempo per smaltire la coda attuale con gli slot disponibili
+        slots = self.max_concurrency or max(self._total, 1)
+        retry_after = max(1.0, self._avg_hold * (len(self._waiters) + 1) / slots)
+        return AdmissionRejected(route, reason, retry_after)
+
+    async def acquire(self, route: str, priority: Optional[int] = None) -> Callable[[], None]:
+        """
+        Attende uno slot per una richiesta della classe route
+
+        Returns:
+            Funzione da chiamare a fine richiesta per liberare lo slot
+
+        Raises:
+            AdmissionRejected: se la coda è piena o l'attesa supera max_wait
+        """
+        if priority is None:
+            priority = self.priority_for(route)
+
+        # Le richieste in coda non possono entrare (altrimenti sarebbero già state svegliate):
+        # se c'è posto per questa classe la richiesta entra subito senza scavalcare nessuno
+        if self._has_room(route):
+            self._occupy(route)
+            return self._releaser(route)
+
+        if len(self._waiters) >= self.queue_size:
+            raise self._shed(route, "queue_full")
+
+        waiter = _Waiter(priority, next(self._seq), route, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self.queued[route] = self.queued.get(route, 0) + 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            if not waiter.future.done():
+                self._waiters.remove(waiter)
+                waiter.future.cancel()
+                raise self._shed(route, "timeout")
+        except asyncio.CancelledError:
+            # Client disconnesso durante l'attesa: si libera il posto in coda o lo slot già assegnato
+            if waiter.future.done():
+                self._releaser(route)()
+            else:
+                self._waiters.remove(waiter)
+                waiter.future.cancel()
+            raise
+        finally:
+            self.wait_seconds[route] = self.wait_seconds.get(route, 0.0) + time.monotonic() - started
+        return self._releaser(route)
+
+    def _releaser(self, route: str) -> Callable[[], None]:
+        started = time.monotonic()
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if released:
+                return
+            released = True
+            self._avg_hold = 0.9 * self._avg_hold + 0.1 * (time.monotonic() - started)
+            self._total -= 1
+            self._active[route] -= 1
+            self._wake_waiters()
+
+        return release
+
+    def stats(self) -> Dict[str, Any]:
+        routes = sorted(set(self.priorities) | set(self.route_limits) | set(self._active))
+        depth = {route: 0 for route in routes}
+        for waiter in self._waiters:
+            depth[waiter.route] = depth.get(waiter.route, 0) + 1
+        return {
+            "max_concurrency": self.max_concurrency,
+            "queue_size": self.queue_size,
+            "max_wait": self.max_wait,
+            "active_total": self._total,
+            "queue_depth_total": len(self._waiters),
+            "avg_hold_seconds": round(self._avg_hold, 3),
+            "routes": {
+                route: {
+                    "limit": self.route_limits.get(route, 0),
+                    "priority": self.priorities.get(route),
+                    "active": self._active.get(route, 0),
+                    "queue_depth": depth.get(route, 0),
+                    "admitted": self.admitted.get(route, 0),
+                    "queued": self.queued.get(route, 0),
+                    "wait_seconds": round(self.wait_seconds.get(route, 0.0), 3),
+                    "shed": dict(self.shed.get(route, {})),
+                }
+                for route in routes
+            },
+        }
+
+
+def _parse_mapping(value: str) -> Dict[str, int]:
+    """Interpreta "chat=64,compare=8" in {"chat": 64, "compare": 8}"""
+    mapping = {}
+    for part in value.split(","):
+        name, _, number = part.partition("=")
+        if name.strip():
+            mapping[name.strip()] = int(number)
+    return mapping
+
+
+def create_admission_controller_from_env() -> Optional[AdmissionController]:
+    """
+    Crea il controllo di ammissione configurato con le variabili d'ambiente
+
+        ADMISSION: on (default) oppure off
+        ADMISSION_MAX_CONCURRENCY: richieste contemporanee per worker in totale (default 64)
+        ADMISSION_LIMITS: limiti per classe di rotta (default "chat=64,stream=48,compare=16,batch=4")
+        ADMISSION_PRIORITIES: priorità per classe, più bassa = prima (default "chat=0,stream=0,compare=2,batch=3")
+        ADMISSION_QUEUE_SIZE: richieste in attesa oltre le quali si risponde 503 (default 128)
+        ADMISSION_MAX_WAIT: secondi massimi di attesa in coda (default 10)
+
+    Returns:
+        Il controller, oppure None se ADMISSION=off
+    """
+    if os.getenv("ADMISSION", "on").lower() == "off":
+        return None
+    return AdmissionController(
+        max_concurrency=int(os.getenv("ADMISSION_MAX_CONCURRENCY", "64")),
+        route_limits=_parse_mapping(os.getenv("ADMISSION_LIMITS", "chat=64,stream=48,compare=16,batch=4")),
+        priorities=_parse_mapping(os.getenv("ADMISSION_PRIORITIES", "")),
+        queue_size=int(os.getenv("ADMISSION_QUEUE_SIZE", "128")),
+        max_wait=float(os.getenv("ADMISSION_MAX_WAIT", "10")),
+    )
@@ -1,15 +1,80 @@
 """
 Client per interagire con le API di OpenAI e Claude (Anthropic)
-Supporta parametri di pensiero (thinking) e streaming
+Supporta parametri di pensiero (thinking) e streaming, in versione sincrona e asincrona
 """
 
+import asyncio
+import json
 import os
-from typing import Optional, Dict, Any, Iterator
-from openai import OpenAI
-from anthropic import Anthropic
+import time
+from typing import Optional, Dict, Any, Iterator, AsyncIterator, Awaitable, Callable, NamedTuple
+import httpx
+from openai import OpenAI, AsyncOpenAI, DEFAULT_MAX_RETRIES as OPENAI_MAX_RETRIES
+from openai.types.chat import ChatCompletion
+from anthropic import Anthropic, AsyncAnthropic, DEFAULT_MAX_RETRIES as ANTHROPIC_MAX_RETRIES
+from anthropic.types import Message
+from response_cache import ResponseCache, make_cache_key, is_cacheable
+from rate_limiter import RateLimiter, estimate_tokens
+from resilience import ResiliencePolicy
+from token_budget import CONTEXT_BUDGET, enforce_context_budget
+import metrics
 
 
-class OpenAIClient:
+def openai_model_for(model: str, thinking_enabled: bool) -> str:
+    """Modello OpenAI effettivamente chiamato: con thinking i modelli gpt-* passano a o1 (reasoning)"""
+    if thinking_enabled and model.startswith("gpt"):
+        return "o1"
+    return model
+
+
+class _OpenAIBase:
+    """Logica comune ai client OpenAI sincrono e asincrono"""
+
+    # Controllo della finestra di contesto prima dell'invio: clamp, reject oppure off
+    context_budget: str = CONTEXT_BUDGET
+
+    def _build_params(
+        self,
+        messages: list[Dict[str, str]],
+        model: str,
+        temperature: Optional[float],
+        max_tokens: Optional[int],
+        stream: bool,
+        thinking_enabled: bool,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """
+        Prepara i parametri per chat.completions.create
+
+        Returns:
+            Dizionario dei parametri, con il modello già risolto in params["model"]
+        """
+        # Se thinking_enabled è True, usa i modelli della serie o1
+        model = openai_model_for(model, thinking_enabled)
+        if thinking_enabled:
+            # I modelli o1 hanno parametri predefiniti ottimizzati
+            # Rimuovi temperature se si usa o1
+            if model.startswith("o1"):
+                kwargs.pop("temperature", None)
+                temperature = None
+
+        params = {
+            "model": model,
+            "messages": messages,
+            "stream": stream,
+            **kwargs
+        }
+
+        # Aggiungi parametri opzionali solo se specificati
+        if temperature is not None:
+            params["temperature"] = temperature
+        if max_tokens is not None:
+            params["max_tokens"] = max_tokens
+
+        return enforce_context_budget(params, "openai", self.context_budget)
+
+
+class OpenAIClient(_OpenAIBase):
     """Client per le API di OpenAI con supporto per thinking e streaming"""
 
     def __init__(self, api_key: Optional[str] = None):
@@ -46,28 +111,9 @@ class OpenAIClient:
         Returns:
             Risposta dell'API (oggetto ChatCompletion o Stream)
         """
-        # Se thinking_enabled è True, usa i modelli della serie o1
-        if thinking_enabled:
-            if model.startswith("gpt"):
-                model = "o1"  # Passa al modello o1 che supporta il reasoning
-            # I modelli o1 hanno parametri predefiniti ottimizzati
-            # Rimuovi temperature se si usa o1
-            if model.startswith("o1"):
-                kwargs.pop("temperature", None)
-                temperature = None
-
-        params = {
-            "model": model,
-            "messages": messages,
-            "stream": stream,
-            **kwargs
-        }
-
-        # Aggiungi parametri opzionali solo se specificati
-        if temperature is not None:
-            params["temperature"] = temperature
-        if max_tokens is not None:
-            params["max_tokens"] = max_tokens
+        params = self._build_params(
+            messages, model, temperature, max_tokens, stream, thinking_enabled, **kwargs
+        )
 
         response = self.client.chat.completions.create(**params)
 
@@ -91,7 +137,689 @@ class OpenAIClient:
                 yield chunk.choices[0].delta.content
 
 
-class ClaudeClient:
+class _Flight:
+    """Chiamata in corso condivisa da più richieste identiche"""
+
+    def __init__(self, task: "asyncio.Task"):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalescenza delle chiamate identiche concorrenti (single-flight)
+
+    Finché una chiamata con una certa chiave è in corso, le richieste con la
+    stessa chiave non ne avviano un'altra ma ne attendono il risultato. La
+    chiamata viene annullata solo se tutte le richieste in attesa rinunciano.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Esegue call() una sola volta per tutte le richieste concorrenti con la stessa chiave
+
+        Args:
+            key: Chiave della chiamata (payload normalizzato)
+            call: Funzione che avvia la chiamata vera e propria
+
+        Returns:
+            Il risultato della chiamata condivisa
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(call()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _, key=key, flight=flight: self._forget(key, flight))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def in_flight(self, key: str) -> bool:
+        """True se una chiamata con questa chiave è in corso"""
+        return key in self._flights
+
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> Dict[str, int]:
+        """Chiamate avviate, richieste coalescenti e chiamate attualmente in corso"""
+        return {
+            "upstream_calls": self.leaders,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._flights),
+        }
+
+
+class PromptCacheStats:
+    """
+    Contatori della cache dei prompt del provider (prefissi già elaborati)
+
+    Args:
+        input_includes_cached: True se input_tokens comprende già i token letti
+            o scritti in cache (OpenAI), False se li esclude (Anthropic)
+    """
+
+    def __init__(self, input_includes_cached: bool):
+        self.input_includes_cached = input_includes_cached
+        self.requests = 0
+        self.hits = 0
+        self.prompt_tokens = 0
+        self.cached_input_tokens = 0
+        self.cache_creation_input_tokens = 0
+
+    def record(self, usage: Dict[str, int]) -> None:
+        cached = usage.get("cached_input_tokens", 0)
+        created = usage.get("cache_creation_input_tokens", 0)
+        prompt_tokens = usage.get("input_tokens", 0)
+        if not self.input_includes_cached:
+            prompt_tokens += cached + created
+
+        self.requests += 1
+        if cached:
+            self.hits += 1
+        self.prompt_tokens += prompt_tokens
+        self.cached_input_tokens += cached
+        self.cache_creation_input_tokens += created
+
+    def stats(self) -> Dict[str, Any]:
+        """Richieste con hit, token di prompt letti/scritti in cache e percentuale letta dalla cache"""
+        return {
+            "requests": self.requests,
+            "hits": self.hits,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_input_tokens": self.cached_input_tokens,
+            "cache_creation_input_tokens": self.cache_creation_input_tokens,
+            "cached_ratio": round(self.cached_input_tokens / self.prompt_tokens, 4) if self.prompt_tokens else 0.0,
+        }
+
+
+def served_from(response: Any) -> Optional[str]:
+    """
+    Origine di una risposta che non è costata una chiamata al provider
+
+    Returns:
+        "cache" se viene dalla cache delle risposte, "coalesced" se è stata
+        condivisa con una richiesta identica concorrente, None se la chiamata
+        al provider è stata fatta per questa richiesta (e i token consumati)
+    """
+    return getattr(response, "served_from", None)
+
+
+class _AsyncDispatchMixin:
+    """
+    Percorso comune delle chiamate dei client asincroni
+
+    Le sottoclassi definiscono provider, response_type e _raw_create(params).
+    """
+
+    provider: str
+    response_type: type
+    cache: Optional[ResponseCache] = None
+    inflight: Optional[SingleFlight] = None
+    rate_limiter: Optional[RateLimiter] = None
+    resilience: Optional[ResiliencePolicy] = None
+    prompt_cache: Optional[PromptCacheStats] = None
+
+    async def _raw_create(self, params: Dict[str, Any]) -> Any:
+        """Chiama l'SDK tramite with_raw_response (per avere accesso agli header)"""
+        raise NotImplementedError
+
+    def _is_hedgeable(self, params: Dict[str, Any]) -> bool:
+        """Le chiamate brevi (senza streaming né ragionamento esteso) possono essere duplicate"""
+        return not params.get("stream")
+
+    async def _create(self, params: Dict[str, Any]) -> Any:
+        """
+        Esegue la chiamata upstream (anche in streaming) con retry, hedging e circuit breaker
+
+        Returns:
+            La risposta già interpretata dall'SDK (oggetto risposta o stream)
+        """
+        if self.resilience is None:
+            return await self._attempt(params)
+        return await self.resilience.call(
+            self.provider,
+            params["model"],
+            lambda: self._attempt(params),
+            hedgeable=self._is_hedgeable(params)
+        )
+
+    async def _attempt(self, params: Dict[str, Any]) -> Any:
+        """Un singolo tentativo di chiamata upstream, nel rispetto del rate limit"""
+        model = params["model"]
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire(self.provider, model, estimate_tokens(params))
+
+        # Per gli stream concorrenza e durata completa vengono misurate da _observe_stream
+        stream = bool(params.get("stream"))
+        started = time.perf_counter()
+        if not stream:
+            metrics.UPSTREAM_IN_FLIGHT.inc(provider=self.provider)
+        try:
+            raw = await self._raw_create(params)
+        except asyncio.CancelledError:
+            metrics.UPSTREAM_CANCELLED.inc(provider=self.provider, model=model, stream=str(stream).lower())
+            raise
+        except Exception as e:
+            metrics.UPSTREAM_ERRORS.inc(provider=self.provider, model=model, error=type(e).__name__)
+            # Anche le risposte di errore (es. 429) riportano lo stato dei limiti
+            response = getattr(e, "response", None)
+            if self.rate_limiter is not None and response is not None:
+                await self.rate_limiter.update_from_headers(self.provider, model, response.headers)
+            raise
+        finally:
+            if not stream:
+                metrics.UPSTREAM_IN_FLIGHT.dec(provider=self.provider)
+
+        if not stream:
+            metrics.UPSTREAM_LATENCY.observe(
+                time.perf_counter() - started, provider=self.provider, model=model, stream="false"
+            )
+        if self.rate_limiter is not None:
+            await self.rate_limiter.update_from_headers(self.provider, model, raw.headers)
+        return raw.parse()
+
+    def extract_usage(self, response: Any) -> Dict[str, int]:
+        """
+        Token consumati da una risposta, in un formato comune ai due provider
+
+        Returns:
+            Dizionario con input_tokens, output_tokens, cached_input_tokens
+            (letti dalla cache dei prompt del provider), cache_creation_input_tokens
+            (scritti nella cache) e reasoning_tokens (ragionamento dei modelli o1)
+        """
+        raise NotImplementedError
+
+    def _record_usage(self, model: str, usage: Dict[str, int]) -> None:
+        if usage and self.prompt_cache is not None:
+            self.prompt_cache.record(usage)
+        for kind, count in usage.items():
+            if count:
+                metrics.TOKENS.inc(count, provider=self.provider, model=model, kind=kind)
+
+    async def _observe_stream(
+        self, model: str, events: AsyncIterator[Dict[str, Any]]
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Inoltra gli eventi di uno stream misurando tempo al primo token, durata e token"""
+        started = time.perf_counter()
+        first_token = True
+        metrics.UPSTREAM_IN_FLIGHT.inc(provider=self.provider)
+        try:
+            async for event in events:
+                if first_token and event["type"] in ("text", "thinking"):
+                    first_token = False
+                    metrics.UPSTREAM_TTFT.observe(
+                        time.perf_counter() - started, provider=self.provider, model=model
+                    )
+                elif event["type"] == "usage":
+                    self._record_usage(model, event["usage"])
+                yield event
+        except (asyncio.CancelledError, GeneratorExit):
+            # Stream abbandonato (es. client disconnesso): la connessione upstream viene chiusa
+            metrics.UPSTREAM_CANCELLED.inc(provider=self.provider, model=model, stream="true")
+            raise
+        finally:
+            metrics.UPSTREAM_IN_FLIGHT.dec(provider=self.provider)
+            metrics.UPSTREAM_LATENCY.observe(
+                time.perf_counter() - started, provider=self.provider, model=model, stream="true"
+            )
+
+    async def _dispatch(self, params: Dict[str, Any], use_cache: bool = True) -> Any:
+        """
+        Esegue la chiamata, servendo dalla cache le richieste deterministiche già viste
+        e condividendo un'unica chiamata upstream tra le richieste identiche concorrenti
+
+        Args:
+            params: Parametri finali della chiamata
+            use_cache: Se False, ignora la cache per questa chiamata (senza aggiornarla)
+        """
+        key = make_cache_key(self.provider, params)
+        use_cache = self.cache is not None and use_cache and is_cacheable(params)
+        if use_cache:
+            cached = await self.cache.aget(key)
+            if cached is not None:
+                return self.response_type.model_validate(cached).model_copy(update={"served_from": "cache"})
+
+        async def call() -> Any:
+            response = await self._create(params)
+            self._record_usage(params["model"], self.extract_usage(response))
+            if use_cache:
+                await self.cache.aset(key, response.model_dump(mode="json"))
+            return response
+
+        if self.inflight is None:
+            return await call()
+        # Chi si accoda a una chiamata già in corso riceve una copia marcata (vedi served_from)
+        leader = not self.inflight.in_flight(key)
+        response = await self.inflight.do(key, call)
+        return response if leader else response.model_copy(update={"served_from": "coalesced"})
+
+
+class AsyncOpenAIClient(_OpenAIBase, _AsyncDispatchMixin):
+    """
+    Variante asincrona di OpenAIClient, basata su AsyncOpenAI
+
+    Da usare dentro un event loop (es. negli endpoint FastAPI) per non
+    bloccare le altre richieste mentre si attende la risposta del provider.
+    """
+
+    provider = "openai"
+    response_type = ChatCompletion
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        http_client: Optional[httpx.AsyncClient] = None,
+        cache: Optional[ResponseCache] = None,
+        base_url: Optional[str] = None,
+        coalesce: bool = True,
+        rate_limiter: Optional[RateLimiter] = None,
+        resilience: Optional[ResiliencePolicy] = None
+    ):
+        """
+        Inizializza il client OpenAI asincrono
+
+        Args:
+            api_key: Chiave API OpenAI (se None, usa la variabile d'ambiente OPENAI_API_KEY)
+            http_client: Client httpx condiviso (pool di connessioni keep-alive);
+                se None, l'SDK ne crea uno proprio
+            cache: Cache delle risposte deterministiche (opzionale)
+            coalesce: Se True, le chiamate identiche concorrenti condividono
+                un'unica richiesta upstream (single-flight)
+            base_url: URL alternativo delle API (es. un server locale di test);
+                se None, l'SDK usa la variabile d'ambiente del provider o l'URL ufficiale
+            rate_limiter: Rate limiter condiviso per richieste e token al minuto (opzionale)
+            resilience: Politica di retry/hedging/circuit breaker (opzionale); se
+                presente sostituisce i retry interni dell'SDK
+        """
+        self.client = AsyncOpenAI(
+            api_key=api_key or os.getenv("OPENAI_API_KEY"),
+            base_url=base_url,
+            http_client=http_client,
+            max_retries=0 if resilience is not None else OPENAI_MAX_RETRIES
+        )
+        self.cache = cache
+        self.inflight = SingleFlight() if coalesce else None
+        self.rate_limiter = rate_limiter
+        self.resilience = resilience
+        # La cache dei prompt di OpenAI è automatica per i prefissi da 1024 token in su
+        self.prompt_cache = PromptCacheStats(input_includes_cached=True)
+
+    async def chat_completion(
+        self,
+        messages: list[Dict[str, str]],
+        model: str = "gpt-4o",
+        temperature: float = 1.0,
+        max_tokens: Optional[int] = None,
+        stream: bool = False,
+        thinking_enabled: bool = False,
+        use_cache: bool = True,
+        **kwargs
+    ) -> Any:
+        """
+        Esegue una chat completion con OpenAI senza bloccare l'event loop
+
+        Args:
+            Gli stessi di OpenAIClient.chat_completion, più:
+            use_cache: Se False, non usa la cache delle risposte per questa chiamata
+
+        Returns:
+            Risposta dell'API (oggetto ChatCompletion o async iterator di chunk di testo)
+        """
+        params = self._build_params(
+            messages, model, temperature, max_tokens, stream, thinking_enabled, **kwargs
+        )
+
+        if stream:
+            response = await self._create(params)
+            return self._handle_stream(response)
+        else:
+            return await self._dispatch(params, use_cache=use_cache)
+
+    async def _raw_create(self, params: Dict[str, Any]) -> Any:
+        return await self.client.chat.completions.with_raw_response.create(**params)
+
+    def extract_usage(self, response: Any) -> Dict[str, int]:
+        usage = response.usage
+        if usage is None:
+            return {}
+        prompt_details = getattr(usage, "prompt_tokens_details", None)
+        completion_details = getattr(usage, "completion_tokens_details", None)
+        return {
+            "input_tokens": usage.prompt_tokens,
+            "output_tokens": usage.completion_tokens,
+            "cached_input_tokens": getattr(prompt_details, "cached_tokens", None) or 0,
+            "cache_creation_input_tokens": 0,
+            "reasoning_tokens": getattr(completion_details, "reasoning_tokens", None) or 0
+        }
+
+    def _is_hedgeable(self, params: Dict[str, Any]) -> bool:
+        # I modelli di reasoning (o1, o3, ...) hanno latenze lunghe e variabili
+        return not params.get("stream") and not params["model"].startswith("o")
+
+    async def _handle_stream(self, stream: AsyncIterator) -> AsyncIterator[str]:
+        """
+        Gestisce lo streaming asincrono della risposta
+
+        Args:
+            stream: Stream asincrono dalla API
+
+        Yields:
+            Chunk di testo della risposta
+        """
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content is not None:
+                yield chunk.choices[0].delta.content
+
+    def stream_events(
+        self,
+        messages: list[Dict[str, str]],
+        model: str = "gpt-4o",
+        temperature: float = 1.0,
+        max_tokens: Optional[int] = None,
+        thinking_enabled: bool = False,
+        **kwargs
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Esegue una chat completion in streaming e produce eventi strutturati
+
+        Args:
+            Gli stessi di chat_completion (lo streaming è sempre attivo)
+
+        Returns:
+            Iteratore di eventi: {"type": "text", "text": ...} per ogni delta di
+            testo, seguito da {"type": "usage", "usage": {...}} (vedi extract_usage)
+
+        Raises:
+            ContextBudgetError: subito, prima di avviare lo stream (vedi token_budget.py)
+        """
+        params = self._build_params(
+            messages, model, temperature, max_tokens, True, thinking_enabled,
+            stream_options={"include_usage": True}, **kwargs
+        )
+
+        # I parametri (e la finestra di contesto) sono verificati alla chiamata, non alla prima iterazione
+        return self._observe_stream(params["model"], self._stream_events(params))
+
+    async def _stream_events(self, params: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        stream = await self._create(params)
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield {"type": "text", "text": chunk.choices[0].delta.content}
+                if chunk.usage is not None:
+                    yield {"type": "usage", "usage": self.extract_usage(chunk)}
+        finally:
+            await stream.close()
+
+    # Batch API (elaborazione asincrona a costo ridotto, completamento entro 24h)
+
+    async def submit_batch(self, requests: list[Dict[str, Any]]) -> Any:
+        """
+        Invia un gruppo di richieste alla Batch API di OpenAI
+
+        Args:
+            requests: Lista di dizionari con "custom_id", "messages" e gli stessi
+                parametri opzionali di chat_completion (model, temperature, ...)
+
+        Returns:
+            Oggetto Batch creato dal provider
+        """
+        lines = []
+        for request in requests:
+            options = dict(request)
+            custom_id = options.pop("custom_id")
+            body = self._build_params(
+                options.pop("messages"),
+                options.pop("model", "gpt-4o"),
+                options.pop("temperature", 1.0),
+                options.pop("max_tokens", None),
+                False,
+                options.pop("thinking_enabled", False),
+                **options
+            )
+            body.pop("stream")
+            lines.append(json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body
+            }, ensure_ascii=False))
+        content = ("\n".join(lines) + "\n").encode("utf-8")
+
+        input_file = await self.client.files.create(
+            file=("batch.jsonl", content), purpose="batch"
+        )
+        return await self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+
+    async def get_batch(self, batch_id: str) -> Any:
+        """Restituisce lo stato aggiornato di un batch"""
+        return await self.client.batches.retrieve(batch_id)
+
+    async def cancel_batch(self, batch_id: str) -> Any:
+        """Annulla un batch in corso"""
+        return await self.client.batches.cancel(batch_id)
+
+    async def get_batch_results(self, batch: Any) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Scarica i risultati di un batch concluso
+
+        Args:
+            batch: Oggetto Batch restituito da get_batch
+
+        Yields:
+            {"custom_id": ..., "response": dict | None, "usage": dict, "error": str | None}
+        """
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await self.client.files.content(file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get("response") or {}
+                body = response.get("body")
+                error = entry.get("error")
+                if error is None and response.get("status_code", 200) >= 400:
+                    error = (body or {}).get("error", f"HTTP {response['status_code']}")
+                if isinstance(error, dict):
+                    error = error.get("message", error)
+                yield {
+                    "custom_id": entry["custom_id"],
+                    "response": body if error is None else None,
+                    "usage": self.extract_usage(ChatCompletion.model_validate(body)) if error is None else {},
+                    "error": None if error is None else str(error)
+                }
+
+    async def close(self) -> None:
+        """Chiude il client HTTP sottostante (incluso l'eventuale http_client condiviso)"""
+        await self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+def claude_usage(message: Any) -> Dict[str, int]:
+    """Token consumati da un messaggio di Claude (vedi AsyncClaudeClient.extract_usage)"""
+    # Il ragionamento esteso è conteggiato in output_tokens (l'API non lo separa)
+    usage = message.usage
+    return {
+        "input_tokens": usage.input_tokens,
+        "output_tokens": usage.output_tokens,
+        "cached_input_tokens": getattr(usage, "cache_read_input_tokens", None) or 0,
+        "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", None) or 0,
+        "reasoning_tokens": 0
+    }
+
+
+class ClaudeContent(NamedTuple):
+    """Contenuto di una risposta di Claude, già separato per tipo di blocco"""
+    text: str
+    thinking: str
+    tool_calls: list[Dict[str, Any]]
+    usage: Dict[str, int]
+
+
+class ClaudeContentBuilder:
+    """
+    Assembla il contenuto di una risposta di Claude, da blocchi o eventi di stream
+
+    I frammenti vengono accumulati in liste e uniti una sola volta in build():
+    concatenare le stringhe a ogni blocco o delta ricopierebbe ogni volta tutto
+    il testo già ricevuto, con costo quadratico sui ragionamenti lunghi.
+    """
+
+    def __init__(self):
+        self._text: list[str] = []
+        self._thinking: list[str] = []
+        self._tool_calls: list[Dict[str, Any]] = []
+        self._usage: Dict[str, int] = {}
+
+    def add_block(self, block: Any) -> None:
+        """Aggiunge un blocco di contenuto di un Message (text, thinking o tool_use)"""
+        if block.type == "text":
+            self._text.append(block.text)
+        elif block.type == "thinking":
+            self._thinking.append(block.thinking)
+        elif block.type == "tool_use":
+            self._tool_calls.append({"id": block.id, "name": block.name, "input": block.input})
+
+    def add_text(self, text: str) -> None:
+        """Aggiunge un frammento di risposta (es. un chunk dello streaming sincrono)"""
+        self._text.append(text)
+
+    def add_event(self, event: Dict[str, Any]) -> None:
+        """Aggiunge un evento di stream_events (text, thinking, usage)"""
+        if event["type"] == "text":
+            self._text.append(event["text"])
+        elif event["type"] == "thinking":
+            self._thinking.append(event["thinking"])
+        elif event["type"] == "usage":
+            self._usage = event["usage"]
+
+    def build(self) -> ClaudeContent:
+        return ClaudeContent(
+            text="".join(self._text),
+            thinking="".join(self._thinking),
+            tool_calls=self._tool_calls,
+            usage=self._usage,
+        )
+
+
+def assemble_claude_response(message: Any) -> ClaudeContent:
+    """Testo, ragionamento, chiamate a tool e token di un Message di Claude"""
+    builder = ClaudeContentBuilder()
+    for block in message.content:
+        builder.add_block(block)
+    builder.add_event({"type": "usage", "usage": claude_usage(message)})
+    return builder.build()
+
+
+class _ClaudeBase:
+    """Logica comune ai client Claude sincrono e asincrono"""
+
+    # Controllo della finestra di contesto prima dell'invio: clamp, reject oppure off
+    context_budget: str = CONTEXT_BUDGET
+
+    def _build_params(
+        self,
+        messages: list[Dict[str, str]],
+        model: str,
+        max_tokens: int,
+        temperature: float,
+        stream: bool,
+        thinking_enabled: bool,
+        thinking_budget: Optional[int],
+        cache_prompt: bool = False,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """
+        Prepara i parametri per messages.create
+
+        Returns:
+            Dizionario dei parametri da passare all'API
+        """
+        params = {
+            "model": model,
+            "max_tokens": max_tokens,
+            "messages": messages,
+            "temperature": temperature,
+            "stream": stream,
+            **kwargs
+        }
+
+        # Abilita il pensiero esteso se richiesto
+        if thinking_enabled:
+            params["thinking"] = {
+                "type": "enabled",
+                "budget_tokens": thinking_budget or 10000
+            }
+
+        if cache_prompt:
+            self._add_cache_breakpoints(params)
+
+        return enforce_context_budget(params, "claude", self.context_budget)
+
+    def _add_cache_breakpoints(self, params: Dict[str, Any]) -> None:
+        """
+        Marca come cacheable i prefissi stabili della richiesta (prompt caching)
+
+        I punti di cache sono al massimo tre (il limite dell'API è quattro):
+        fine delle definizioni dei tool, fine del system prompt e ultimo turno
+        precedente al messaggio corrente. Le chiamate successive con lo stesso
+        prefisso rileggono dalla cache invece di rielaborarlo. I prefissi più
+        corti del minimo del modello (1024 token per Sonnet) vengono ignorati
+        dall'API senza errori.
+        """
+        cache_control = {"type": "ephemeral"}
+
+        if params.get("tools"):
+            tools = [dict(tool) for tool in params["tools"]]
+            tools[-1]["cache_control"] = cache_control
+            params["tools"] = tools
+
+        system = params.get("system")
+        if isinstance(system, str) and system:
+            params["system"] = [{"type": "text", "text": system, "cache_control": cache_control}]
+        elif isinstance(system, list) and system:
+            params["system"] = [*system[:-1], {**system[-1], "cache_control": cache_control}]
+
+        # Il messaggio corrente cambia a ogni chiamata: si marca il turno precedente
+        messages = params["messages"]
+        if len(messages) > 1:
+            previous = dict(messages[-2])
+            content = previous["content"]
+            if isinstance(content, str):
+                content = [{"type": "text", "text": content}]
+            previous["content"] = [*content[:-1], {**content[-1], "cache_control": cache_control}]
+            params["messages"] = [*messages[:-2], previous, messages[-1]]
+
+
+class ClaudeClient(_ClaudeBase):
     """Client per le API di Claude (Anthropic) con supporto per thinking e streaming"""
 
     def __init__(self, api_key: Optional[str] = None):
@@ -112,6 +840,7 @@ class ClaudeClient:
         stream: bool = False,
         thinking_enabled: bool = False,
         thinking_budget: Optional[int] = None,
+        cache_prompt: bool = False,
         **kwargs
     ) -> Any:
         """
@@ -125,26 +854,18 @@ class ClaudeClient:
             stream: Se True, abilita lo streaming della risposta
             thinking_enabled: Se True, abilita il pensiero esteso (extended thinking)
             thinking_budget: Budget di token per il pensiero (opzionale)
-            **kwargs: Altri parametri da passare all'API
+            cache_prompt: Se True, marca come cacheable tool, system prompt e turni
+                precedenti (prompt caching); i token letti dalla cache sono in
+                response.usage.cache_read_input_tokens
+            **kwargs: Altri parametri da passare all'API (es. system, tools)
 
         Returns:
             Risposta dell'API (oggetto Message o Stream)
         """
-        params = {
-            "model": model,
-            "max_tokens": max_tokens,
-            "messages": messages,
-            "temperature": temperature,
-            "stream": stream,
-            **kwargs
-        }
-
-        # Abilita il pensiero esteso se richiesto
-        if thinking_enabled:
-            params["thinking"] = {
-                "type": "enabled",
-                "budget_tokens": thinking_budget or 10000
-            }
+        params = self._build_params(
+            messages, model, max_tokens, temperature, stream,
+            thinking_enabled, thinking_budget, cache_prompt, **kwargs
+        )
 
         response = self.client.messages.create(**params)
 
@@ -169,6 +890,247 @@ class ClaudeClient:
                     yield event.delta.text
 
 
+class AsyncClaudeClient(_ClaudeBase, _AsyncDispatchMixin):
+    """
+    Variante asincrona di ClaudeClient, basata su AsyncAnthropic
+
+    Da usare dentro un event loop (es. negli endpoint FastAPI) per non
+    bloccare le altre richieste durante le chiamate con extended thinking.
+    """
+
+    provider = "claude"
+    response_type = Message
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        http_client: Optional[httpx.AsyncClient] = None,
+        cache: Optional[ResponseCache] = None,
+        base_url: Optional[str] = None,
+        coalesce: bool = True,
+        rate_limiter: Optional[RateLimiter] = None,
+        resilience: Optional[ResiliencePolicy] = None
+    ):
+        """
+        Inizializza il client Claude asincrono
+
+        Args:
+            api_key: Chiave API Anthropic (se None, usa la variabile d'ambiente ANTHROPIC_API_KEY)
+            http_client: Client httpx condiviso (pool di connessioni keep-alive);
+                se None, l'SDK ne crea uno proprio
+            cache: Cache delle risposte deterministiche (opzionale)
+            coalesce: Se True, le chiamate identiche concorrenti condividono
+                un'unica richiesta upstream (single-flight)
+            base_url: URL alternativo delle API (es. un server locale di test);
+                se None, l'SDK usa la variabile d'ambiente del provider o l'URL ufficiale
+            rate_limiter: Rate limiter condiviso per richieste e token al minuto (opzionale)
+            resilience: Politica di retry/hedging/circuit breaker (opzionale); se
+                presente sostituisce i retry interni dell'SDK
+        """
+        self.client = AsyncAnthropic(
+            api_key=api_key or os.getenv("ANTHROPIC_API_KEY"),
+            base_url=base_url,
+            http_client=http_client,
+            max_retries=0 if resilience is not None else ANTHROPIC_MAX_RETRIES
+        )
+        self.cache = cache
+        self.inflight = SingleFlight() if coalesce else None
+        self.rate_limiter = rate_limiter
+        self.resilience = resilience
+        self.prompt_cache = PromptCacheStats(input_includes_cached=False)
+
+    async def create_message(
+        self,
+        messages: list[Dict[str, str]],
+        model: str = "claude-sonnet-4-5-20250929",
+        max_tokens: int = 8192,
+        temperature: float = 1.0,
+        stream: bool = False,
+        thinking_enabled: bool = False,
+        thinking_budget: Optional[int] = None,
+        cache_prompt: bool = False,
+        use_cache: bool = True,
+        **kwargs
+    ) -> Any:
+        """
+        Crea un messaggio con Claude senza bloccare l'event loop
+
+        Args:
+            Gli stessi di ClaudeClient.create_message, più:
+            use_cache: Se False, non usa la cache delle risposte per questa chiamata
+
+        Returns:
+            Risposta dell'API (oggetto Message o async iterator di chunk di testo)
+        """
+        params = self._build_params(
+            messages, model, max_tokens, temperature, stream,
+            thinking_enabled, thinking_budget, cache_prompt, **kwargs
+        )
+
+        if stream:
+            response = await self._create(params)
+            return self._handle_stream(response)
+        else:
+            return await self._dispatch(params, use_cache=use_cache)
+
+    async def _raw_create(self, params: Dict[str, Any]) -> Any:
+        return await self.client.messages.with_raw_response.create(**params)
+
+    def extract_usage(self, response: Any) -> Dict[str, int]:
+        return claude_usage(response)
+
+    def _is_hedgeable(self, params: Dict[str, Any]) -> bool:
+        return not params.get("stream") and "thinking" not in params
+
+    async def _handle_stream(self, stream: AsyncIterator) -> AsyncIterator[str]:
+        """
+        Gestisce lo streaming asincrono della risposta
+
+        Args:
+            stream: Stream asincrono dalla API
+
+        Yields:
+            Chunk di testo della risposta
+        """
+        async for event in stream:
+            if event.type == "content_block_delta":
+                if hasattr(event.delta, "text"):
+                    yield event.delta.text
+
+    def stream_events(
+        self,
+        messages: list[Dict[str, str]],
+        model: str = "claude-sonnet-4-5-20250929",
+        max_tokens: int = 8192,
+        temperature: float = 1.0,
+        thinking_enabled: bool = False,
+        thinking_budget: Optional[int] = None,
+        cache_prompt: bool = False,
+        **kwargs
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Crea un messaggio in streaming e produce eventi strutturati
+
+        Args:
+            Gli stessi di create_message (lo streaming è sempre attivo)
+
+        Returns:
+            Iteratore di eventi: {"type": "thinking", "thinking": ...} per ogni delta
+            del ragionamento, {"type": "text", "text": ...} per ogni delta della
+            risposta e infine {"type": "usage", "usage": {...}} (vedi extract_usage)
+
+        Raises:
+            ContextBudgetError: subito, prima di avviare lo stream (vedi token_budget.py)
+        """
+        params = self._build_params(
+            messages, model, max_tokens, temperature, True,
+            thinking_enabled, thinking_budget, cache_prompt, **kwargs
+        )
+
+        # I parametri (e la finestra di contesto) sono verificati alla chiamata, non alla prima iterazione
+        return self._observe_stream(params["model"], self._stream_events(params))
+
+    async def _stream_events(self, params: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        stream = await self._create(params)
+        usage: Dict[str, int] = {}
+        try:
+            async for event in stream:
+                if event.type == "content_block_delta":
+                    if event.delta.type == "text_delta":
+                        yield {"type": "text", "text": event.delta.text}
+                    elif event.delta.type == "thinking_delta":
+                        yield {"type": "thinking", "thinking": event.delta.thinking}
+                elif event.type == "message_start":
+                    usage = self.extract_usage(event.message)
+                elif event.type == "message_delta":
+                    usage["output_tokens"] = event.usage.output_tokens
+        finally:
+            await stream.close()
+
+        yield {"type": "usage", "usage": usage}
+
+    # Message Batches API (elaborazione asincrona a costo ridotto, completamento entro 24h)
+
+    async def submit_batch(self, requests: list[Dict[str, Any]]) -> Any:
+        """
+        Invia un gruppo di richieste alla Message Batches API
+
+        Args:
+            requests: Lista di dizionari con "custom_id", "messages" e gli stessi
+                parametri opzionali di create_message (model, max_tokens, ...)
+
+        Returns:
+            Oggetto MessageBatch creato dal provider
+        """
+        batch_requests = []
+        for request in requests:
+            options = dict(request)
+            custom_id = options.pop("custom_id")
+            params = self._build_params(
+                options.pop("messages"),
+                options.pop("model", "claude-sonnet-4-5-20250929"),
+                options.pop("max_tokens", 8192),
+                options.pop("temperature", 1.0),
+                False,
+                options.pop("thinking_enabled", False),
+                options.pop("thinking_budget", None),
+                options.pop("cache_prompt", False),
+                **options
+            )
+            params.pop("stream")
+            batch_requests.append({"custom_id": custom_id, "params": params})
+
+        return await self.client.messages.batches.create(requests=batch_requests)
+
+    async def get_batch(self, batch_id: str) -> Any:
+        """Restituisce lo stato aggiornato di un batch"""
+        return await self.client.messages.batches.retrieve(batch_id)
+
+    async def cancel_batch(self, batch_id: str) -> Any:
+        """Annulla un batch in corso"""
+        return await self.client.messages.batches.cancel(batch_id)
+
+    async def get_batch_results(self, batch: Any) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Scarica i risultati di un batch concluso
+
+        Args:
+            batch: Oggetto MessageBatch restituito da get_batch
+
+        Yields:
+            {"custom_id": ..., "response": dict | None, "usage": dict, "error": str | None}
+        """
+        async for entry in await self.client.messages.batches.results(batch.id):
+            result = entry.result
+            if result.type == "succeeded":
+                yield {
+                    "custom_id": entry.custom_id,
+                    "response": result.message.model_dump(mode="json"),
+                    "usage": claude_usage(result.message),
+                    "error": None
+                }
+            else:
+                # errored (con dettaglio dell'errore), canceled oppure expired
+                error = getattr(result, "error", None)
+                detail = getattr(getattr(error, "error", None), "message", None)
+                yield {
+                    "custom_id": entry.custom_id,
+                    "response": None,
+                    "usage": {},
+                    "error": detail or result.type
+                }
+
+    async def close(self) -> None:
+        """Chiude il client HTTP sottostante (incluso l'eventuale http_client condiviso)"""
+        await self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
 # Funzioni di utilità per esempi rapidi
 
 def quick_openai_chat(prompt: str, thinking: bool = False, stream: bool = False) -> str:
@@ -227,21 +1189,18 @@ def quick_claude_chat(prompt: str, thinking: bool = False, stream: bool = False)
 
     if stream:
         print("Claude (streaming):")
-        full_response = ""
+        builder = ClaudeContentBuilder()
         for chunk in response:
             print(chunk, end="", flush=True)
-            full_response += chunk
+            builder.add_text(chunk)
         print("\n")
-        return full_response
+        return builder.build().text
     else:
         # Gestisci i diversi tipi di contenuto (testo e pensiero)
-        full_text = ""
-        for block in response.content:
-            if block.type == "text":
-                full_text += block.text
-            elif block.type == "thinking":
-                print(f"\n[Pensiero di Claude]: {block.thinking}\n")
-        return full_text
+        content = assemble_claude_response(response)
+        if content.thinking:
+            print(f"\n[Pensiero di Claude]: {content.thinking}\n")
+        return content.text
 
 
 # Esempio di utilizzo
@@ -3,18 +3,330 @@ API Server per Custom GPT Actions
 Espone endpoint per chiamare OpenAI e Claude con thinking
 """
 
-from fastapi import FastAPI, HTTPException, Header
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Header, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import Optional, Literal
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from pydantic import BaseModel, BeforeValidator, Field
+from typing import Optional, Literal, Annotated, Awaitable, Callable, Tuple, Any, AsyncIterator, Dict, Union
+import asyncio
+import functools
+import math
 import os
-from api_client import OpenAIClient, ClaudeClient
+import time
+import httpx
+from api_client import (
+    AsyncOpenAIClient, AsyncClaudeClient, ClaudeContentBuilder, assemble_claude_response, served_from
+)
+import fast_json
+from compression import CompressionMiddleware
+from disconnect import CancelOnDisconnectMiddleware
+from fast_json import FastJSONResponse, FastJSONRoute
+from response_cache import create_response_cache_from_env
+from batch_jobs import BatchJob, BatchJobManager, parse_jsonl
+from rate_limiter import RateLimitExceeded, create_rate_limiter_from_env, retry_after_header
+from resilience import CircuitOpenError, create_resilience_from_env
+from token_budget import ContextBudgetError, token_count_cache_stats
+from model_router import Candidate, create_model_router_from_env, route_for
+import metrics
+from usage_tracker import UsageTracker, create_usage_tracker_from_env
+from shared_state import SharedState, create_shared_state_from_env
+from admission import AdmissionRejected, create_admission_controller_from_env
+from auth import (
+    ApiKey, ANONYMOUS, KeyStore, QuotaExceeded, QuotaManager, QuotaReleaseMiddleware,
+    create_key_store_from_env, estimate_request_tokens
+)
+from session_store import Session, SessionStore, compact_history, history_tokens, create_session_store_from_env
+
+
+class ClientRegistry:
+    """
+    Registro dei client dei provider, condiviso da tutte le richieste del worker
+
+    I client (e i relativi pool di connessioni keep-alive) vengono creati una
+    sola volta all'avvio e chiusi allo shutdown, così le richieste non pagano
+    ogni volta un nuovo handshake TLS verso OpenAI e Anthropic.
+
+    I limiti del pool sono configurabili con le variabili d'ambiente:
+        PROVIDER_MAX_CONNECTIONS: connessioni massime per provider (default 100)
+        PROVIDER_MAX_KEEPALIVE: connessioni keep-alive mantenute (default 20)
+        PROVIDER_KEEPALIVE_EXPIRY: secondi prima di chiudere una connessione inattiva (default 30)
+        PROVIDER_TIMEOUT: timeout in secondi delle chiamate upstream (default 600)
+
+    Contiene anche la cache delle risposte deterministiche, il rate limiter, la
+    politica di resilienza (retry, hedging, circuit breaker) e il router dei
+    modelli, condivisi dai due provider e configurati dalle rispettive funzioni
+    create_*_from_env. Cache e rate limiter si appoggiano a state, lo stato
+    condiviso tra i worker (vedi shared_state.py).
+    """
+
+    def __init__(self, state: Optional[SharedState] = None):
+        self.limits = httpx.Limits(
+            max_connections=int(os.getenv("PROVIDER_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("PROVIDER_MAX_KEEPALIVE", "20")),
+            keepalive_expiry=float(os.getenv("PROVIDER_KEEPALIVE_EXPIRY", "30")),
+        )
+        self.timeout = httpx.Timeout(float(os.getenv("PROVIDER_TIMEOUT", "600")), connect=5.0)
+
+        self.cache = create_response_cache_from_env(state)
+        self.rate_limiter = create_rate_limiter_from_env(state)
+        self.resilience = create_resilience_from_env()
+        self.router = create_model_router_from_env()
+
+        self.openai = AsyncOpenAIClient(
+            http_client=self._new_http_client(),
+            cache=self.cache,
+            rate_limiter=self.rate_limiter,
+            resilience=self.resilience
+        )
+        self.claude = AsyncClaudeClient(
+            http_client=self._new_http_client(),
+            cache=self.cache,
+            rate_limiter=self.rate_limiter,
+            resilience=self.resilience
+        )
+
+    def _new_http_client(self) -> httpx.AsyncClient:
+        """Crea un client httpx con il pool configurato (uno per provider)"""
+        return httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+
+    def single_flight_stats(self) -> Dict[str, Dict[str, int]]:
+        """Contatori della coalescenza delle richieste identiche, per provider"""
+        return {
+            name: client.inflight.stats()
+            for name, client in (("openai", self.openai), ("claude", self.claude))
+            if client.inflight is not None
+        }
+
+    def prompt_cache_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Contatori della cache dei prompt dei provider (prefissi già elaborati), per provider"""
+        return {
+            "openai": self.openai.prompt_cache.stats(),
+            "claude": self.claude.prompt_cache.stats(),
+        }
+
+    async def close(self) -> None:
+        """Chiude tutti i client e i pool di connessioni"""
+        await self.openai.close()
+        await self.claude.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+# File in cui salvare lo stato dei job batch e intervallo (secondi) di aggiornamento
+BATCH_JOBS_PATH = os.getenv("BATCH_JOBS_PATH", "batch_jobs.json")
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "60"))
+
+# Intervallo (secondi) con cui i consumi per API key vengono salvati su disco
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "60"))
+
+# Budget di token della storia delle sessioni e cosa fare dei turni in eccesso
+# ("truncate" li scarta, "summarize" li riassume con SESSION_SUMMARY_MODEL)
+SESSION_HISTORY_TOKENS = int(os.getenv("SESSION_HISTORY_TOKENS", "8000"))
+SESSION_OVERFLOW = os.getenv("SESSION_OVERFLOW", "truncate").lower()
+SESSION_SUMMARY_MODEL = os.getenv("SESSION_SUMMARY_MODEL", "claude-sonnet-4-5-20250929")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Crea i client dei provider all'avvio del worker e li chiude allo shutdown"""
+    state = create_shared_state_from_env()
+    app.state.shared = state
+    clients = ClientRegistry(state)
+    app.state.clients = clients
+    app.state.usage = create_usage_tracker_from_env(state)
+    app.state.jobs = BatchJobManager(
+        {"openai": clients.openai, "claude": clients.claude},
+        clients.router,
+        path=BATCH_JOBS_PATH or None,
+        usage=app.state.usage
+    )
+    app.state.sessions = create_session_store_from_env(state)
+    app.state.keys = create_key_store_from_env()
+    app.state.quotas = QuotaManager(state)
+    app.state.admission = create_admission_controller_from_env()
+
+    background = [asyncio.create_task(app.state.usage.flush_forever(USAGE_FLUSH_INTERVAL))]
+    if BATCH_POLL_INTERVAL > 0:
+        background.append(asyncio.create_task(app.state.jobs.poll_forever(BATCH_POLL_INTERVAL)))
+    try:
+        yield
+    finally:
+        for task in background:
+            task.cancel()
+        app.state.usage.close()
+        app.state.sessions.close()
+        await clients.close()
+        state.close()
+
+
+def get_clients(request: Request) -> ClientRegistry:
+    """Dipendenza FastAPI che restituisce il registro dei client del worker"""
+    return request.app.state.clients
+
+
+def get_jobs(request: Request) -> BatchJobManager:
+    """Dipendenza FastAPI che restituisce il registro dei job batch"""
+    return request.app.state.jobs
+
+
+def get_sessions(request: Request) -> SessionStore:
+    """Dipendenza FastAPI che restituisce l'archivio delle sessioni di conversazione"""
+    return request.app.state.sessions
+
+
+def authenticate(request: Request, authorization: str = Header(None, include_in_schema=False)) -> ApiKey:
+    """
+    Dipendenza FastAPI che verifica l'API key del chiamante (header Authorization: Bearer ...)
+
+    Le chiavi sono quelle del file AUTH_KEYS_PATH più CUSTOM_GPT_API_KEY;
+    l'accesso è anonimo solo con AUTH=off.
+    """
+    keys: Optional[KeyStore] = request.app.state.keys
+    if keys is None:
+        return ANONYMOUS
+    if not keys.available:
+        # File delle chiavi illeggibile: si rifiuta tutto invece di aprire l'accesso
+        raise HTTPException(status_code=503, detail="API keys unavailable")
+    if not authorization:
+        raise HTTPException(status_code=401, detail="Missing API Key", headers={"WWW-Authenticate": "Bearer"})
+    api_key = keys.lookup(authorization.removeprefix("Bearer ").strip())
+    if api_key is None:
+        raise HTTPException(status_code=401, detail="Invalid API Key", headers={"WWW-Authenticate": "Bearer"})
+    return api_key
+
+
+def require_admin(api_key: ApiKey = Depends(authenticate)) -> ApiKey:
+    """Dipendenza FastAPI che ammette solo le chiavi con "admin": true (vedi auth.py)"""
+    if not api_key.admin:
+        raise HTTPException(status_code=403, detail="Admin API key required")
+    return api_key
+
+
+def require_quota(calls: int = 1, count_tokens: bool = True):
+    """
+    Dipendenza FastAPI che autentica il chiamante e ne applica le quote
+
+    Lo slot di concorrenza resta occupato fino alla fine della risposta (anche in
+    streaming) e viene liberato da QuotaReleaseMiddleware.
+
+    Args:
+        calls: Chiamate ai provider per richiesta (es. 2 per /compare), moltiplica i token stimati
+        count_tokens: False per le richieste il cui corpo non è un prompt JSON (es. upload JSONL)
+    """
+    async def dependency(request: Request, api_key: ApiKey = Depends(authenticate)) -> ApiKey:
+        tokens = 0
+        if count_tokens and api_key.tokens_per_minute:
+            try:
+                tokens = calls * estimate_request_tokens(await request.json())
+            except ValueError:
+                tokens = 0
+        try:
+            release = await request.app.state.quotas.acquire(api_key, tokens)
+        except QuotaExceeded as e:
+            raise HTTPException(
+                status_code=429,
+                detail=str(e),
+                headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))}
+            )
+        request.state.quota_release = [*getattr(request.state, "quota_release", []), release]
+
+        async def refund(amount: int) -> None:
+            # Mai più di quanto riservato per la richiesta
+            nonlocal tokens
+            amount = min(amount, tokens)
+            tokens -= amount
+            await request.app.state.quotas.refund(api_key, amount)
+
+        request.state.quota_refund = refund
+        return api_key
+
+    return dependency
+
+
+def admit(route: str):
+    """
+    Dipendenza FastAPI che attende uno slot del controllo di ammissione (vedi admission.py)
+
+    Va dichiarata dopo require_quota, così le richieste oltre quota vengono
+    rifiutate prima di entrare in coda. Le richieste con thinking=True hanno
+    priorità più bassa delle altre della stessa classe. Lo slot resta occupato
+    fino alla fine della risposta e viene liberato da QuotaReleaseMiddleware.
+
+    Args:
+        route: Classe di rotta (chat, stream, compare, batch) con limite e priorità propri
+    """
+    async def dependency(request: Request) -> None:
+        admission = request.app.state.admission
+        if admission is None:
+            return
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+        thinking = isinstance(body, dict) and bool(body.get("thinking"))
+        try:
+            release = await admission.acquire(route, admission.priority_for(route, thinking))
+        except AdmissionRejected as e:
+            raise HTTPException(
+                status_code=503,
+                detail=str(e),
+                headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))}
+            )
+        request.state.quota_release = [*getattr(request.state, "quota_release", []), release]
+
+    return dependency
+
+
+def get_api_key_id(api_key: ApiKey = Depends(authenticate)) -> str:
+    """Identificativo dell'API key del chiamante (per la contabilità dei consumi)"""
+    return api_key.id
+
+
+class UsageRecorder:
+    """Registra i token consumati da una richiesta sull'API key che l'ha effettuata"""
+
+    def __init__(self, tracker: UsageTracker, key_id: str, state: Any = None):
+        self.tracker = tracker
+        self.key_id = key_id
+        self.state = state
+
+    async def record(
+        self, provider: str, model: str, usage: Optional[Dict[str, int]], reused: bool = False
+    ) -> None:
+        """
+        Registra una chiamata e i token che ha consumato
+
+        Le risposte riusate (dalla cache o condivise con una richiesta identica
+        concorrente, vedi served_from) non hanno consumato token: contano come
+        richiesta senza token e restituiscono alla quota della chiave i token
+        riservati per la chiamata.
+        """
+        if not reused:
+            self.tracker.record(self.key_id, provider, model, usage)
+            return
+        self.tracker.record(self.key_id, provider, model, None)
+        refund = getattr(self.state, "quota_refund", None)
+        if refund is not None and usage:
+            await refund(usage.get("input_tokens", 0) + usage.get("output_tokens", 0))
+
+
+def get_usage_recorder(
+    request: Request, key_id: str = Depends(get_api_key_id)
+) -> UsageRecorder:
+    """Dipendenza FastAPI che restituisce il registratore dei consumi per il chiamante"""
+    return UsageRecorder(request.app.state.usage, key_id, request.state)
+
 
 app = FastAPI(
     title="AI API for Custom GPT",
     description="API per estendere Custom GPT con chiamate a OpenAI e Claude",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
+# Corpi JSON delle richieste letti con fast_json (da impostare prima di dichiarare gli endpoint)
+app.router.route_class = FastJSONRoute
 
 # Configurazione CORS per permettere chiamate da ChatGPT
 app.add_middleware(
@@ -25,39 +337,161 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Autenticazione semplice (da configurare nel Custom GPT)
-API_KEY = os.getenv("CUSTOM_GPT_API_KEY", "your-secret-api-key-here")
+# Numero massimo di elementi accettati da /batch
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
 
+# Timeout di default (secondi) per ciascun provider in /compare
+COMPARE_PROVIDER_TIMEOUT = float(os.getenv("COMPARE_PROVIDER_TIMEOUT", "120"))
 
-def verify_api_key(authorization: str = Header(None)):
-    """Verifica l'API key dalle richieste"""
-    if not authorization:
-        raise HTTPException(status_code=401, detail="Missing API Key")
+# Caratteri massimi del ragionamento restituito con include_thinking="summary"
+THINKING_SUMMARY_CHARS = int(os.getenv("THINKING_SUMMARY_CHARS", "1000"))
+
+# Annulla l'endpoint (e la chiamata al provider) se il client si disconnette prima della fine
+# della risposta; aggiunto prima delle metriche, che registrano la richiesta con stato 499
+if os.getenv("CANCEL_ON_DISCONNECT", "on").lower() != "off":
+    app.add_middleware(CancelOnDisconnectMiddleware)
 
-    if authorization != f"Bearer {API_KEY}":
-        raise HTTPException(status_code=401, detail="Invalid API Key")
+# Metriche per rotta (durata, esito, richieste in corso), esposte su /metrics
+app.add_middleware(metrics.MetricsMiddleware, router=app.router)
 
-    return True
+# Libera gli slot delle quote e del controllo di ammissione a risposta conclusa (vedi require_quota e admit)
+app.add_middleware(QuotaReleaseMiddleware)
+
+# Compressione gzip/brotli negoziata con Accept-Encoding (gli stream con un flush per evento)
+if os.getenv("COMPRESSION", "on").lower() != "off":
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=int(os.getenv("COMPRESSION_MIN_SIZE", "1024")),
+        gzip_level=int(os.getenv("COMPRESSION_GZIP_LEVEL", "6")),
+        brotli_quality=int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4")),
+    )
+
+
+def provider_error(prefix: str, error: Exception) -> HTTPException:
+    """Converte un errore della chiamata a un provider nella risposta HTTP appropriata"""
+    if isinstance(error, RateLimitExceeded):
+        return HTTPException(
+            status_code=429,
+            detail=f"{prefix}: {str(error)}",
+            headers=retry_after_header(error)
+        )
+    if isinstance(error, CircuitOpenError):
+        return HTTPException(
+            status_code=503,
+            detail=f"{prefix}: {str(error)}",
+            headers={"Retry-After": str(max(1, math.ceil(error.retry_after)))}
+        )
+    if isinstance(error, ContextBudgetError):
+        return HTTPException(status_code=400, detail=f"{prefix}: {str(error)}")
+    return HTTPException(status_code=500, detail=f"{prefix}: {str(error)}")
 
 
 # Modelli per le richieste
+def _thinking_mode(value: Any) -> Any:
+    """Accetta anche i valori booleani delle versioni precedenti (true = full, false = off)"""
+    if isinstance(value, bool):
+        return "full" if value else "off"
+    return value
+
+
+ThinkingMode = Annotated[Literal["off", "summary", "full"], BeforeValidator(_thinking_mode)]
+
+
 class AIRequest(BaseModel):
     prompt: str = Field(..., description="Il prompt da inviare all'AI")
     thinking: bool = Field(default=False, description="Abilita il ragionamento esteso")
     max_tokens: Optional[int] = Field(default=None, description="Limite di token nella risposta")
     temperature: Optional[float] = Field(default=1.0, description="Temperatura (0.0-2.0)")
+    system: Optional[str] = Field(default=None, description="System prompt (istruzioni fisse del GPT)")
+    cache_prompt: bool = Field(
+        default=False,
+        description="Marca il system prompt come prefisso cacheable (Claude; OpenAI lo fa automaticamente)"
+    )
+    bypass_cache: bool = Field(
+        default=False,
+        description="Ignora la cache delle risposte (usata solo con temperature=0)"
+    )
+    include_thinking: ThinkingMode = Field(
+        default="full",
+        description="Ragionamento restituito nel campo thinking: off (nessuno), summary (inizio e conclusione) o full"
+    )
+    thinking_max_chars: Optional[int] = Field(
+        default=None, ge=0,
+        description="Tronca il testo del ragionamento restituito a questo numero di caratteri"
+    )
 
 
 class CompareRequest(BaseModel):
     prompt: str = Field(..., description="Il prompt da inviare a entrambi i modelli")
     thinking: bool = Field(default=False, description="Abilita il ragionamento esteso")
+    system: Optional[str] = Field(default=None, description="System prompt (istruzioni fisse del GPT)")
+    cache_prompt: bool = Field(
+        default=False,
+        description="Marca il system prompt come prefisso cacheable (Claude; OpenAI lo fa automaticamente)"
+    )
+    timeout: Optional[float] = Field(
+        default=None, gt=0,
+        description="Tempo massimo in secondi concesso a ciascun provider"
+    )
+    allow_partial: bool = Field(
+        default=False,
+        description="Se True, restituisce comunque la risposta del provider riuscito quando l'altro fallisce o va in timeout"
+    )
+    include_thinking: ThinkingMode = Field(
+        default="full",
+        description="Ragionamento restituito nel campo thinking: off (nessuno), summary (inizio e conclusione) o full"
+    )
+    thinking_max_chars: Optional[int] = Field(
+        default=None, ge=0,
+        description="Tronca il testo del ragionamento restituito a questo numero di caratteri"
+    )
+
+
+class BatchItem(AIRequest):
+    provider: Literal["openai", "claude"] = Field(..., description="Provider a cui inviare il prompt")
+
+
+class SessionMessageRequest(AIRequest):
+    provider: Literal["openai", "claude", "auto"] = Field(
+        default="claude", description="Provider a cui inviare il turno (auto: il modello più veloce tra i due)"
+    )
+
+
+class BatchRequest(BaseModel):
+    items: list[BatchItem] = Field(..., min_length=1, description="Prompt da eseguire")
+    concurrency: int = Field(
+        default=8, ge=1, le=64,
+        description="Numero massimo di chiamate eseguite in parallelo"
+    )
+    stream: bool = Field(
+        default=False,
+        description="Se True, restituisce i risultati come NDJSON (una riga per elemento, in ordine)"
+    )
 
 
 # Modelli per le risposte
+class Usage(BaseModel):
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_input_tokens: int = Field(default=0, description="Token di input letti dalla cache dei prompt")
+    cache_creation_input_tokens: int = Field(default=0, description="Token di input scritti nella cache dei prompt")
+    reasoning_tokens: int = Field(default=0, description="Token di ragionamento (modelli o1; per Claude inclusi in output_tokens)")
+    cached: bool = Field(
+        default=False,
+        description="True se la risposta viene dalla cache o da una richiesta identica concorrente: token non consumati di nuovo"
+    )
+
+
 class AIResponse(BaseModel):
     response: str
     model: str
+    provider: Optional[str] = None
     thinking_used: bool
+    thinking: Optional[str] = Field(default=None, description="Ragionamento di Claude, secondo include_thinking")
+    reasoning_tokens: Optional[int] = Field(
+        default=None, description="Token di ragionamento dei modelli OpenAI o1 (l'API non ne espone il testo)"
+    )
+    usage: Optional[Usage] = None
 
 
 class CompareResponse(BaseModel):
@@ -65,6 +499,32 @@ class CompareResponse(BaseModel):
     claude_response: str
     openai_model: str
     claude_model: str
+    openai_error: Optional[str] = None
+    claude_error: Optional[str] = None
+    claude_thinking: Optional[str] = Field(default=None, description="Ragionamento di Claude, secondo include_thinking")
+    openai_reasoning_tokens: Optional[int] = Field(default=None, description="Token di ragionamento del modello OpenAI o1")
+    openai_usage: Optional[Usage] = None
+    claude_usage: Optional[Usage] = None
+
+
+class SessionResponse(AIResponse):
+    session_id: str
+    turns: int = Field(..., description="Turni user/assistant attualmente in storia")
+    history_tokens: int = Field(..., description="Token stimati di storia e riassunto")
+    dropped_turns: int = Field(..., description="Turni scartati o riassunti per rispettare il budget")
+
+
+class BatchItemResult(BaseModel):
+    index: int
+    provider: str
+    result: Optional[AIResponse] = None
+    error: Optional[str] = None
+
+
+class BatchResponse(BaseModel):
+    results: list[BatchItemResult]
+    succeeded: int
+    failed: int
 
 
 # Endpoint API
@@ -78,135 +538,928 @@ async def root():
         "endpoints": [
             "/openai/chat",
             "/claude/chat",
-            "/compare"
+            "/chat",
+            "/compare",
+            "/openai/chat/stream",
+            "/claude/chat/stream",
+            "/compare/stream",
+            "/batch",
+            "/jobs",
+            "/sessions/{session_id}/messages"
         ]
     }
 
 
+def openai_messages(request: Union[AIRequest, CompareRequest]) -> list[Dict[str, str]]:
+    """Messaggi per OpenAI: l'eventuale system prompt precede il prompt dell'utente"""
+    messages = [{"role": "user", "content": request.prompt}]
+    if request.system:
+        messages.insert(0, {"role": "system", "content": request.system})
+    return messages
+
+
+def claude_options(request: Union[AIRequest, CompareRequest]) -> Dict[str, Any]:
+    """System prompt e prompt caching per Claude (il system prompt è un parametro a parte)"""
+    options: Dict[str, Any] = {"cache_prompt": request.cache_prompt}
+    if request.system:
+        options["system"] = request.system
+    return options
+
+
+async def run_openai_chat(
+    clients: ClientRegistry, request: AIRequest, model: str, usage: Optional[UsageRecorder] = None
+) -> AIResponse:
+    """Esegue una richiesta AIRequest su un modello OpenAI"""
+    messages = openai_messages(request)
+
+    response = await clients.openai.chat_completion(
+        messages=messages,
+        model=model,
+        thinking_enabled=request.thinking,
+        temperature=request.temperature,
+        max_tokens=request.max_tokens,
+        use_cache=not request.bypass_cache
+    )
+
+    tokens = clients.openai.extract_usage(response)
+    reused = served_from(response) is not None
+    if usage is not None:
+        await usage.record("openai", model, tokens, reused)
+
+    return AIResponse(
+        response=response.choices[0].message.content,
+        model=model,
+        provider="openai",
+        thinking_used=request.thinking,
+        reasoning_tokens=reasoning_tokens(tokens, request.thinking),
+        usage=Usage(**tokens, cached=reused) if tokens else None
+    )
+
+
+def reasoning_tokens(tokens: Optional[Dict[str, int]], thinking: bool) -> Optional[int]:
+    """Token di ragionamento di una risposta OpenAI, solo per i modelli di ragionamento"""
+    if not thinking or not tokens:
+        return None
+    return tokens.get("reasoning_tokens", 0)
+
+
+def summarize_thinking(text: str, max_chars: int) -> str:
+    """
+    Riassunto estrattivo di un ragionamento, entro max_chars caratteri
+
+    Conserva l'inizio del primo paragrafo (come il modello imposta il problema)
+    e gli ultimi paragrafi interi (la conclusione), senza altre chiamate al modello.
+    """
+    if len(text) <= max_chars:
+        return text
+    paragraphs = [paragraph.strip() for paragraph in text.split("\n\n") if paragraph.strip()]
+    head = paragraphs[0][:max_chars // 3]
+    budget = max_chars - len(head)
+    tail: list[str] = []
+    for paragraph in reversed(paragraphs[1:]):
+        if len(paragraph) > budget:
+            break
+        tail.append(paragraph)
+        budget -= len(paragraph)
+    if not tail and budget > 0:
+        tail.append(paragraphs[-1][-budget:])
+    return "\n\n".join([head, "…", *reversed(tail)])
+
+
+def trim_thinking(text: str, request: Union[AIRequest, CompareRequest]) -> Optional[str]:
+    """Ragionamento da restituire nel campo thinking, secondo include_thinking e thinking_max_chars"""
+    if not text or request.include_thinking == "off":
+        return None
+    if request.include_thinking == "summary":
+        text = summarize_thinking(text, THINKING_SUMMARY_CHARS)
+    limit = request.thinking_max_chars
+    if limit is not None and len(text) > limit:
+        return f"{text[:limit]}… [{len(text) - limit} caratteri omessi]"
+    return text
+
+
+async def run_claude_chat(
+    clients: ClientRegistry, request: AIRequest, model: str, usage: Optional[UsageRecorder] = None
+) -> AIResponse:
+    """Esegue una richiesta AIRequest su un modello Claude"""
+    messages = [{"role": "user", "content": request.prompt}]
+
+    response = await clients.claude.create_message(
+        messages=messages,
+        model=model,
+        thinking_enabled=request.thinking,
+        temperature=1.0 if request.temperature is None else request.temperature,
+        max_tokens=request.max_tokens or 8192,
+        use_cache=not request.bypass_cache,
+        **claude_options(request)
+    )
+
+    content = assemble_claude_response(response)
+    reused = served_from(response) is not None
+    if usage is not None:
+        await usage.record("claude", model, content.usage, reused)
+
+    # Il ragionamento (se il chiamante lo vuole) è in un campo separato dalla risposta
+    return AIResponse(
+        response=content.text,
+        model=model,
+        provider="claude",
+        thinking_used=request.thinking,
+        thinking=trim_thinking(content.thinking, request),
+        usage=Usage(**content.usage, cached=reused)
+    )
+
+
+RUNNERS = {"openai": run_openai_chat, "claude": run_claude_chat}
+
+
+async def run_routed_chat(
+    clients: ClientRegistry, route: str, request: AIRequest, usage: Optional[UsageRecorder] = None
+) -> AIResponse:
+    """
+    Esegue una richiesta AIRequest sul modello scelto dal router per la rotta
+
+    Se il modello scelto fallisce per un problema del provider si passa al
+    candidato successivo; provider e model della risposta indicano chi l'ha servita.
+    """
+    _, response = await clients.router.call(
+        route,
+        lambda candidate: RUNNERS[candidate.provider](clients, request, candidate.model, usage),
+        reused=lambda response: response.usage is not None and response.usage.cached
+    )
+    return response
+
+
 @app.post("/openai/chat", response_model=AIResponse)
 async def openai_chat(
     request: AIRequest,
-    authorized: bool = Header(None, include_in_schema=False)
+    clients: ClientRegistry = Depends(get_clients),
+    usage: UsageRecorder = Depends(get_usage_recorder),
+    api_key: ApiKey = Depends(require_quota()),
+    admitted: None = Depends(admit("chat"))
 ):
     """
     Chiama OpenAI GPT con opzione thinking
 
-    Quando thinking=True, usa automaticamente il modello o1 con reasoning
+    Quando thinking=True, usa automaticamente il modello o1 con reasoning.
+    I modelli sono quelli delle rotte "openai" e "openai-thinking" del router.
+    """
+    try:
+        return await run_routed_chat(clients, route_for("openai", request.thinking), request, usage)
+    except Exception as e:
+        raise provider_error("OpenAI Error", e)
+
+
+@app.post("/claude/chat", response_model=AIResponse)
+async def claude_chat(
+    request: AIRequest,
+    clients: ClientRegistry = Depends(get_clients),
+    usage: UsageRecorder = Depends(get_usage_recorder),
+    api_key: ApiKey = Depends(require_quota()),
+    admitted: None = Depends(admit("chat"))
+):
+    """
+    Chiama Claude con opzione extended thinking
+
+    Quando thinking=True, Claude userà il ragionamento esteso.
+    I modelli sono quelli delle rotte "claude" e "claude-thinking" del router.
+    """
+    try:
+        return await run_routed_chat(clients, route_for("claude", request.thinking), request, usage)
+    except Exception as e:
+        raise provider_error("Claude Error", e)
+
+
+@app.post("/chat", response_model=AIResponse)
+async def routed_chat(
+    request: AIRequest,
+    clients: ClientRegistry = Depends(get_clients),
+    usage: UsageRecorder = Depends(get_usage_recorder),
+    api_key: ApiKey = Depends(require_quota()),
+    admitted: None = Depends(admit("chat"))
+):
+    """
+    Chiama il modello più veloce tra quelli sani della rotta "auto" (o "auto-thinking")
+
+    I candidati possono essere di entrambi i provider; se uno fallisce si passa
+    al successivo. I campi provider e model indicano chi ha servito la richiesta.
     """
     try:
-        client = OpenAIClient()
-        messages = [{"role": "user", "content": request.prompt}]
+        return await run_routed_chat(clients, route_for("auto", request.thinking), request, usage)
+    except Exception as e:
+        raise provider_error("Chat Error", e)
 
-        model = "o1" if request.thinking else "gpt-4o"
 
-        response = client.chat_completion(
+@app.post("/compare", response_model=CompareResponse)
+async def compare_models(
+    request: CompareRequest,
+    clients: ClientRegistry = Depends(get_clients),
+    usage: UsageRecorder = Depends(get_usage_recorder),
+    api_key: ApiKey = Depends(require_quota(calls=2)),
+    admitted: None = Depends(admit("compare"))
+):
+    """
+    Confronta le risposte di OpenAI e Claude sullo stesso prompt
+
+    I due provider vengono chiamati in parallelo, ognuno con la propria scadenza:
+    la latenza è quella del più lento, non la somma. Con allow_partial=True un
+    provider lento o in errore non fa fallire l'intera richiesta. I modelli sono
+    quelli delle rotte "openai" e "claude" (o "*-thinking") del router, con
+    fallback tra i candidati dello stesso provider.
+    """
+    messages = [{"role": "user", "content": request.prompt}]
+    openai_route = route_for("openai", request.thinking)
+    claude_route = route_for("claude", request.thinking)
+    timeout = request.timeout or COMPARE_PROVIDER_TIMEOUT
+
+    async def call_openai(candidate: Candidate) -> Tuple[str, Optional[str], Dict[str, int], bool]:
+        response = await clients.openai.chat_completion(
+            messages=openai_messages(request),
+            model=candidate.model,
+            thinking_enabled=request.thinking
+        )
+        tokens = clients.openai.extract_usage(response)
+        reused = served_from(response) is not None
+        await usage.record("openai", candidate.model, tokens, reused)
+        return response.choices[0].message.content, None, tokens, reused
+
+    async def call_claude(candidate: Candidate) -> Tuple[str, Optional[str], Dict[str, int], bool]:
+        response = await clients.claude.create_message(
             messages=messages,
-            model=model,
+            model=candidate.model,
             thinking_enabled=request.thinking,
-            temperature=request.temperature,
-            max_tokens=request.max_tokens
+            max_tokens=8192,
+            **claude_options(request)
         )
 
-        return AIResponse(
-            response=response.choices[0].message.content,
-            model=model,
-            thinking_used=request.thinking
+        content = assemble_claude_response(response)
+        reused = served_from(response) is not None
+        await usage.record("claude", candidate.model, content.usage, reused)
+        return content.text, trim_thinking(content.thinking, request), content.usage, reused
+
+    # Chiama entrambi i modelli in parallelo
+    calls = [
+        asyncio.ensure_future(_call_with_deadline(
+            clients.router.call(openai_route, call_openai, provider="openai", reused=lambda result: result[3]), timeout
+        )),
+        asyncio.ensure_future(_call_with_deadline(
+            clients.router.call(claude_route, call_claude, provider="claude", reused=lambda result: result[3]), timeout
+        )),
+    ]
+    try:
+        (openai_result, openai_error), (claude_result, claude_error) = await asyncio.gather(*calls)
+    except ContextBudgetError as e:
+        # Il prompt non sta nella finestra di contesto: errore del client, non un fallimento parziale
+        for call in calls:
+            call.cancel()
+        raise provider_error("Comparison Error", e)
+
+    if (openai_error and claude_error) or (
+        not request.allow_partial and (openai_error or claude_error)
+    ):
+        errors = [
+            f"{name}: {error}"
+            for name, error in (("OpenAI", openai_error), ("Claude", claude_error))
+            if error
+        ]
+        raise HTTPException(status_code=500, detail=f"Comparison Error: {'; '.join(errors)}")
+
+    openai_candidate, (openai_text, _, openai_tokens, openai_reused) = openai_result or (
+        clients.router.select(openai_route, provider="openai"), ("", None, None, False)
+    )
+    claude_candidate, (claude_text, claude_thinking, claude_tokens, claude_reused) = claude_result or (
+        clients.router.select(claude_route, provider="claude"), ("", None, None, False)
+    )
+    return CompareResponse(
+        openai_response=openai_text,
+        claude_response=claude_text,
+        openai_model=openai_candidate.model,
+        claude_model=claude_candidate.model,
+        openai_error=openai_error,
+        claude_error=claude_error,
+        claude_thinking=claude_thinking,
+        openai_reasoning_tokens=reasoning_tokens(openai_tokens, request.thinking),
+        openai_usage=Usage(**openai_tokens, cached=openai_reused) if openai_tokens else None,
+        claude_usage=Usage(**claude_tokens, cached=claude_reused) if claude_tokens else None
+    )
+
+
+async def _call_with_deadline(
+    call: Awaitable[Any], timeout: float
+) -> Tuple[Optional[Any], Optional[str]]:
+    """
+    Attende una chiamata a un provider entro la scadenza indicata
+
+    Returns:
+        Coppia (risultato, errore): esattamente uno dei due è None
+
+    Raises:
+        ContextBudgetError: la richiesta non sta nella finestra di contesto (risposta 400)
+    """
+    try:
+        return await asyncio.wait_for(call, timeout=timeout), None
+    except asyncio.TimeoutError:
+        return None, f"Timeout after {timeout:g}s"
+    except ContextBudgetError:
+        raise
+    except Exception as e:
+        return None, str(e)
+
+
+@app.post("/batch", response_model=BatchResponse)
+async def batch(
+    request: BatchRequest,
+    clients: ClientRegistry = Depends(get_clients),
+    usage: UsageRecorder = Depends(get_usage_recorder),
+    api_key: ApiKey = Depends(require_quota()),
+    admitted: None = Depends(admit("batch"))
+):
+    """
+    Esegue molti prompt in una sola richiesta, con parallelismo limitato
+
+    I risultati sono restituiti nell'ordine degli elementi in ingresso; un errore
+    su un elemento non fa fallire gli altri. Con stream=True ogni risultato viene
+    inviato come riga NDJSON appena è pronto (sempre rispettando l'ordine).
+    """
+    if len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many items: {len(request.items)} (max {BATCH_MAX_ITEMS})"
         )
 
+    semaphore = asyncio.Semaphore(request.concurrency)
+
+    async def run_item(index: int, item: BatchItem) -> BatchItemResult:
+        async with semaphore:
+            try:
+                route = route_for(item.provider, item.thinking)
+                result = await run_routed_chat(clients, route, item, usage)
+                return BatchItemResult(index=index, provider=item.provider, result=result)
+            except Exception as e:
+                return BatchItemResult(index=index, provider=item.provider, error=str(e))
+
+    tasks = [
+        asyncio.create_task(run_item(index, item))
+        for index, item in enumerate(request.items)
+    ]
+
+    if request.stream:
+        return StreamingResponse(_ndjson_results(tasks), media_type="application/x-ndjson")
+
+    results = await asyncio.gather(*tasks)
+    failed = sum(1 for r in results if r.error is not None)
+    return BatchResponse(results=results, succeeded=len(results) - failed, failed=failed)
+
+
+async def _ndjson_results(tasks: list["asyncio.Task"]) -> AsyncIterator[str]:
+    """Invia i risultati del batch come NDJSON, nell'ordine degli elementi"""
+    try:
+        for task in tasks:
+            result = await task
+            yield result.model_dump_json() + "\n"
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+# Job batch offline (Batch API dei provider)
+
+@app.post("/jobs", response_model=BatchJob)
+async def create_job(
+    http_request: Request,
+    provider: Literal["openai", "claude"],
+    jobs: BatchJobManager = Depends(get_jobs),
+    api_key: ApiKey = Depends(require_quota(count_tokens=False))
+):
+    """
+    Crea un job batch offline a partire da un file JSONL
+
+    Il corpo della richiesta è un file JSONL (application/x-ndjson) con una
+    richiesta per riga: {"custom_id": "...", "prompt": "...", "thinking": false,
+    "max_tokens": null, "temperature": 1.0}. Il job viene elaborato dalla Batch
+    API del provider (entro 24 ore, a costo ridotto) e appartiene all'API key
+    che lo crea.
+    """
+    body = await http_request.body()
+    try:
+        items = parse_jsonl(body.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        return await jobs.submit(provider, items, key_id=api_key.id)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"OpenAI Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Batch Job Error: {str(e)}")
 
 
-@app.post("/claude/chat", response_model=AIResponse)
-async def claude_chat(
-    request: AIRequest,
-    authorized: bool = Header(None, include_in_schema=False)
+def job_owner(api_key: ApiKey = Depends(authenticate)) -> Optional[str]:
+    """
+    Dipendenza FastAPI che restituisce l'API key a cui limitare i job visibili
+
+    Le chiavi admin vedono i job di tutte le chiavi (None), le altre solo i
+    propri: i job degli altri risultano inesistenti (404).
+    """
+    return None if api_key.admin else api_key.id
+
+
+@app.get("/jobs", response_model=list[BatchJob])
+async def list_jobs(
+    jobs: BatchJobManager = Depends(get_jobs),
+    owner: Optional[str] = Depends(job_owner)
+):
+    """Elenca i job batch del chiamante (tutti per le chiavi admin), dal più recente"""
+    return jobs.list(key_id=owner)
+
+
+@app.get("/jobs/{job_id}", response_model=BatchJob)
+async def get_job(
+    job_id: str,
+    jobs: BatchJobManager = Depends(get_jobs),
+    owner: Optional[str] = Depends(job_owner)
+):
+    """Restituisce lo stato aggiornato di un job batch"""
+    try:
+        return await jobs.refresh(job_id, key_id=owner)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Batch Job Error: {str(e)}")
+
+
+@app.post("/jobs/{job_id}/cancel", response_model=BatchJob)
+async def cancel_job(
+    job_id: str,
+    jobs: BatchJobManager = Depends(get_jobs),
+    owner: Optional[str] = Depends(job_owner)
+):
+    """Annulla un job batch in corso"""
+    try:
+        return await jobs.cancel(job_id, key_id=owner)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Batch Job Error: {str(e)}")
+
+
+@app.get("/jobs/{job_id}/results")
+async def get_job_results(
+    job_id: str,
+    jobs: BatchJobManager = Depends(get_jobs),
+    owner: Optional[str] = Depends(job_owner)
 ):
     """
-    Chiama Claude con opzione extended thinking
+    Scarica i risultati di un job concluso come NDJSON
 
-    Quando thinking=True, Claude userà il ragionamento esteso
+    Ogni riga contiene custom_id, response, model, usage ed error. Al primo
+    download i token dei risultati vengono registrati nei consumi (/usage)
+    dell'API key che ha creato il job.
     """
     try:
-        client = ClaudeClient()
-        messages = [{"role": "user", "content": request.prompt}]
+        job = await jobs.refresh(job_id, key_id=owner)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Batch Job Error: {str(e)}")
+
+    if job.status not in ("completed", "cancelled", "expired"):
+        raise HTTPException(status_code=409, detail=f"Job not finished (status: {job.status})")
+
+    async def lines() -> AsyncIterator[str]:
+        async for result in jobs.results(job_id, key_id=owner):
+            yield fast_json.dumps_str(result) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+# Sessioni di conversazione
+
+def _session_system(session: Session) -> Optional[str]:
+    """System prompt della sessione, seguito dall'eventuale riassunto dei turni scartati"""
+    if not session.summary:
+        return session.system
+    note = f"Riassunto della conversazione precedente:\n{session.summary}"
+    return f"{session.system}\n\n{note}" if session.system else note
+
+
+async def summarize_turns(
+    clients: ClientRegistry,
+    usage: UsageRecorder,
+    summary: Optional[str],
+    dropped: list[Dict[str, str]]
+) -> str:
+    """Aggiorna il riassunto di una sessione con i turni usciti dalla storia"""
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in dropped)
+    prompt = (
+        "Aggiorna il riassunto di questa conversazione con i nuovi turni, conservando "
+        "fatti, nomi, decisioni e richieste dell'utente. Rispondi solo con il riassunto.\n\n"
+    )
+    if summary:
+        prompt += f"Riassunto attuale:\n{summary}\n\n"
+    prompt += f"Nuovi turni:\n{transcript}"
+
+    response = await clients.claude.create_message(
+        messages=[{"role": "user", "content": prompt}],
+        model=SESSION_SUMMARY_MODEL,
+        max_tokens=1024,
+        temperature=0
+    )
+    content = assemble_claude_response(response)
+    await usage.record("claude", SESSION_SUMMARY_MODEL, content.usage, served_from(response) is not None)
+    return content.text
+
+
+@app.post("/sessions/{session_id}/messages", response_model=SessionResponse)
+async def session_message(
+    session_id: str,
+    request: SessionMessageRequest,
+    clients: ClientRegistry = Depends(get_clients),
+    sessions: SessionStore = Depends(get_sessions),
+    key_id: str = Depends(get_api_key_id),
+    usage: UsageRecorder = Depends(get_usage_recorder),
+    api_key: ApiKey = Depends(require_quota()),
+    admitted: None = Depends(admit("chat"))
+):
+    """
+    Aggiunge un turno a una conversazione (la sessione viene creata al primo turno)
+
+    Il client invia solo il nuovo prompt: la storia è conservata dal server.
+    Il campo system, se presente, sostituisce il system prompt della sessione.
+    Oltre SESSION_HISTORY_TOKENS i turni più vecchi vengono scartati o riassunti
+    (SESSION_OVERFLOW). Le sessioni sono separate per API key.
+    """
+    key = f"{key_id}:{session_id}"
+    async with sessions.lock(key):
+        now = time.time()
+        session = await sessions.aget(key) or Session(id=session_id, created_at=now, updated_at=now)
+        if request.system is not None:
+            session.system = request.system or None
+
+        summarize = None
+        if SESSION_OVERFLOW == "summarize":
+            summarize = functools.partial(summarize_turns, clients, usage)
+
+        route = route_for(request.provider, request.thinking)
+        try:
+            # Storia stimata per la famiglia del candidato preferito, come farà il controllo del contesto
+            family = clients.router.select(route).provider
+            await compact_history(session, SESSION_HISTORY_TOKENS, family, summarize)
+
+            system = _session_system(session)
+            messages = session.messages + [{"role": "user", "content": request.prompt}]
+
+            async def turn(candidate: Candidate) -> Tuple[str, Optional[str], Dict[str, int], bool]:
+                if candidate.provider == "openai":
+                    response = await clients.openai.chat_completion(
+                        messages=([{"role": "system", "content": system}] if system else []) + messages,
+                        model=candidate.model,
+                        thinking_enabled=request.thinking,
+                        temperature=request.temperature,
+                        max_tokens=request.max_tokens,
+                        use_cache=not request.bypass_cache
+                    )
+                    return (
+                        response.choices[0].message.content or "", None,
+                        clients.openai.extract_usage(response), served_from(response) is not None
+                    )
+
+                response = await clients.claude.create_message(
+                    messages=messages,
+                    model=candidate.model,
+                    thinking_enabled=request.thinking,
+                    temperature=1.0 if request.temperature is None else request.temperature,
+                    max_tokens=request.max_tokens or 8192,
+                    use_cache=not request.bypass_cache,
+                    cache_prompt=request.cache_prompt,
+                    **({"system": system} if system else {})
+                )
+                # In storia resta solo la risposta: il ragionamento non serve ai turni successivi
+                content = assemble_claude_response(response)
+                return content.text, content.thinking, content.usage, served_from(response) is not None
+
+            candidate, (answer, thinking, tokens, reused) = await clients.router.call(
+                route, turn, reused=lambda result: result[3]
+            )
+        except Exception as e:
+            raise provider_error("Session Error", e)
+
+        model = candidate.model
+        await usage.record(candidate.provider, model, tokens, reused)
+        session.messages = messages + [{"role": "assistant", "content": answer}]
+        await sessions.asave(key, session)
+
+    return SessionResponse(
+        response=answer,
+        model=model,
+        provider=candidate.provider,
+        thinking_used=request.thinking,
+        thinking=trim_thinking(thinking or "", request),
+        reasoning_tokens=reasoning_tokens(tokens, request.thinking) if candidate.provider == "openai" else None,
+        usage=Usage(**tokens, cached=reused) if tokens else None,
+        session_id=session_id,
+        turns=len(session.messages) // 2,
+        history_tokens=history_tokens(session, candidate.provider),
+        dropped_turns=session.dropped_turns
+    )
+
+
+@app.get("/sessions/{session_id}", response_model=Session)
+async def get_session(
+    session_id: str,
+    sessions: SessionStore = Depends(get_sessions),
+    key_id: str = Depends(get_api_key_id),
+    api_key: ApiKey = Depends(authenticate)
+):
+    """Storia, riassunto e system prompt di una sessione"""
+    session = await sessions.aget(f"{key_id}:{session_id}")
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Session not found: {session_id}")
+    return session
+
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(
+    session_id: str,
+    sessions: SessionStore = Depends(get_sessions),
+    key_id: str = Depends(get_api_key_id),
+    api_key: ApiKey = Depends(authenticate)
+):
+    """Elimina una sessione e la sua storia"""
+    if not await sessions.adelete(f"{key_id}:{session_id}"):
+        raise HTTPException(status_code=404, detail=f"Session not found: {session_id}")
+    return {"deleted": session_id}
+
+
+# Endpoint di streaming (Server-Sent Events)
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # Disabilita il buffering dei reverse proxy (nginx)
+}
+
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    """Formatta un evento Server-Sent Events"""
+    return f"event: {event}\ndata: {fast_json.dumps_str(data)}\n\n"
+
+
+async def _sse_stream(
+    events: AsyncIterator[Dict[str, Any]], model: str
+) -> AsyncIterator[str]:
+    """
+    Converte gli eventi di stream_events in Server-Sent Events
+
+    Ogni evento del client diventa un evento SSE con lo stesso tipo
+    (text, thinking, usage); lo stream termina con "done" oppure "error".
+    """
+    try:
+        async for event in events:
+            yield _sse(event["type"], event)
+    except Exception as e:
+        yield _sse("error", {"type": "error", "error": str(e)})
+        return
+    yield _sse("done", {"type": "done", "model": model})
+
 
-        response = client.create_message(
+async def _filter_thinking(
+    events: AsyncIterator[Dict[str, Any]], request: Union[AIRequest, CompareRequest]
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Omette, riassume o tronca gli eventi thinking di uno stream, come trim_thinking
+
+    Con include_thinking="summary" il ragionamento viene accumulato e inviato
+    come un unico evento thinking (riassunto) prima del primo evento successivo.
+    """
+    if request.include_thinking == "summary":
+        async for event in _summarize_thinking_events(events, request):
+            yield event
+        return
+
+    limit = request.thinking_max_chars
+    sent = 0
+    async for event in events:
+        if event["type"] == "thinking":
+            if request.include_thinking == "off" or (limit is not None and sent >= limit):
+                continue
+            text = event["thinking"]
+            if limit is not None and sent + len(text) > limit:
+                text = text[:limit - sent] + "…"
+            sent += len(event["thinking"])
+            event = {**event, "thinking": text}
+        yield event
+
+
+async def _summarize_thinking_events(
+    events: AsyncIterator[Dict[str, Any]], request: Union[AIRequest, CompareRequest]
+) -> AsyncIterator[Dict[str, Any]]:
+    """Sostituisce i delta del ragionamento con un solo evento thinking riassunto"""
+    # Ragionamento assemblato come nelle risposte non in streaming (vedi ClaudeContentBuilder)
+    builder: Optional[ClaudeContentBuilder] = None
+    async for event in events:
+        if event["type"] == "thinking":
+            builder = builder or ClaudeContentBuilder()
+            builder.add_event(event)
+            continue
+        if builder is not None:
+            yield {"type": "thinking", "thinking": trim_thinking(builder.build().thinking, request)}
+            builder = None
+        yield event
+    if builder is not None:
+        yield {"type": "thinking", "thinking": trim_thinking(builder.build().thinking, request)}
+
+
+async def _record_stream_usage(
+    events: AsyncIterator[Dict[str, Any]], usage: UsageRecorder, provider: str, model: str
+) -> AsyncIterator[Dict[str, Any]]:
+    """Inoltra gli eventi di uno stream registrando i token dell'evento usage"""
+    async for event in events:
+        if event["type"] == "usage":
+            await usage.record(provider, model, event["usage"])
+        yield event
+
+
+@app.post("/openai/chat/stream")
+async def openai_chat_stream(
+    request: AIRequest,
+    clients: ClientRegistry = Depends(get_clients),
+    usage: UsageRecorder = Depends(get_usage_recorder),
+    api_key: ApiKey = Depends(require_quota()),
+    admitted: None = Depends(admit("stream"))
+):
+    """
+    Come /openai/chat, ma invia la risposta come Server-Sent Events man mano che arriva
+
+    Se il modello scelto fallisce prima del primo evento si passa al candidato
+    successivo della rotta; gli errori a stream avviato arrivano come evento error.
+    """
+    messages = openai_messages(request)
+
+    def open_events(candidate: Candidate) -> AsyncIterator[Dict[str, Any]]:
+        return clients.openai.stream_events(
             messages=messages,
+            model=candidate.model,
             thinking_enabled=request.thinking,
-            temperature=request.temperature or 1.0,
-            max_tokens=request.max_tokens or 8192
+            temperature=request.temperature,
+            max_tokens=request.max_tokens
         )
 
-        # Estrai il testo dalla risposta
-        full_text = ""
-        thinking_text = ""
-        for block in response.content:
-            if block.type == "text":
-                full_text += block.text
-            elif block.type == "thinking":
-                thinking_text += block.thinking
-
-        # Se c'è thinking, includilo nella risposta
-        final_response = full_text
-        if thinking_text:
-            final_response = f"[RAGIONAMENTO]: {thinking_text}\n\n[RISPOSTA]: {full_text}"
-
-        return AIResponse(
-            response=final_response,
-            model="claude-sonnet-4-5-20250929",
-            thinking_used=request.thinking
+    try:
+        candidate, events = await clients.router.open_stream(
+            route_for("openai", request.thinking), open_events, provider="openai"
         )
-
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Claude Error: {str(e)}")
+        raise provider_error("OpenAI Error", e)
 
+    events = _record_stream_usage(events, usage, "openai", candidate.model)
+    return StreamingResponse(
+        _sse_stream(events, candidate.model), media_type="text/event-stream", headers=SSE_HEADERS
+    )
 
-@app.post("/compare", response_model=CompareResponse)
-async def compare_models(
-    request: CompareRequest,
-    authorized: bool = Header(None, include_in_schema=False)
+
+@app.post("/claude/chat/stream")
+async def claude_chat_stream(
+    request: AIRequest,
+    clients: ClientRegistry = Depends(get_clients),
+    usage: UsageRecorder = Depends(get_usage_recorder),
+    api_key: ApiKey = Depends(require_quota()),
+    admitted: None = Depends(admit("stream"))
 ):
     """
-    Confronta le risposte di OpenAI e Claude sullo stesso prompt
+    Come /claude/chat, ma invia ragionamento e risposta come Server-Sent Events
+    man mano che arrivano
+
+    Se il modello scelto fallisce prima del primo evento si passa al candidato
+    successivo della rotta; gli errori a stream avviato arrivano come evento error.
     """
+    messages = [{"role": "user", "content": request.prompt}]
+
+    def open_events(candidate: Candidate) -> AsyncIterator[Dict[str, Any]]:
+        return clients.claude.stream_events(
+            messages=messages,
+            model=candidate.model,
+            thinking_enabled=request.thinking,
+            temperature=1.0 if request.temperature is None else request.temperature,
+            max_tokens=request.max_tokens or 8192,
+            **claude_options(request)
+        )
+
     try:
-        # Chiama entrambi i modelli in parallelo
-        openai_client = OpenAIClient()
-        claude_client = ClaudeClient()
+        candidate, events = await clients.router.open_stream(
+            route_for("claude", request.thinking), open_events, provider="claude"
+        )
+    except Exception as e:
+        raise provider_error("Claude Error", e)
 
-        messages = [{"role": "user", "content": request.prompt}]
+    events = _record_stream_usage(_filter_thinking(events, request), usage, "claude", candidate.model)
+    return StreamingResponse(
+        _sse_stream(events, candidate.model), media_type="text/event-stream", headers=SSE_HEADERS
+    )
 
-        # OpenAI
-        openai_model = "o1" if request.thinking else "gpt-4o"
-        openai_response = openai_client.chat_completion(
-            messages=messages,
-            model=openai_model,
+
+@app.post("/compare/stream")
+async def compare_models_stream(
+    request: CompareRequest,
+    clients: ClientRegistry = Depends(get_clients),
+    usage: UsageRecorder = Depends(get_usage_recorder),
+    api_key: ApiKey = Depends(require_quota(calls=2)),
+    admitted: None = Depends(admit("compare"))
+):
+    """
+    Come /compare, ma multiplexa gli stream dei due provider in un unico flusso SSE
+
+    Ogni evento riporta il campo "provider" ("openai" o "claude"); ogni provider
+    chiude il proprio flusso con "done" o "error", e lo stream termina con
+    un evento "done" senza provider quando entrambi hanno finito. Per ogni
+    provider si passa al candidato successivo se il modello scelto fallisce
+    prima del primo evento.
+    """
+    messages = [{"role": "user", "content": request.prompt}]
+    timeout = request.timeout or COMPARE_PROVIDER_TIMEOUT
+
+    def open_openai(candidate: Candidate) -> AsyncIterator[Dict[str, Any]]:
+        return clients.openai.stream_events(
+            messages=openai_messages(request),
+            model=candidate.model,
             thinking_enabled=request.thinking
         )
 
-        # Claude
-        claude_response = claude_client.create_message(
+    def open_claude(candidate: Candidate) -> AsyncIterator[Dict[str, Any]]:
+        return clients.claude.stream_events(
             messages=messages,
+            model=candidate.model,
             thinking_enabled=request.thinking,
-            max_tokens=8192
+            max_tokens=8192,
+            **claude_options(request)
         )
 
-        # Estrai testo da Claude
-        claude_text = ""
-        for block in claude_response.content:
-            if block.type == "text":
-                claude_text += block.text
-
-        return CompareResponse(
-            openai_response=openai_response.choices[0].message.content,
-            claude_response=claude_text,
-            openai_model=openai_model,
-            claude_model="claude-sonnet-4-5-20250929"
+    async def open_stream(
+        provider: str, open_events: Callable[[Candidate], AsyncIterator[Dict[str, Any]]]
+    ) -> Tuple[str, AsyncIterator[Dict[str, Any]]]:
+        candidate, events = await clients.router.open_stream(
+            route_for(provider, request.thinking), open_events, provider=provider
         )
+        events = _record_stream_usage(_filter_thinking(events, request), usage, provider, candidate.model)
+        return candidate.model, events
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Comparison Error: {str(e)}")
+    # La finestra di contesto si verifica prima di avviare lo stream (400 invece di un evento
+    # error): stream_events controlla i parametri alla chiamata, senza contattare il provider
+    try:
+        for provider, open_events in (("openai", open_openai), ("claude", open_claude)):
+            open_events(clients.router.select(route_for(provider, request.thinking), provider=provider))
+    except ContextBudgetError as e:
+        raise provider_error("Comparison Error", e)
+
+    streams = {
+        "openai": functools.partial(open_stream, "openai", open_openai),
+        "claude": functools.partial(open_stream, "claude", open_claude),
+    }
+    return StreamingResponse(
+        _multiplex_streams(streams, timeout),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
+
+# Apre uno stream (con il fallback del router) e restituisce il modello scelto e gli eventi
+StreamOpener = Callable[[], Awaitable[Tuple[str, AsyncIterator[Dict[str, Any]]]]]
+
+
+async def _multiplex_streams(
+    streams: Dict[str, StreamOpener],
+    timeout: float
+) -> AsyncIterator[str]:
+    """Unisce più stream di eventi in un unico flusso SSE, nell'ordine di arrivo"""
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump(provider: str, open_stream: StreamOpener) -> str:
+        model, events = await open_stream()
+        async for event in events:
+            await queue.put(_sse(event["type"], {**event, "provider": provider}))
+        return model
+
+    async def run(provider: str, open_stream: StreamOpener) -> None:
+        try:
+            model = await asyncio.wait_for(pump(provider, open_stream), timeout=timeout)
+            final = _sse("done", {"type": "done", "provider": provider, "model": model})
+        except asyncio.TimeoutError:
+            final = _sse("error", {"type": "error", "provider": provider, "error": f"Timeout after {timeout:g}s"})
+        except Exception as e:
+            final = _sse("error", {"type": "error", "provider": provider, "error": str(e)})
+        await queue.put(final)
+        await queue.put(None)
+
+    tasks = [asyncio.create_task(run(provider, open_stream)) for provider, open_stream in streams.items()]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            item = await queue.get()
+            if item is None:
+                remaining -= 1
+            else:
+                yield item
+        yield _sse("done", {"type": "done"})
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 # Health check endpoint
@@ -216,6 +1469,113 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics(request: Request, clients: ClientRegistry = Depends(get_clients)):
+    """
+    Metriche in formato Prometheus
+
+    Include conteggi e latenze per rotta, latenze upstream e tempo al primo token
+    per provider e modello, richieste in corso, token consumati, errori,
+    richieste e chiamate annullate per disconnessione del client e i
+    contatori di cache, coalescenza, rate limiter, resilienza e ammissione
+    (richieste in coda e scartate per classe di rotta).
+    """
+    # Le statistiche di cache e rate limiter leggono lo stato condiviso: fuori dall'event loop
+    metrics.observe_stats(
+        cache_stats=await asyncio.to_thread(clients.cache.stats) if clients.cache is not None else None,
+        single_flight=clients.single_flight_stats(),
+        rate_limit_stats=(
+            await asyncio.to_thread(clients.rate_limiter.stats) if clients.rate_limiter is not None else None
+        ),
+        resilience_stats=clients.resilience.stats() if clients.resilience is not None else None,
+        admission_stats=request.app.state.admission.stats() if request.app.state.admission is not None else None
+    )
+    return PlainTextResponse(
+        metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/rate-limits")
+async def rate_limits(
+    clients: ClientRegistry = Depends(get_clients), api_key: ApiKey = Depends(authenticate)
+):
+    """Stato dei bucket del rate limiter (richieste e token al minuto per modello)"""
+    if clients.rate_limiter is None:
+        return {"enabled": False}
+    return {"enabled": True, **await asyncio.to_thread(clients.rate_limiter.stats)}
+
+
+@app.get("/resilience")
+async def resilience_stats(
+    clients: ClientRegistry = Depends(get_clients), api_key: ApiKey = Depends(authenticate)
+):
+    """Contatori di retry e hedging e stato dei circuit breaker per provider"""
+    if clients.resilience is None:
+        return {"enabled": False}
+    return {"enabled": True, **clients.resilience.stats()}
+
+
+@app.get("/routing")
+async def routing_stats(
+    clients: ClientRegistry = Depends(get_clients), api_key: ApiKey = Depends(authenticate)
+):
+    """Candidati di ogni rotta in ordine di preferenza, con latenza media e tasso di errore"""
+    return clients.router.stats()
+
+
+@app.get("/cache/stats")
+async def cache_stats(
+    clients: ClientRegistry = Depends(get_clients), api_key: ApiKey = Depends(authenticate)
+):
+    """
+    Contatori della cache delle risposte, della coalescenza delle richieste
+    identiche, della cache dei prompt dei provider e della cache dei conteggi
+    di token
+    """
+    stats = {"enabled": False}
+    if clients.cache is not None:
+        stats = {"enabled": True, **await asyncio.to_thread(clients.cache.stats)}
+
+    stats["single_flight"] = clients.single_flight_stats()
+    stats["prompt_cache"] = clients.prompt_cache_stats()
+    stats["token_counts"] = token_count_cache_stats()
+    return stats
+
+
+@app.get("/usage")
+async def usage_summary(request: Request, api_key: ApiKey = Depends(authenticate)):
+    """
+    Token consumati per API key e modello (per la pianificazione della capacità)
+
+    Le chiavi admin vedono i consumi di tutte le chiavi, le altre solo i propri.
+    """
+    return await asyncio.to_thread(
+        request.app.state.usage.summary, key_id=None if api_key.admin else api_key.id
+    )
+
+
+@app.get("/quotas")
+async def quota_stats(request: Request, api_key: ApiKey = Depends(authenticate)):
+    """
+    Richieste in corso e richieste rifiutate per quota, per API key
+
+    Le chiavi admin vedono tutte le chiavi e lo stato del file delle chiavi,
+    le altre solo le proprie quote.
+    """
+    if not api_key.admin:
+        return {"key": api_key.id, **request.app.state.quotas.stats(key_id=api_key.id)}
+    keys = request.app.state.keys
+    return {"keys": keys.stats() if keys is not None else None, **request.app.state.quotas.stats()}
+
+
+@app.get("/admission")
+async def admission_stats(request: Request, api_key: ApiKey = Depends(require_admin)):
+    """Slot occupati, richieste in coda, attese e richieste scartate per classe di rotta (solo admin)"""
+    if request.app.state.admission is None:
+        return {"enabled": False}
+    return {"enabled": True, **request.app.state.admission.stats()}
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
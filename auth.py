@@ -0,0 +1,401 @@
+"""
+Autenticazione con API key multiple e quote per chiave
+
+Le chiavi sono lette da un file JSON locale (AUTH_KEYS_PATH, default
+api_keys.json) che ne contiene solo l'hash SHA-256, mai la chiave in chiaro:
+
+    {
+      "keys": [
+        {"id": "custom-gpt", "hash": "sha256:9f86d0...", "max_concurrency": 4, "tokens_per_minute": 200000},
+        {"id": "batch-worker", "hash": "sha256:2c26b4...", "disabled": true},
+        {"id": "ops", "hash": "sha256:fcde2b...", "admin": true}
+      ]
+    }
+
+La tabella delle chiavi resta in memoria e viene ricaricata quando il file
+cambia. Ogni chiave può avere un limite di richieste contemporanee e di token
+al minuto (stimati prima della chiamata): le richieste oltre quota ricevono
+subito un 429, prima di qualsiasi chiamata ai provider. Le chiavi con
+"admin": true vedono consumi e quote di tutte le chiavi (/usage, /quotas) e
+lo stato del controllo di ammissione; le altre solo i propri.
+
+Se il file esiste ma non è leggibile, o se AUTH_KEYS_PATH è impostato e il
+file manca, il server rifiuta le richieste (503) invece di diventare
+pubblico: l'accesso anonimo è possibile solo con AUTH=off.
+
+Per aggiungere una chiave:
+
+    python auth.py add custom-gpt --tokens-per-minute 200000 --max-concurrency 4
+
+Senza file, l'unica chiave valida è CUSTOM_GPT_API_KEY (se impostata); senza
+alcuna chiave tutte le richieste ricevono 401.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from typing import Optional, Dict, Any, Callable, NamedTuple
+
+from shared_state import SharedState, InProcessState
+
+
+class ApiKey(NamedTuple):
+    """Una chiave autorizzata e le sue quote (0 = illimitato)"""
+    id: str
+    hash: str
+    max_concurrency: int = 0
+    tokens_per_minute: int = 0
+    disabled: bool = False
+    admin: bool = False
+
+
+# Chiamante usato con AUTH=off (senza autenticazione non c'è nulla da separare tra chiavi)
+ANONYMOUS = ApiKey(id="anonymous", hash="", admin=True)
+
+
+class QuotaExceeded(Exception):
+    """La richiesta supera una quota della chiave"""
+
+    def __init__(self, key_id: str, reason: str, retry_after: float):
+        super().__init__(f"Quota exceeded for key {key_id}: {reason}")
+        self.key_id = key_id
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def hash_key(key: str) -> str:
+    """Hash con cui una chiave viene salvata nel file ("sha256:<hex>")"""
+    return "sha256:" + hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def generate_key() -> str:
+    """Nuova chiave casuale (256 bit)"""
+    return "sk-" + secrets.token_urlsafe(32)
+
+
+# Nessun caricamento fallito (diverso da None, che indica un file inesistente)
+_NEVER = object()
+
+
+class KeyStore:
+    """
+    Tabella in memoria delle chiavi autorizzate, ricaricata quando il file cambia
+
+    Args:
+        path: File JSON delle chiavi (None o inesistente = solo legacy_key)
+        legacy_key: Chiave singola in chiaro accettata in aggiunta (CUSTOM_GPT_API_KEY)
+        reload_interval: Secondi minimi tra due controlli di modifica del file
+        required: Se True il file deve esistere (AUTH_KEYS_PATH impostato esplicitamente)
+    """
+
+    def __init__(
+        self,
+        path: Optional[str],
+        legacy_key: Optional[str] = None,
+        reload_interval: float = 1.0,
+        required: bool = False
+    ):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.required = required
+        self.reloads = 0
+        # Ultimo errore di caricamento del file (None se l'ultimo caricamento è riuscito)
+        self.error: Optional[str] = None
+        self._loaded = False
+        self._legacy: Dict[str, ApiKey] = {}
+        if legacy_key:
+            digest = hash_key(legacy_key)
+            # Stesso identificativo usato in passato per la contabilità dei consumi
+            key_id = hashlib.sha256(legacy_key.encode("utf-8")).hexdigest()[:12]
+            self._legacy[digest] = ApiKey(id=key_id, hash=digest)
+        self._keys: Dict[str, ApiKey] = dict(self._legacy)
+        self._signature: Optional[tuple] = None
+        # Versione del file che non è stato possibile caricare (non si riprova finché non cambia)
+        self._failed_signature: Any = _NEVER
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._maybe_reload(force=True)
+
+    @property
+    def available(self) -> bool:
+        """False se il file delle chiavi non è mai stato caricato correttamente (si rifiuta tutto)"""
+        self._maybe_reload()
+        return self._loaded
+
+    def _file_signature(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.path)
+        except (OSError, TypeError):
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _maybe_reload(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.reload_interval:
+            return
+        with self._lock:
+            self._checked_at = now
+            signature = self._file_signature()
+            if (self._loaded and signature == self._signature) or signature == self._failed_signature:
+                return
+            keys = dict(self._legacy)
+            try:
+                if signature is not None:
+                    keys.update(self._read_file())
+                elif self.required:
+                    raise FileNotFoundError("file non trovato")
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                # File mancante, in scrittura o non valido: si tiene la tabella attuale (se
+                # mai caricata, altrimenti si rifiuta tutto) e si riprova quando il file cambia
+                self.error = str(e)
+                self._failed_signature = signature
+                print(f"Errore nel file delle chiavi {self.path}: {e}", file=sys.stderr)
+                return
+            # Sostituzione atomica: le richieste in corso vedono la tabella vecchia o la nuova
+            self._keys = keys
+            self._signature = signature
+            self._loaded = True
+            self._failed_signature = _NEVER
+            self.error = None
+            self.reloads += 1
+
+    def _read_file(self) -> Dict[str, ApiKey]:
+        with open(self.path, encoding="utf-8") as f:
+            config = json.load(f)
+        keys = {}
+        for entry in config.get("keys", []):
+            key = ApiKey(
+                id=entry["id"],
+                hash=entry["hash"],
+                max_concurrency=int(entry.get("max_concurrency", 0)),
+                tokens_per_minute=int(entry.get("tokens_per_minute", 0)),
+                disabled=bool(entry.get("disabled", False)),
+                admin=bool(entry.get("admin", False)),
+            )
+            keys[key.hash] = key
+        return keys
+
+    def lookup(self, key: str) -> Optional[ApiKey]:
+        """La chiave corrispondente, None se sconosciuta o disabilitata"""
+        self._maybe_reload()
+        digest = hash_key(key)
+        entry = self._keys.get(digest)
+        # Confronto a tempo costante anche dopo la ricerca per hash
+        if entry is None or not hmac.compare_digest(entry.hash, digest) or entry.disabled:
+            return None
+        return entry
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "available": self._loaded,
+            "error": self.error,
+            "path": self.path,
+            "keys": len(self._keys),
+            "reloads": self.reloads,
+        }
+
+
+class QuotaManager:
+    """
+    Quote per chiave: richieste contemporanee (per worker) e token al minuto
+
+    I token al minuto sono un token bucket nello stato condiviso, quindi valgono
+    per tutto il deployment se lo stato è condiviso tra i worker.
+    """
+
+    def __init__(self, state: Optional[SharedState] = None):
+        self.state = state if state is not None else InProcessState()
+        self._active: Dict[str, int] = {}
+        self.rejections: Dict[str, int] = {}
+
+    async def acquire(self, key: ApiKey, estimated_tokens: int) -> Callable[[], None]:
+        """
+        Riserva uno slot di concorrenza e i token stimati della richiesta
+
+        Returns:
+            Funzione da chiamare a fine richiesta per liberare lo slot
+
+        Raises:
+            QuotaExceeded: se la chiave è al limite di concorrenza o di token al minuto
+        """
+        active = self._active.get(key.id, 0)
+        if key.max_concurrency and active >= key.max_concurrency:
+            self._reject(key)
+            raise QuotaExceeded(key.id, f"{key.max_concurrency} concurrent requests", 1.0)
+
+        # Lo slot è occupato prima di attendere lo stato condiviso, così le richieste
+        # concorrenti della stessa chiave lo vedono già
+        self._active[key.id] = active + 1
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if not released:
+                released = True
+                self._active[key.id] -= 1
+
+        if key.tokens_per_minute and estimated_tokens:
+            try:
+                wait = await self.state.run(
+                    self.state.take_tokens,
+                    [(self._bucket_key(key), key.tokens_per_minute, estimated_tokens)]
+                )
+            except BaseException:
+                release()
+                raise
+            if wait > 0:
+                release()
+                self._reject(key)
+                raise QuotaExceeded(key.id, f"{key.tokens_per_minute} tokens per minute", wait)
+
+        return release
+
+    async def refund(self, key: ApiKey, tokens: int) -> None:
+        """Restituisce alla quota token riservati ma non consumati (es. risposte dalla cache)"""
+        if key.tokens_per_minute and tokens > 0:
+            # Un prelievo negativo riaccredita i token; la ricarica successiva li limita alla capacità
+            await self.state.run(self.state.take_tokens, [(self._bucket_key(key), key.tokens_per_minute, -tokens)])
+
+    @staticmethod
+    def _bucket_key(key: ApiKey) -> str:
+        # Il limite fa parte della chiave del bucket: se cambia nel file si riparte da un bucket nuovo
+        return f"quota:{key.id}:{key.tokens_per_minute}"
+
+    def _reject(self, key: ApiKey) -> None:
+        self.rejections[key.id] = self.rejections.get(key.id, 0) + 1
+
+    def stats(self, key_id: Optional[str] = None) -> Dict[str, Any]:
+        """Richieste in corso e rifiutate per chiave (solo per key_id, se indicata)"""
+        active = {key: count for key, count in self._active.items() if count}
+        rejections = dict(self.rejections)
+        if key_id is not None:
+            active = {key: count for key, count in active.items() if key == key_id}
+            rejections = {key: count for key, count in rejections.items() if key == key_id}
+        return {"active": active, "rejections": rejections}
+
+
+def estimate_request_tokens(body: Any, default_output: int = 1024) -> int:
+    """
+    Stima dei token di una richiesta dal corpo JSON (circa 4 caratteri per token)
+
+    Conta prompt e system prompt più i token di output richiesti (max_tokens);
+    per /batch somma gli elementi.
+    """
+    if not isinstance(body, dict):
+        return 0
+    if isinstance(body.get("items"), list):
+        return sum(estimate_request_tokens(item, default_output) for item in body["items"])
+    chars = len(body.get("prompt") or "") + len(body.get("system") or "")
+    return chars // 4 + (body.get("max_tokens") or default_output)
+
+
+class QuotaReleaseMiddleware:
+    """
+    Middleware ASGI che libera gli slot di concorrenza a risposta conclusa
+
+    Le dipendenze FastAPI terminano prima che una StreamingResponse abbia
+    finito di inviare il corpo: lo slot viene quindi registrato nello stato
+    della richiesta (request.state.quota_release) e liberato qui. Lo stesso
+    vale per gli slot del controllo di ammissione (vedi admission.py).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        state = scope.setdefault("state", {})
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            for release in state.pop("quota_release", []):
+                release()
+
+
+def create_key_store_from_env() -> Optional[KeyStore]:
+    """
+    Crea la tabella delle chiavi configurata con le variabili d'ambiente
+
+        AUTH: on (default) oppure off (accesso anonimo, senza chiavi né quote)
+        AUTH_KEYS_PATH: file JSON delle chiavi (default api_keys.json; se impostato deve esistere)
+        CUSTOM_GPT_API_KEY: chiave singola accettata in aggiunta a quelle del file
+        AUTH_RELOAD_INTERVAL: secondi tra due controlli di modifica del file (default 1)
+
+    Returns:
+        La tabella delle chiavi, oppure None se AUTH=off
+    """
+    if os.getenv("AUTH", "on").lower() == "off":
+        print("ATTENZIONE: AUTH=off, le API sono accessibili senza chiave", file=sys.stderr)
+        return None
+    path = os.getenv("AUTH_KEYS_PATH")
+    store = KeyStore(
+        path=(path if path is not None else "api_keys.json") or None,
+        legacy_key=os.getenv("CUSTOM_GPT_API_KEY") or None,
+        reload_interval=float(os.getenv("AUTH_RELOAD_INTERVAL", "1")),
+        required=bool(path),
+    )
+    if store.available and not store.stats()["keys"]:
+        print(
+            "ATTENZIONE: nessuna API key configurata, tutte le richieste riceveranno 401 "
+            "(usa python auth.py add <id> oppure AUTH=off)",
+            file=sys.stderr
+        )
+    return store
+
+
+def _add_key(args: argparse.Namespace) -> None:
+    config = {"keys": []}
+    if os.path.exists(args.path):
+        with open(args.path, encoding="utf-8") as f:
+            config = json.load(f)
+    if any(entry["id"] == args.id for entry in config["keys"]):
+        sys.exit(f"La chiave {args.id!r} esiste già in {args.path}")
+
+    key = generate_key()
+    entry = {"id": args.id, "hash": hash_key(key)}
+    if args.max_concurrency:
+        entry["max_concurrency"] = args.max_concurrency
+    if args.tokens_per_minute:
+        entry["tokens_per_minute"] = args.tokens_per_minute
+    if args.admin:
+        entry["admin"] = True
+    config["keys"].append(entry)
+
+    tmp_path = f"{args.path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+    os.replace(tmp_path, args.path)
+    print(f"Chiave {args.id!r} aggiunta a {args.path}. Salvala ora, non verrà più mostrata:\n{key}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Gestione delle API key del server")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="Genera una nuova chiave e ne salva l'hash")
+    add.add_argument("id", help="Identificativo della chiave (compare in /usage)")
+    add.add_argument("--path", default=os.getenv("AUTH_KEYS_PATH", "api_keys.json"))
+    add.add_argument("--max-concurrency", type=int, default=0)
+    add.add_argument("--tokens-per-minute", type=int, default=0)
+    add.add_argument("--admin", action="store_true", help="Accesso a consumi e quote di tutte le chiavi")
+
+    hash_command = commands.add_parser("hash", help="Stampa l'hash di una chiave esistente")
+    hash_command.add_argument("key")
+
+    args = parser.parse_args()
+    if args.command == "add":
+        _add_key(args)
+    else:
+        print(hash_key(args.key))
+
+
+if __name__ == "__main__":
+    main()
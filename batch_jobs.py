@@ -0,0 +1,308 @@
+"""
+Job di elaborazione offline tramite le Batch API dei provider
+
+Per carichi non interattivi (es. valutazioni notturne su centinaia di prompt)
+OpenAI e Anthropic offrono API batch asincrone più economiche e con limiti di
+throughput più alti delle chiamate sincrone. Questo modulo traduce un file
+JSONL di prompt in un batch del provider, ne tiene traccia e ne scarica i
+risultati a conclusione.
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from typing import Optional, Dict, Any, AsyncIterator, Literal
+
+from pydantic import BaseModel, Field, ValidationError
+
+from model_router import ModelRouter, route_for
+from usage_tracker import UsageTracker
+
+
+JobStatus = Literal["in_progress", "completed", "failed", "cancelling", "cancelled", "expired"]
+
+# Stati dei provider -> stato normalizzato del job
+_OPENAI_STATUS = {
+    "validating": "in_progress",
+    "in_progress": "in_progress",
+    "finalizing": "in_progress",
+    "completed": "completed",
+    "failed": "failed",
+    "expired": "expired",
+    "cancelling": "cancelling",
+    "cancelled": "cancelled",
+}
+_CLAUDE_STATUS = {
+    "in_progress": "in_progress",
+    "canceling": "cancelling",
+    "ended": "completed",
+}
+
+# Stati per cui non serve più interrogare il provider
+FINAL_STATUSES = {"completed", "failed", "cancelled", "expired"}
+
+
+class JobItem(BaseModel):
+    """Una riga del file JSONL inviato a /jobs"""
+    custom_id: Optional[str] = Field(default=None, description="Identificativo della riga (default: item-<n>)")
+    prompt: str = Field(..., description="Il prompt da inviare all'AI")
+    thinking: bool = Field(default=False, description="Abilita il ragionamento esteso")
+    max_tokens: Optional[int] = Field(default=None, description="Limite di token nella risposta")
+    temperature: Optional[float] = Field(default=1.0, description="Temperatura (0.0-2.0)")
+
+
+class BatchJob(BaseModel):
+    """Stato di un job batch"""
+    id: str
+    # API key che ha creato il job (None per i job salvati prima che i job avessero un proprietario)
+    key_id: Optional[str] = None
+    provider: Literal["openai", "claude"]
+    provider_batch_id: str
+    status: JobStatus
+    provider_status: str
+    total: int
+    succeeded: int = 0
+    failed: int = 0
+    created_at: float
+    updated_at: float
+    # True quando i token dei risultati sono stati registrati nei consumi (una sola volta)
+    usage_recorded: bool = False
+
+
+def parse_jsonl(text: str) -> list[JobItem]:
+    """
+    Legge un file JSONL di richieste (una JobItem per riga, righe vuote ignorate)
+
+    Raises:
+        ValueError: se una riga non è JSON valido o non rispetta lo schema
+    """
+    items = []
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            # Parsing e validazione in un solo passaggio (pydantic-core)
+            item = JobItem.model_validate_json(line)
+        except ValidationError as e:
+            raise ValueError(f"Riga {line_number} non valida: {e}") from e
+        if item.custom_id is None:
+            item.custom_id = f"item-{len(items)}"
+        items.append(item)
+
+    if not items:
+        raise ValueError("Il file JSONL non contiene richieste")
+    custom_ids = [item.custom_id for item in items]
+    if len(set(custom_ids)) != len(custom_ids):
+        raise ValueError("I custom_id devono essere univoci")
+    return items
+
+
+class BatchJobManager:
+    """
+    Registro dei job batch, persistito su file JSON
+
+    Args:
+        clients: Client asincroni per provider, es. {"openai": AsyncOpenAIClient, "claude": AsyncClaudeClient}
+        router: Router dei modelli: ogni richiesta usa il candidato preferito della rotta
+            del provider (es. "claude-thinking"), come le chiamate sincrone
+        path: File JSON in cui salvare lo stato dei job (None = solo in memoria)
+        usage: Aggregatore dei consumi in cui registrare i token dei risultati
+    """
+
+    def __init__(
+        self,
+        clients: Dict[str, Any],
+        router: ModelRouter,
+        path: Optional[str] = None,
+        usage: Optional[UsageTracker] = None
+    ):
+        self.clients = clients
+        self.router = router
+        self.usage = usage
+        self.path = path
+        self.jobs: Dict[str, BatchJob] = {}
+        # Serializza le scritture del file: ognuna salva lo stato più recente
+        self._save_lock = asyncio.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        # Lettura sincrona una sola volta, all'avvio del server, prima di servire richieste
+        if self.path and os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for data in json.load(f):
+                    job = BatchJob.model_validate(data)
+                    self.jobs[job.id] = job
+
+    async def _save(self) -> None:
+        """Salva lo stato dei job; la scrittura del file avviene fuori dall'event loop"""
+        if not self.path:
+            return
+        async with self._save_lock:
+            # Istantanea presa nell'event loop, così i job non cambiano durante la scrittura
+            data = [job.model_dump(mode="json") for job in self.jobs.values()]
+            await asyncio.to_thread(self._write, data)
+
+    def _write(self, data: list[Dict[str, Any]]) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def _build_request(self, provider: str, item: JobItem) -> Dict[str, Any]:
+        """Converte una JobItem nei parametri di submit_batch del client"""
+        request = {
+            "custom_id": item.custom_id,
+            "messages": [{"role": "user", "content": item.prompt}],
+            "model": self.router.select(route_for(provider, item.thinking), provider).model,
+            "thinking_enabled": item.thinking,
+            "temperature": 1.0 if item.temperature is None else item.temperature,
+        }
+        if provider == "openai":
+            request["max_tokens"] = item.max_tokens
+        else:
+            request["max_tokens"] = item.max_tokens or 8192
+        return request
+
+    async def submit(self, provider: str, items: list[JobItem], key_id: Optional[str] = None) -> BatchJob:
+        """Invia le richieste al provider come un unico batch e registra il job di key_id"""
+        client = self.clients[provider]
+        batch = await client.submit_batch([self._build_request(provider, item) for item in items])
+
+        now = time.time()
+        job = BatchJob(
+            id=f"job_{uuid.uuid4().hex}",
+            key_id=key_id,
+            provider=provider,
+            provider_batch_id=batch.id,
+            status="in_progress",
+            provider_status="",
+            total=len(items),
+            created_at=now,
+            updated_at=now,
+        )
+        self._apply(job, batch)
+        self.jobs[job.id] = job
+        await self._save()
+        return job
+
+    def get(self, job_id: str, key_id: Optional[str] = None) -> BatchJob:
+        """
+        Restituisce un job
+
+        Args:
+            key_id: Se indicata, solo un job creato da questa API key
+
+        Raises:
+            KeyError: se il job non esiste o appartiene a un'altra API key
+        """
+        job = self.jobs[job_id]
+        if key_id is not None and job.key_id != key_id:
+            raise KeyError(job_id)
+        return job
+
+    def list(self, key_id: Optional[str] = None) -> list[BatchJob]:
+        """I job (solo quelli di key_id, se indicata), dal più recente"""
+        jobs = [job for job in self.jobs.values() if key_id is None or job.key_id == key_id]
+        return sorted(jobs, key=lambda job: job.created_at, reverse=True)
+
+    async def refresh(self, job_id: str, key_id: Optional[str] = None) -> BatchJob:
+        """Aggiorna lo stato di un job interrogando il provider"""
+        job = self.get(job_id, key_id)
+        if job.status in FINAL_STATUSES:
+            return job
+        batch = await self.clients[job.provider].get_batch(job.provider_batch_id)
+        self._apply(job, batch)
+        await self._save()
+        return job
+
+    async def cancel(self, job_id: str, key_id: Optional[str] = None) -> BatchJob:
+        """Chiede al provider di annullare il batch"""
+        job = self.get(job_id, key_id)
+        if job.status not in FINAL_STATUSES:
+            batch = await self.clients[job.provider].cancel_batch(job.provider_batch_id)
+            self._apply(job, batch)
+            await self._save()
+        return job
+
+    async def results(self, job_id: str, key_id: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Scarica i risultati di un job concluso
+
+        Raises:
+            KeyError: se il job non esiste o appartiene a un'altra API key
+
+        Al primo download completo i token dei risultati vengono registrati nei
+        consumi dell'API key che ha creato il job.
+
+        Yields:
+            {"custom_id": ..., "response": str | None, "model": str | None,
+             "usage": dict | None, "error": str | None}
+        """
+        job = self.get(job_id, key_id)
+        client = self.clients[job.provider]
+        batch = await client.get_batch(job.provider_batch_id)
+        consumed: list[tuple[str, Dict[str, int]]] = []
+        async for entry in client.get_batch_results(batch):
+            body = entry["response"]
+            model = None if body is None else body.get("model")
+            if entry["usage"]:
+                consumed.append((model or "unknown", entry["usage"]))
+            yield {
+                "custom_id": entry["custom_id"],
+                "response": None if body is None else _extract_text(job.provider, body),
+                "model": model,
+                "usage": entry["usage"] or None,
+                "error": entry["error"],
+            }
+        await self._record_usage(job, consumed)
+
+    async def _record_usage(self, job: BatchJob, consumed: list[tuple[str, Dict[str, int]]]) -> None:
+        """Registra i token dei risultati di un job concluso, una sola volta per job"""
+        if self.usage is None or job.usage_recorded or job.status not in FINAL_STATUSES:
+            return
+        job.usage_recorded = True
+        for model, usage in consumed:
+            self.usage.record(job.key_id or "unknown", job.provider, model, usage)
+        await self._save()
+
+    async def poll_forever(self, interval: float) -> None:
+        """Aggiorna periodicamente i job ancora in corso (da eseguire come task di background)"""
+        while True:
+            await asyncio.sleep(interval)
+            for job in list(self.jobs.values()):
+                if job.status in FINAL_STATUSES:
+                    continue
+                try:
+                    await self.refresh(job.id)
+                except Exception as e:
+                    # Il provider potrebbe essere momentaneamente irraggiungibile: riprova al giro successivo
+                    print(f"Errore aggiornando il job {job.id}: {e}", file=sys.stderr)
+
+    def _apply(self, job: BatchJob, batch: Any) -> None:
+        """Copia nel job lo stato e i contatori del batch del provider"""
+        if job.provider == "openai":
+            job.provider_status = batch.status
+            job.status = _OPENAI_STATUS.get(batch.status, "in_progress")
+            if batch.request_counts is not None:
+                job.succeeded = batch.request_counts.completed
+                job.failed = batch.request_counts.failed
+        else:
+            job.provider_status = batch.processing_status
+            job.status = _CLAUDE_STATUS.get(batch.processing_status, "in_progress")
+            if job.status == "completed" and batch.cancel_initiated_at is not None:
+                # Un batch annullato termina comunque come "ended": come per OpenAI risulta "cancelled"
+                job.status = "cancelled"
+            counts = batch.request_counts
+            job.succeeded = counts.succeeded
+            job.failed = counts.errored + counts.canceled + counts.expired
+        job.updated_at = time.time()
+
+
+def _extract_text(provider: str, body: Dict[str, Any]) -> str:
+    """Estrae il testo della risposta dal corpo JSON restituito dal provider"""
+    if provider == "openai":
+        return body["choices"][0]["message"]["content"] or ""
+    return "".join(block["text"] for block in body.get("content", []) if block.get("type") == "text")
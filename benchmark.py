@@ -0,0 +1,355 @@
+"""
+Benchmark di carico dell'API server contro un provider simulato
+
+Avvia mock_provider.py e l'API server (tramite serve.py) su porte locali,
+invia le richieste con la concorrenza indicata e riporta per ogni endpoint
+richieste al secondo, latenza p50/p95/p99, tempo al primo token (endpoint in
+streaming) e CPU consumata dai worker. I risultati possono essere salvati
+come baseline e confrontati con le esecuzioni successive: un peggioramento
+oltre la tolleranza fa terminare lo script con codice 1.
+
+Uso:
+    python benchmark.py --concurrency 32 --requests 500 --save-baseline benchmark_baseline.json
+    python benchmark.py --concurrency 32 --requests 500 --baseline benchmark_baseline.json
+
+Con --server-url il benchmark usa un server già avviato (la CPU non viene misurata).
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+from typing import Optional, Dict, Any
+
+import httpx
+
+
+DEFAULT_ENDPOINTS = "openai/chat,claude/chat,openai/chat/stream,claude/chat/stream"
+
+# Metriche confrontate con la baseline: (nome, True se più alto è meglio)
+COMPARED_METRICS = (
+    ("rps", True),
+    ("latency_p50", False),
+    ("latency_p95", False),
+    ("latency_p99", False),
+    ("ttft_p95", False),
+    ("cpu_ms_per_request", False),
+)
+
+
+def percentile(values: list[float], q: float) -> Optional[float]:
+    """Percentile q (0-1) con il metodo nearest-rank, None se non ci sono valori"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def process_tree_cpu(pid: int) -> Optional[float]:
+    """
+    Secondi di CPU (utente + sistema) del processo e dei suoi discendenti
+
+    Legge /proc, quindi funziona solo su Linux; altrove restituisce None.
+    """
+    if not os.path.isdir("/proc"):
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    stats: Dict[int, tuple[int, float]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # Il nome del processo (tra parentesi) può contenere spazi
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        ppid, utime, stime = int(fields[1]), int(fields[11]), int(fields[12])
+        stats[int(entry)] = (ppid, (utime + stime) / ticks)
+
+    tree = {pid}
+    changed = True
+    while changed:
+        children = {child for child, (ppid, _) in stats.items() if ppid in tree} - tree
+        tree |= children
+        changed = bool(children)
+    return sum(stats[p][1] for p in tree if p in stats)
+
+
+async def wait_ready(url: str, timeout: float = 30.0) -> None:
+    """Attende che GET url risponda 200"""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} non risponde dopo {timeout:.0f}s")
+
+
+async def one_request(
+    client: httpx.AsyncClient, endpoint: str, payload: Dict[str, Any]
+) -> tuple[bool, float, Optional[float]]:
+    """
+    Esegue una richiesta e ne misura la durata
+
+    Returns:
+        (successo, latenza totale, tempo al primo token o None se non in streaming)
+    """
+    started = time.perf_counter()
+    if not endpoint.endswith("/stream"):
+        response = await client.post(f"/{endpoint}", json=payload)
+        return response.status_code == 200, time.perf_counter() - started, None
+
+    ttft = None
+    ok = False
+    async with client.stream("POST", f"/{endpoint}", json=payload) as response:
+        if response.status_code != 200:
+            await response.aread()
+            return False, time.perf_counter() - started, None
+        async for line in response.aiter_lines():
+            if ttft is None and line in ("event: text", "event: thinking"):
+                ttft = time.perf_counter() - started
+            elif line == "event: done":
+                ok = True
+    return ok, time.perf_counter() - started, ttft
+
+
+async def run_endpoint(
+    client: httpx.AsyncClient,
+    endpoint: str,
+    requests: int,
+    concurrency: int,
+    warmup: int,
+    thinking: bool,
+    server_pid: Optional[int]
+) -> Dict[str, Any]:
+    """Esegue requests richieste su un endpoint con concorrenza fissa e ne riassume i tempi"""
+    latencies: list[float] = []
+    ttfts: list[float] = []
+    errors = 0
+
+    async def worker(indices, measure: bool) -> None:
+        nonlocal errors
+        for index in indices:
+            # Prompt diversi per non misurare cache o coalescenza delle richieste
+            payload = {"prompt": f"Benchmark request {index}", "thinking": thinking}
+            try:
+                ok, latency, ttft = await one_request(client, endpoint, payload)
+            except httpx.HTTPError:
+                ok, latency, ttft = False, 0.0, None
+            if not measure:
+                continue
+            if not ok:
+                errors += 1
+                continue
+            latencies.append(latency)
+            if ttft is not None:
+                ttfts.append(ttft)
+
+    if warmup:
+        indices = iter(range(warmup))
+        await asyncio.gather(*(worker(indices, False) for _ in range(min(concurrency, warmup))))
+
+    cpu_before = process_tree_cpu(server_pid) if server_pid else None
+    started = time.perf_counter()
+    indices = iter(range(warmup, warmup + requests))
+    await asyncio.gather(*(worker(indices, True) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    cpu_after = process_tree_cpu(server_pid) if server_pid else None
+
+    cpu = None if cpu_before is None or cpu_after is None else cpu_after - cpu_before
+
+    def ms(value: Optional[float]) -> Optional[float]:
+        return None if value is None else round(value * 1000, 2)
+
+    return {
+        "requests": requests,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_p50": ms(percentile(latencies, 0.50)),
+        "latency_p95": ms(percentile(latencies, 0.95)),
+        "latency_p99": ms(percentile(latencies, 0.99)),
+        "ttft_p50": ms(percentile(ttfts, 0.50)),
+        "ttft_p95": ms(percentile(ttfts, 0.95)),
+        "ttft_p99": ms(percentile(ttfts, 0.99)),
+        "cpu_seconds": None if cpu is None else round(cpu, 3),
+        "cpu_percent": None if cpu is None else round(100 * cpu / elapsed, 1),
+        "cpu_ms_per_request": None if cpu is None else round(1000 * cpu / requests, 3),
+    }
+
+
+def compare_with_baseline(
+    results: Dict[str, Dict[str, Any]], baseline: Dict[str, Any], tolerance: float
+) -> list[str]:
+    """Peggioramenti rispetto alla baseline oltre la tolleranza (frazione, es. 0.15)"""
+    regressions = []
+    for endpoint, current in results.items():
+        previous = baseline.get("results", {}).get(endpoint)
+        if previous is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS:
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(f"{endpoint} {metric}: {old} -> {new} ({change:+.0%})")
+        if current["errors"] > previous.get("errors", 0):
+            regressions.append(f"{endpoint} errors: {previous.get('errors', 0)} -> {current['errors']}")
+    return regressions
+
+
+def print_report(results: Dict[str, Dict[str, Any]]) -> None:
+    columns = ("rps", "latency_p50", "latency_p95", "latency_p99", "ttft_p95", "cpu_percent", "errors")
+    print(f"\n{'endpoint':<22}" + "".join(f"{column:>14}" for column in columns))
+    for endpoint, result in results.items():
+        cells = ("-" if result[column] is None else str(result[column]) for column in columns)
+        print(f"{endpoint:<22}" + "".join(f"{cell:>14}" for cell in cells))
+    print("(latenze in ms, cpu_percent = CPU dei worker, 100 = un core)")
+
+
+def start_servers(args: argparse.Namespace) -> tuple[list[subprocess.Popen], str]:
+    """Avvia provider simulato e API server; restituisce i processi e l'URL del server"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    mock = subprocess.Popen([
+        sys.executable, os.path.join(here, "mock_provider.py"),
+        "--port", str(args.mock_port),
+        "--latency", str(args.latency),
+        "--jitter", str(args.jitter),
+        "--token-interval", str(args.token_interval),
+        "--output-tokens", str(args.output_tokens),
+        "--error-rate", str(args.error_rate),
+        "--error-status", str(args.error_status),
+    ])
+
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    env = {
+        # Stato pulito per ogni esecuzione: niente consumi, job o cache salvati su disco
+        "USAGE_DB_PATH": "",
+        "BATCH_JOBS_PATH": "",
+        "BATCH_POLL_INTERVAL": "0",
+        "RESPONSE_CACHE": "off",
+        "AUTH_KEYS_PATH": "",
+        "CUSTOM_GPT_API_KEY": "benchmark",
+        **os.environ,
+        "OPENAI_BASE_URL": f"{mock_url}/v1",
+        "ANTHROPIC_BASE_URL": mock_url,
+        "OPENAI_API_KEY": "mock",
+        "ANTHROPIC_API_KEY": "mock",
+    }
+    server = subprocess.Popen(
+        [
+            sys.executable, os.path.join(here, "serve.py"),
+            "--host", "127.0.0.1",
+            "--port", str(args.port),
+            "--workers", str(args.workers),
+            "--log-level", "warning",
+        ],
+        cwd=here,
+        env=env,
+    )
+    return [mock, server], f"http://127.0.0.1:{args.port}"
+
+
+async def run(args: argparse.Namespace) -> int:
+    processes: list[subprocess.Popen] = []
+    server_url = args.server_url
+    server_pid = None
+    try:
+        if server_url is None:
+            processes, server_url = start_servers(args)
+            server_pid = processes[1].pid
+            await wait_ready(f"http://127.0.0.1:{args.mock_port}/health")
+        await wait_ready(f"{server_url}/health")
+
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        headers = {"Authorization": f"Bearer {os.getenv('CUSTOM_GPT_API_KEY', 'benchmark')}"}
+        results = {}
+        async with httpx.AsyncClient(
+            base_url=server_url, limits=limits, headers=headers, timeout=args.timeout
+        ) as client:
+            for endpoint in args.endpoints.split(","):
+                endpoint = endpoint.strip().strip("/")
+                print(f"→ {endpoint}: {args.requests} richieste, concorrenza {args.concurrency}")
+                results[endpoint] = await run_endpoint(
+                    client, endpoint, args.requests, args.concurrency, args.warmup,
+                    args.thinking, server_pid
+                )
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    print_report(results)
+
+    config = {
+        key: getattr(args, key)
+        for key in ("endpoints", "concurrency", "requests", "workers", "latency", "jitter",
+                    "token_interval", "output_tokens", "error_rate", "thinking")
+    }
+    report = {"config": config, "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline salvata in {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print("\n⚠️  La baseline è stata registrata con parametri diversi: il confronto è indicativo")
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n❌ Peggioramenti oltre il {args.tolerance:.0%} rispetto a {args.baseline}:")
+            for regression in regressions:
+                print(f"  - {regression}")
+            return 1
+        print(f"\n✅ Nessun peggioramento oltre il {args.tolerance:.0%} rispetto a {args.baseline}")
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark di carico dell'API server")
+    parser.add_argument("--endpoints", default=DEFAULT_ENDPOINTS,
+                        help=f"Endpoint da misurare, separati da virgole (default {DEFAULT_ENDPOINTS})")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=500, help="Richieste misurate per endpoint")
+    parser.add_argument("--warmup", type=int, default=20, help="Richieste iniziali non misurate")
+    parser.add_argument("--thinking", action="store_true", help="Richieste con ragionamento esteso")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--workers", type=int, default=1, help="Worker dell'API server")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--server-url", help="Usa un server già avviato invece di avviarne uno")
+    parser.add_argument("--mock-port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=0.2, help="Latenza del provider simulato (s)")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--token-interval", type=float, default=0.01, help="Secondi tra i token in streaming")
+    parser.add_argument("--output-tokens", type=int, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--output", help="File JSON in cui salvare i risultati")
+    parser.add_argument("--save-baseline", help="Salva i risultati come baseline in questo file")
+    parser.add_argument("--baseline", help="Confronta i risultati con questa baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="Peggioramento tollerato rispetto alla baseline (default 0.15 = 15%%)")
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
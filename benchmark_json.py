@@ -0,0 +1,108 @@
+"""
+Micro-benchmark della serializzazione JSON delle risposte
+
+Confronta, sui documenti di json-examples/ e su una risposta sintetica con un
+ragionamento lungo (come quelle di /claude/chat con thinking), il percorso di
+default di Starlette (json.dumps + encode) con fast_json (orjson se
+installato). Misura anche il parsing dei corpi delle richieste.
+
+Uso:
+    python benchmark_json.py
+    python benchmark_json.py json-examples/04-casi-reali/05-openapi-swagger.json --number 2000
+"""
+
+import argparse
+import glob
+import json
+import os
+import timeit
+from typing import Any, Callable, Dict
+
+import fast_json
+
+
+def starlette_dumps(value: Any) -> bytes:
+    """Stesse impostazioni di JSONResponse.render di Starlette"""
+    return json.dumps(
+        value, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def thinking_response(chars: int = 200_000) -> Dict[str, Any]:
+    """Risposta di /claude/chat con un ragionamento esteso di circa chars caratteri"""
+    paragraph = (
+        "Analizzo la richiesta: l'utente vuole sapere perché la città è più calda "
+        "del previsto. Considero l'effetto isola di calore, l'umidità e il vento. "
+    )
+    thinking = paragraph * (chars // len(paragraph))
+    return {
+        "response": "La risposta è: dipende dall'umidità.",
+        "model": "claude-sonnet-4-5-20250929",
+        "provider": "claude",
+        "thinking_used": True,
+        "thinking": thinking,
+        "usage": {
+            "input_tokens": 1200,
+            "output_tokens": 52000,
+            "cached_input_tokens": 0,
+            "cache_creation_input_tokens": 0,
+            "reasoning_tokens": 0,
+        },
+    }
+
+
+def best_time(function: Callable[[], Any], number: int, repeat: int) -> float:
+    """Tempo medio di una chiamata (secondi), migliore tra repeat serie"""
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def main() -> None:
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Micro-benchmark della serializzazione JSON")
+    parser.add_argument("files", nargs="*", help="Documenti JSON da usare (default: json-examples/**/*.json)")
+    parser.add_argument("--number", type=int, default=500, help="Chiamate per serie")
+    parser.add_argument("--repeat", type=int, default=5, help="Serie per misura (vince la migliore)")
+    args = parser.parse_args()
+
+    files = args.files or sorted(glob.glob(os.path.join(here, "json-examples", "**", "*.json"), recursive=True))
+    fixtures: Dict[str, Any] = {}
+    for path in files:
+        with open(path, encoding="utf-8") as f:
+            fixtures[os.path.relpath(path, os.path.join(here, "json-examples"))] = json.load(f)
+    fixtures["(sintetico) risposta con thinking da 200 KB"] = thinking_response()
+
+    print(f"fast_json usa: {fast_json.BACKEND}\n")
+    print(f"{'documento':<48}{'KB':>8}{'dumps json':>12}{'fast':>10}{'x':>7}{'loads json':>12}{'fast':>10}{'x':>7}")
+    totals = {"dumps": [0.0, 0.0], "loads": [0.0, 0.0]}
+    for name, value in fixtures.items():
+        encoded = starlette_dumps(value)
+        assert fast_json.loads(fast_json.dumps(value)) == value
+        # I documenti grandi richiedono meno ripetizioni per una misura stabile
+        number = max(1, args.number * 10_000 // max(len(encoded), 10_000))
+
+        dumps = (
+            best_time(lambda: starlette_dumps(value), number, args.repeat),
+            best_time(lambda: fast_json.dumps(value), number, args.repeat),
+        )
+        loads = (
+            best_time(lambda: json.loads(encoded), number, args.repeat),
+            best_time(lambda: fast_json.loads(encoded), number, args.repeat),
+        )
+        for kind, (baseline, fast) in (("dumps", dumps), ("loads", loads)):
+            totals[kind][0] += baseline
+            totals[kind][1] += fast
+
+        print(
+            f"{name[:47]:<48}{len(encoded) / 1024:>8.1f}"
+            f"{dumps[0] * 1e6:>10.1f}µs{dumps[1] * 1e6:>8.1f}µs{dumps[0] / dumps[1]:>6.1f}x"
+            f"{loads[0] * 1e6:>10.1f}µs{loads[1] * 1e6:>8.1f}µs{loads[0] / loads[1]:>6.1f}x"
+        )
+
+    print(
+        f"\nTotale: dumps {totals['dumps'][0] / totals['dumps'][1]:.1f}x,"
+        f" loads {totals['loads'][0] / totals['loads'][1]:.1f}x più veloce"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Compressione gzip/brotli delle risposte HTTP
+
+Il middleware sceglie la codifica in base all'header Accept-Encoding del
+client (brotli se il pacchetto opzionale brotli è installato, altrimenti
+gzip) e comprime solo i tipi testuali (JSON, testo, SSE, NDJSON).
+
+- Risposte normali: compresse solo se superano minimum_size byte, così le
+  risposte piccole non pagano l'overhead della compressione.
+- Stream (text/event-stream, application/x-ndjson): sempre compressi, con un
+  flush del compressore dopo ogni messaggio, così ogni evento arriva subito
+  al client invece di restare nel buffer del compressore.
+"""
+
+import zlib
+from typing import Optional, Dict
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+STREAMING_TYPES = ("text/event-stream", "application/x-ndjson")
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "application/xml",
+)
+
+
+def available_encodings() -> tuple[str, ...]:
+    """Codifiche supportate, in ordine di preferenza a parità di qualità"""
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate_encoding(accept_encoding: str, supported: tuple[str, ...]) -> Optional[str]:
+    """
+    Sceglie la codifica da usare in base all'header Accept-Encoding
+
+    Vince la codifica supportata con il valore q più alto; a parità di q
+    l'ordine di supported. q=0 esclude la codifica, "*" vale per le altre.
+
+    Returns:
+        La codifica scelta, oppure None se nessuna è accettata
+    """
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[name] = q
+
+    best, best_q = None, 0.0
+    for encoding in supported:
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class _Compressor:
+    """Compressore incrementale con la stessa interfaccia per gzip e brotli"""
+
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=brotli_quality)
+        else:
+            self._zlib = zlib.compressobj(gzip_level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._brotli.process(data)
+        return self._zlib.compress(data)
+
+    def flush(self) -> bytes:
+        """Svuota il buffer interno (il client può decodificare tutto quanto ricevuto)"""
+        if self.encoding == "br":
+            return self._brotli.flush()
+        return self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._brotli.finish()
+        return self._zlib.flush(zlib.Z_FINISH)
+
+
+class CompressionMiddleware:
+    """
+    Middleware ASGI che comprime le risposte con gzip o brotli
+
+    Args:
+        app: Applicazione ASGI successiva
+        minimum_size: Byte minimi perché una risposta non in streaming venga compressa
+        gzip_level: Livello di compressione gzip (1-9)
+        brotli_quality: Qualità di compressione brotli (0-11; valori bassi sono più veloci)
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.supported = available_encodings()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""), self.supported)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        responder = _CompressionResponder(self, encoding, send)
+        await self.app(scope, receive, responder.send)
+
+
+class _CompressionResponder:
+    """Stato della compressione di una singola risposta"""
+
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self._send = send
+        self.start: Optional[dict] = None
+        # None finché non si sa se comprimere; poi "identity", "buffered" o "stream"
+        self.mode: Optional[str] = None
+        self.buffer = bytearray()
+        self.compressor: Optional[_Compressor] = None
+
+    def _new_compressor(self) -> _Compressor:
+        return _Compressor(self.encoding, self.middleware.gzip_level, self.middleware.brotli_quality)
+
+    async def _send_start(self, compressed: bool, content_length: Optional[int] = None) -> None:
+        headers = MutableHeaders(raw=list(self.start["headers"]))
+        headers.add_vary_header("Accept-Encoding")
+        if compressed:
+            headers["Content-Encoding"] = self.encoding
+            if content_length is None:
+                del headers["Content-Length"]
+            else:
+                headers["Content-Length"] = str(content_length)
+        await self._send({**self.start, "headers": headers.raw})
+
+    async def send(self, message) -> None:
+        if message["type"] == "http.response.start":
+            self.start = message
+            headers = Headers(raw=message["headers"])
+            content_type = headers.get("content-type", "").lower()
+            if "content-encoding" in headers or not content_type.startswith(COMPRESSIBLE_TYPES):
+                self.mode = "identity"
+                await self._send(message)
+            elif content_type.startswith(STREAMING_TYPES):
+                self.mode = "stream"
+                self.compressor = self._new_compressor()
+                await self._send_start(compressed=True)
+            return
+
+        if message["type"] != "http.response.body" or self.mode == "identity":
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.mode == "stream":
+            data = self.compressor.compress(body)
+            data += self.compressor.flush() if more_body else self.compressor.finish()
+            await self._send({"type": "http.response.body", "body": data, "more_body": more_body})
+            return
+
+        if self.mode is None:
+            # Risposta normale: si accumula finché non si supera la soglia o finisce
+            self.buffer += body
+            if len(self.buffer) < self.middleware.minimum_size:
+                if not more_body:
+                    await self._send_start(compressed=False)
+                    await self._send({"type": "http.response.body", "body": bytes(self.buffer)})
+                return
+            self.mode = "buffered"
+            self.compressor = self._new_compressor()
+            body, self.buffer = bytes(self.buffer), bytearray()
+            if not more_body:
+                data = self.compressor.compress(body) + self.compressor.finish()
+                await self._send_start(compressed=True, content_length=len(data))
+                await self._send({"type": "http.response.body", "body": data})
+                return
+            await self._send_start(compressed=True)
+
+        data = self.compressor.compress(body)
+        if not more_body:
+            data += self.compressor.finish()
+        await self._send({"type": "http.response.body", "body": data, "more_body": more_body})
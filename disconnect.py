@@ -0,0 +1,72 @@
+"""
+Annullamento delle richieste quando il client si disconnette
+
+Se il client (es. ChatGPT che abbandona un'azione) chiude la connessione
+prima della fine della risposta, continuare a generarla è solo uno spreco: la
+chiamata al provider (magari migliaia di token di ragionamento) occupa uno
+slot di concorrenza, una connessione verso il provider e token che nessuno
+leggerà. Il middleware si accorge della disconnessione e annulla l'esecuzione
+dell'endpoint: l'annullamento arriva fino alla chiamata dell'SDK o allo
+stream in corso, che chiudono la connessione upstream.
+"""
+
+import asyncio
+
+
+class CancelOnDisconnectMiddleware:
+    """
+    Middleware ASGI che annulla l'endpoint quando il client si disconnette
+
+    I messaggi del client vengono letti da un task dedicato e passati
+    all'applicazione tramite una coda; alla ricezione di http.disconnect prima
+    della fine della risposta l'endpoint viene annullato e la richiesta è
+    marcata con scope["state"]["client_disconnected"] (usato dalle metriche).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        state = scope.setdefault("state", {})
+        messages: asyncio.Queue = asyncio.Queue()
+        response_complete = False
+
+        async def send_wrapper(message):
+            nonlocal response_complete
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_complete = True
+            await send(message)
+
+        app_task = asyncio.ensure_future(self.app(scope, messages.get, send_wrapper))
+
+        async def read_client() -> None:
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    if not response_complete and not app_task.done():
+                        state["client_disconnected"] = True
+                        app_task.cancel()
+                    return
+
+        reader = asyncio.ensure_future(read_client())
+        try:
+            await asyncio.wait({app_task})
+        except asyncio.CancelledError:
+            # Annullamento dall'esterno (es. shutdown del server): si propaga all'endpoint
+            app_task.cancel()
+            raise
+        finally:
+            reader.cancel()
+
+        if state.get("client_disconnected"):
+            # La risposta non ha più destinatario: eventuali errori sollevati
+            # durante l'annullamento vengono letti e scartati
+            if not app_task.cancelled():
+                app_task.exception()
+            return
+        app_task.result()
@@ -153,10 +153,14 @@ def esempio_system_prompt():
             {"role": "user", "content": "Spiegami cosa sono i database"}
         ],
         system="Sei un professore universitario che spiega concetti complessi in modo semplice usando analogie con la cucina.",
+        # Il system prompt è uguale a ogni chiamata: Claude può rileggerlo dalla cache
+        # (efficace solo oltre i 1024 token, come i system prompt lunghi dei Custom GPT)
+        cache_prompt=True,
         max_tokens=2048
     )
 
     print(response.content[0].text + "\n")
+    print(f"Token letti dalla cache: {response.usage.cache_read_input_tokens or 0}\n")
 
 
 def esempio_max_tokens():
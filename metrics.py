@@ -0,0 +1,335 @@
+"""
+Metriche in formato Prometheus (text exposition format 0.0.4)
+
+Implementazione minimale di Counter, Gauge e Histogram con etichette, senza
+dipendenze esterne. Le metriche sono registrate nel registro globale REGISTRY
+ed esposte dall'endpoint /metrics del server.
+"""
+
+import math
+import threading
+import time
+from typing import Optional, Dict, Any, Iterable
+
+from starlette.routing import Match
+
+
+# Bucket (secondi) adatti a latenze che vanno da pochi ms a diversi minuti (thinking)
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    """Base comune: nome, descrizione, etichette e valori per combinazione di etichette"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: etichette attese {self.labelnames}, ricevute {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> Iterable[str]:
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Contatore monotono"""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels) -> None:
+        """Imposta il totale di un contatore mantenuto altrove (letto al momento dello scrape)"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Gauge(_Metric):
+    """Valore che può salire e scendere"""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Istogramma cumulativo con bucket fissi"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def _samples(self) -> Iterable[str]:
+        for key, state in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, state["counts"]):
+                labels = _format_labels(self.labelnames + ("le",), key + (_format_value(bound),))
+                yield f"{self.name}_bucket{labels} {count}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(state['sum'])}"
+            yield f"{self.name}_count{labels} {state['count']}"
+
+
+class MetricsRegistry:
+    """Insieme delle metriche esposte da /metrics"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> Any:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metrica già registrata: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Tutte le metriche nel formato testuale di Prometheus"""
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# Richieste HTTP ricevute dal server
+HTTP_REQUESTS = REGISTRY.counter(
+    "aiapi_http_requests_total", "Richieste HTTP gestite", ["route", "method", "status"]
+)
+HTTP_LATENCY = REGISTRY.histogram(
+    "aiapi_http_request_duration_seconds",
+    "Durata totale delle richieste HTTP (fino all'ultimo byte, anche in streaming)",
+    ["route", "method"]
+)
+HTTP_IN_FLIGHT = REGISTRY.gauge(
+    "aiapi_http_requests_in_flight", "Richieste HTTP in corso", ["route"]
+)
+CLIENT_DISCONNECTS = REGISTRY.counter(
+    "aiapi_client_disconnects_total",
+    "Richieste annullate perché il client si è disconnesso (phase: prima della risposta o durante lo stream)",
+    ["route", "phase"]
+)
+
+# Chiamate ai provider
+UPSTREAM_LATENCY = REGISTRY.histogram(
+    "aiapi_upstream_request_duration_seconds",
+    "Durata delle chiamate ai provider (per tentativo; per gli stream fino all'ultimo evento)",
+    ["provider", "model", "stream"]
+)
+UPSTREAM_TTFT = REGISTRY.histogram(
+    "aiapi_upstream_time_to_first_token_seconds",
+    "Tempo fino al primo token (testo o ragionamento) nelle chiamate in streaming",
+    ["provider", "model"]
+)
+UPSTREAM_IN_FLIGHT = REGISTRY.gauge(
+    "aiapi_upstream_requests_in_flight", "Chiamate ai provider in corso", ["provider"]
+)
+UPSTREAM_CANCELLED = REGISTRY.counter(
+    "aiapi_upstream_cancelled_total",
+    "Chiamate ai provider annullate prima della fine (client disconnesso o richiesta di riserva superata)",
+    ["provider", "model", "stream"]
+)
+UPSTREAM_ERRORS = REGISTRY.counter(
+    "aiapi_upstream_errors_total", "Chiamate ai provider fallite", ["provider", "model", "error"]
+)
+TOKENS = REGISTRY.counter(
+    "aiapi_tokens_total", "Token consumati", ["provider", "model", "kind"]
+)
+
+# Cache, coalescenza, rate limiter e resilienza (aggiornati al momento dello scrape)
+CACHE_LOOKUPS = REGISTRY.counter(
+    "aiapi_response_cache_lookups_total", "Ricerche nella cache delle risposte", ["result"]
+)
+CACHE_SIZE = REGISTRY.gauge("aiapi_response_cache_entries", "Risposte in cache")
+COALESCED = REGISTRY.counter(
+    "aiapi_coalesced_requests_total", "Richieste servite da una chiamata identica già in corso", ["provider"]
+)
+RATE_LIMIT_EVENTS = REGISTRY.counter(
+    "aiapi_rate_limit_events_total", "Attese e rifiuti del rate limiter lato client", ["event"]
+)
+RESILIENCE_EVENTS = REGISTRY.counter(
+    "aiapi_resilience_events_total", "Eventi di retry, hedging e circuit breaker", ["event"]
+)
+ROUTE_FALLBACKS = REGISTRY.counter(
+    "aiapi_route_fallbacks_total",
+    "Chiamate fallite su un modello e passate al candidato successivo della rotta",
+    ["route", "provider", "model"]
+)
+CIRCUIT_OPEN = REGISTRY.gauge(
+    "aiapi_circuit_open", "1 se il circuit breaker del provider è aperto o in prova", ["provider"]
+)
+
+# Controllo di ammissione (per classe di rotta: chat, stream, compare, batch)
+ADMISSION_ACTIVE = REGISTRY.gauge(
+    "aiapi_admission_active", "Richieste ammesse in esecuzione", ["route"]
+)
+ADMISSION_QUEUE_DEPTH = REGISTRY.gauge(
+    "aiapi_admission_queue_depth", "Richieste in coda in attesa di uno slot", ["route"]
+)
+ADMISSION_SHED = REGISTRY.counter(
+    "aiapi_admission_shed_total", "Richieste scartate con 503 per sovraccarico", ["route", "reason"]
+)
+ADMISSION_WAIT = REGISTRY.counter(
+    "aiapi_admission_wait_seconds_total", "Secondi complessivi di attesa in coda", ["route"]
+)
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI che misura durata, esito e concorrenza delle richieste HTTP
+
+    L'etichetta route è il percorso della rotta FastAPI (es. /jobs/{job_id}),
+    così le metriche non esplodono con un'etichetta per ogni URL.
+
+    Args:
+        app: Applicazione ASGI successiva
+        router: Router dell'applicazione, usato per risolvere la rotta
+    """
+
+    def __init__(self, app, router):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = self._route_template(scope)
+        method = scope["method"]
+        started = time.perf_counter()
+        status = {"code": 500, "started": False}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                status["started"] = True
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(route=route)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec(route=route)
+            if scope.get("state", {}).get("client_disconnected"):
+                # 499 come nei log di nginx: il client ha chiuso la connessione prima della fine
+                status["code"] = 499
+                CLIENT_DISCONNECTS.inc(route=route, phase="streaming" if status["started"] else "waiting")
+            HTTP_REQUESTS.inc(route=route, method=method, status=status["code"])
+            HTTP_LATENCY.observe(time.perf_counter() - started, route=route, method=method)
+
+    def _route_template(self, scope) -> str:
+        for route in self.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", "unmatched")
+        return "unmatched"
+
+
+def observe_stats(
+    cache_stats: Optional[Dict[str, Any]] = None,
+    single_flight: Optional[Dict[str, Dict[str, int]]] = None,
+    rate_limit_stats: Optional[Dict[str, Any]] = None,
+    resilience_stats: Optional[Dict[str, Any]] = None,
+    admission_stats: Optional[Dict[str, Any]] = None
+) -> None:
+    """Copia nelle metriche i contatori mantenuti da cache, rate limiter, resilienza e ammissione"""
+    if cache_stats is not None:
+        CACHE_LOOKUPS.set(cache_stats["hits"], result="hit")
+        CACHE_LOOKUPS.set(cache_stats["misses"], result="miss")
+        CACHE_SIZE.set(cache_stats["size"])
+    for provider, stats in (single_flight or {}).items():
+        COALESCED.set(stats["coalesced"], provider=provider)
+    if rate_limit_stats is not None:
+        RATE_LIMIT_EVENTS.set(rate_limit_stats["waits"], event="wait")
+        RATE_LIMIT_EVENTS.set(rate_limit_stats["rejections"], event="rejection")
+    if resilience_stats is not None:
+        for event in ("retries", "failures", "hedges_started", "hedges_won", "circuit_rejections"):
+            RESILIENCE_EVENTS.set(resilience_stats[event], event=event)
+        for provider, circuit in resilience_stats["circuits"].items():
+            CIRCUIT_OPEN.set(0 if circuit["state"] == "closed" else 1, provider=provider)
+    if admission_stats is not None:
+        for route, stats in admission_stats["routes"].items():
+            ADMISSION_ACTIVE.set(stats["active"], route=route)
+            ADMISSION_QUEUE_DEPTH.set(stats["queue_depth"], route=route)
+            ADMISSION_WAIT.set(stats["wait_seconds"], route=route)
+            for reason in ("queue_full", "timeout"):
+                ADMISSION_SHED.set(stats["shed"].get(reason, 0), route=route, reason=reason)
@@ -0,0 +1,596 @@
+"""
+Server locale che simula le API di OpenAI e Anthropic
+
+Risponde a /v1/chat/completions (formato OpenAI) e /v1/messages (formato
+Anthropic), anche in streaming, con latenza, cadenza dei token ed errori
+configurabili. Simula anche le Batch API dei due provider (/v1/files e
+/v1/batches di OpenAI, /v1/messages/batches di Anthropic): un batch si
+conclude batch_duration secondi dopo la creazione. Serve a provare e misurare
+l'API server senza chiamare i provider reali: basta puntare OPENAI_BASE_URL e
+ANTHROPIC_BASE_URL qui.
+
+Uso:
+    python mock_provider.py --port 9100 --latency 0.2 --token-interval 0.02
+
+    OPENAI_BASE_URL=http://localhost:9100/v1 ANTHROPIC_BASE_URL=http://localhost:9100 python api_server.py
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from email.parser import BytesParser
+from email.policy import default as email_policy
+from typing import Optional, Dict, Any, AsyncIterator
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+
+class MockSettings:
+    """
+    Comportamento del server simulato
+
+    Args:
+        latency: Secondi prima della risposta (o del primo token in streaming)
+        jitter: Variazione casuale massima (in secondi) della latenza
+        token_interval: Secondi tra un token e il successivo in streaming
+        output_tokens: Token (parole) di ogni risposta
+        error_rate: Frazione delle richieste che falliscono (0-1)
+        error_status: Codice HTTP degli errori simulati (es. 500, 429, 529)
+        rpm / tpm: Limiti riportati negli header di rate limit
+        error_models: Modelli per cui le richieste falliscono sempre (per provare il fallback)
+        batch_duration: Secondi dopo i quali un batch risulta concluso
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.2,
+        jitter: float = 0.05,
+        token_interval: float = 0.02,
+        output_tokens: int = 50,
+        error_rate: float = 0.0,
+        error_status: int = 500,
+        rpm: int = 100000,
+        tpm: int = 100000000,
+        error_models: frozenset[str] = frozenset(),
+        batch_duration: float = 2.0
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.token_interval = token_interval
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rpm = rpm
+        self.tpm = tpm
+        self.error_models = error_models
+        self.batch_duration = batch_duration
+
+    def delay(self) -> float:
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def should_fail(self, model: Optional[str] = None) -> bool:
+        if model in self.error_models:
+            return True
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+def create_mock_settings_from_env() -> MockSettings:
+    """
+    Legge le impostazioni dalle variabili d'ambiente
+
+        MOCK_LATENCY, MOCK_JITTER, MOCK_TOKEN_INTERVAL, MOCK_OUTPUT_TOKENS,
+        MOCK_ERROR_RATE, MOCK_ERROR_STATUS, MOCK_RPM, MOCK_TPM,
+        MOCK_ERROR_MODELS (modelli separati da virgola che falliscono sempre),
+        MOCK_BATCH_DURATION
+    """
+    return MockSettings(
+        latency=float(os.getenv("MOCK_LATENCY", "0.2")),
+        jitter=float(os.getenv("MOCK_JITTER", "0.05")),
+        token_interval=float(os.getenv("MOCK_TOKEN_INTERVAL", "0.02")),
+        output_tokens=int(os.getenv("MOCK_OUTPUT_TOKENS", "50")),
+        error_rate=float(os.getenv("MOCK_ERROR_RATE", "0")),
+        error_status=int(os.getenv("MOCK_ERROR_STATUS", "500")),
+        rpm=int(os.getenv("MOCK_RPM", "100000")),
+        tpm=int(os.getenv("MOCK_TPM", "100000000")),
+        error_models=frozenset(m.strip() for m in os.getenv("MOCK_ERROR_MODELS", "").split(",") if m.strip()),
+        batch_duration=float(os.getenv("MOCK_BATCH_DURATION", "2")),
+    )
+
+
+def _words(count: int) -> list[str]:
+    return [f"token{i} " for i in range(count)]
+
+
+def _input_tokens(body: Dict[str, Any]) -> int:
+    """Stima grossolana dei token di input (circa 4 caratteri per token)"""
+    return len(json.dumps(body.get("messages", []))) // 4 + len(json.dumps(body.get("system", ""))) // 4
+
+
+def _openai_headers(settings: MockSettings) -> Dict[str, str]:
+    return {
+        "x-ratelimit-limit-requests": str(settings.rpm),
+        "x-ratelimit-remaining-requests": str(settings.rpm - 1),
+        "x-ratelimit-reset-requests": "1s",
+        "x-ratelimit-limit-tokens": str(settings.tpm),
+        "x-ratelimit-remaining-tokens": str(settings.tpm - 1000),
+        "x-ratelimit-reset-tokens": "1s",
+    }
+
+
+def _anthropic_headers(settings: MockSettings) -> Dict[str, str]:
+    reset = (datetime.now(timezone.utc) + timedelta(seconds=1)).isoformat().replace("+00:00", "Z")
+    return {
+        "anthropic-ratelimit-requests-limit": str(settings.rpm),
+        "anthropic-ratelimit-requests-remaining": str(settings.rpm - 1),
+        "anthropic-ratelimit-requests-reset": reset,
+        "anthropic-ratelimit-tokens-limit": str(settings.tpm),
+        "anthropic-ratelimit-tokens-remaining": str(settings.tpm - 1000),
+        "anthropic-ratelimit-tokens-reset": reset,
+    }
+
+
+def _error(settings: MockSettings, provider: str) -> JSONResponse:
+    message = f"Simulated error {settings.error_status}"
+    if provider == "openai":
+        body = {"error": {"message": message, "type": "server_error", "code": None}}
+        headers = _openai_headers(settings)
+    else:
+        body = {"type": "error", "error": {"type": "api_error", "message": message}}
+        headers = _anthropic_headers(settings)
+    if settings.error_status == 429:
+        headers["retry-after"] = "1"
+    return JSONResponse(body, status_code=settings.error_status, headers=headers)
+
+
+def _sse(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+def _openai_completion(settings: MockSettings, body: Dict[str, Any]) -> Dict[str, Any]:
+    """Corpo di una chat completion OpenAI (non in streaming)"""
+    words = _words(settings.output_tokens)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": "".join(words)},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": _input_tokens(body),
+            "completion_tokens": len(words),
+            "total_tokens": _input_tokens(body) + len(words),
+        },
+    }
+
+
+def _claude_message(settings: MockSettings, body: Dict[str, Any]) -> Dict[str, Any]:
+    """Corpo di un messaggio Anthropic (non in streaming), con ragionamento se richiesto"""
+    words = _words(settings.output_tokens)
+    thinking = _words(settings.output_tokens // 2) if body.get("thinking") else []
+    content = []
+    if thinking:
+        content.append({"type": "thinking", "thinking": "".join(thinking), "signature": "mock"})
+    content.append({"type": "text", "text": "".join(words)})
+    return {
+        "id": f"msg_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": body.get("model", "claude-sonnet-4-5-20250929"),
+        "content": content,
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": _input_tokens(body), "output_tokens": len(words) + len(thinking)},
+    }
+
+
+def _iso(timestamp: Optional[float]) -> Optional[str]:
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def _multipart_fields(content_type: str, body: bytes) -> Dict[str, tuple[Optional[str], bytes]]:
+    """Campi di un corpo multipart/form-data: nome -> (nome del file, contenuto)"""
+    message = BytesParser(policy=email_policy).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+    )
+    return {
+        part.get_param("name", header="content-disposition"): (part.get_filename(), part.get_payload(decode=True))
+        for part in message.iter_parts()
+    }
+
+
+class MockBatch:
+    """
+    Batch simulato: i risultati sono calcolati alla creazione e diventano
+    visibili quando il batch si conclude (o viene annullato)
+    """
+
+    def __init__(
+        self,
+        batch_id: str,
+        provider: str,
+        results: list[tuple[str, Optional[Dict[str, Any]]]],
+        duration: float
+    ):
+        self.id = batch_id
+        self.provider = provider
+        # (custom_id, corpo della risposta oppure None se la richiesta è fallita)
+        self.results = results
+        self.created_at = time.time()
+        self.ends_at = self.created_at + duration
+        self.cancelled_at: Optional[float] = None
+        # File di input e dei risultati, questi ultimi creati alla conclusione (solo OpenAI)
+        self.input_file_id: Optional[str] = None
+        self.output_file_id: Optional[str] = None
+        self.error_file_id: Optional[str] = None
+
+    @property
+    def ended(self) -> bool:
+        return self.cancelled_at is not None or time.time() >= self.ends_at
+
+    @property
+    def ended_at(self) -> Optional[float]:
+        if not self.ended:
+            return None
+        return self.cancelled_at if self.cancelled_at is not None else self.ends_at
+
+    def counts(self) -> tuple[int, int]:
+        """(riuscite, fallite); le richieste di un batch annullato non sono né l'una né l'altra"""
+        if not self.ended or self.cancelled_at is not None:
+            return 0, 0
+        succeeded = sum(1 for _, response in self.results if response is not None)
+        return succeeded, len(self.results) - succeeded
+
+
+def create_mock_app(settings: Optional[MockSettings] = None) -> FastAPI:
+    """Crea l'app FastAPI del server simulato"""
+    settings = settings or create_mock_settings_from_env()
+    app = FastAPI(title="Mock AI Provider")
+    app.state.settings = settings
+
+    @app.get("/health")
+    async def health():
+        return {"status": "healthy"}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        if settings.should_fail(body.get("model")):
+            await asyncio.sleep(settings.delay())
+            return _error(settings, "openai")
+
+        if not body.get("stream"):
+            await asyncio.sleep(settings.delay() + settings.token_interval * settings.output_tokens)
+            return JSONResponse(_openai_completion(settings, body), headers=_openai_headers(settings))
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        model = body.get("model", "gpt-4o")
+        words = _words(settings.output_tokens)
+        usage = {
+            "prompt_tokens": _input_tokens(body),
+            "completion_tokens": len(words),
+            "total_tokens": _input_tokens(body) + len(words),
+        }
+
+        async def events() -> AsyncIterator[str]:
+            def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+                return {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                }
+
+            await asyncio.sleep(settings.delay())
+            yield _sse(chunk({"role": "assistant", "content": ""}))
+            for word in words:
+                yield _sse(chunk({"content": word}))
+                await asyncio.sleep(settings.token_interval)
+            yield _sse(chunk({}, "stop"))
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield _sse({**chunk({}), "choices": [], "usage": usage})
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(
+            events(), media_type="text/event-stream", headers=_openai_headers(settings)
+        )
+
+    @app.post("/v1/messages")
+    async def messages(request: Request):
+        body = await request.json()
+        if settings.should_fail(body.get("model")):
+            await asyncio.sleep(settings.delay())
+            return _error(settings, "claude")
+
+        if not body.get("stream"):
+            message = _claude_message(settings, body)
+            await asyncio.sleep(settings.delay() + settings.token_interval * message["usage"]["output_tokens"])
+            return JSONResponse(message, headers=_anthropic_headers(settings))
+
+        message_id = f"msg_{uuid.uuid4().hex[:24]}"
+        model = body.get("model", "claude-sonnet-4-5-20250929")
+        words = _words(settings.output_tokens)
+        thinking = _words(settings.output_tokens // 2) if body.get("thinking") else []
+        input_tokens = _input_tokens(body)
+        output_tokens = len(words) + len(thinking)
+
+        async def events() -> AsyncIterator[str]:
+            await asyncio.sleep(settings.delay())
+            yield _sse({
+                "type": "message_start",
+                "message": {
+                    "id": message_id,
+                    "type": "message",
+                    "role": "assistant",
+                    "model": model,
+                    "content": [],
+                    "stop_reason": None,
+                    "stop_sequence": None,
+                    "usage": {"input_tokens": input_tokens, "output_tokens": 1},
+                },
+            }, "message_start")
+
+            blocks = []
+            if thinking:
+                blocks.append(("thinking", thinking))
+            blocks.append(("text", words))
+            for index, (kind, tokens) in enumerate(blocks):
+                start = {"type": "thinking", "thinking": "", "signature": ""} if kind == "thinking" \
+                    else {"type": "text", "text": ""}
+                yield _sse({"type": "content_block_start", "index": index, "content_block": start},
+                           "content_block_start")
+                for token in tokens:
+                    delta = {"type": "thinking_delta", "thinking": token} if kind == "thinking" \
+                        else {"type": "text_delta", "text": token}
+                    yield _sse({"type": "content_block_delta", "index": index, "delta": delta},
+                               "content_block_delta")
+                    await asyncio.sleep(settings.token_interval)
+                if kind == "thinking":
+                    yield _sse({"type": "content_block_delta", "index": index,
+                                "delta": {"type": "signature_delta", "signature": "mock"}},
+                               "content_block_delta")
+                yield _sse({"type": "content_block_stop", "index": index}, "content_block_stop")
+
+            yield _sse({
+                "type": "message_delta",
+                "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                "usage": {"output_tokens": output_tokens},
+            }, "message_delta")
+            yield _sse({"type": "message_stop"}, "message_stop")
+
+        return StreamingResponse(
+            events(), media_type="text/event-stream", headers=_anthropic_headers(settings)
+        )
+
+    # Batch API: file e batch restano in memoria per tutta la vita del processo
+    files: Dict[str, tuple[Dict[str, Any], bytes]] = {}
+    batches: Dict[str, MockBatch] = {}
+
+    def store_file(filename: str, purpose: str, content: bytes) -> Dict[str, Any]:
+        file = {
+            "id": f"file-{uuid.uuid4().hex[:24]}",
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        files[file["id"]] = (file, content)
+        return file
+
+    def openai_batch(batch: MockBatch, status: Optional[str] = None) -> Dict[str, Any]:
+        if batch.ended and batch.cancelled_at is None and batch.output_file_id is None:
+            output, errors = [], []
+            for custom_id, response in batch.results:
+                line = {"id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": custom_id, "error": None}
+                if response is None:
+                    message = f"Simulated error {settings.error_status}"
+                    line["response"] = {"status_code": settings.error_status, "request_id": uuid.uuid4().hex,
+                                        "body": {"error": {"message": message, "type": "server_error"}}}
+                    errors.append(json.dumps(line))
+                else:
+                    line["response"] = {"status_code": 200, "request_id": uuid.uuid4().hex, "body": response}
+                    output.append(json.dumps(line))
+            if output:
+                batch.output_file_id = store_file("batch_output.jsonl", "batch_output",
+                                                  ("\n".join(output) + "\n").encode())["id"]
+            if errors:
+                batch.error_file_id = store_file("batch_errors.jsonl", "batch_output",
+                                                 ("\n".join(errors) + "\n").encode())["id"]
+
+        if status is None:
+            if not batch.ended:
+                status = "in_progress"
+            else:
+                status = "cancelled" if batch.cancelled_at is not None else "completed"
+        succeeded, failed = batch.counts()
+        return {
+            "id": batch.id,
+            "object": "batch",
+            "endpoint": "/v1/chat/completions",
+            "input_file_id": batch.input_file_id,
+            "completion_window": "24h",
+            "status": status,
+            "created_at": int(batch.created_at),
+            "output_file_id": batch.output_file_id,
+            "error_file_id": batch.error_file_id,
+            "request_counts": {"total": len(batch.results), "completed": succeeded, "failed": failed},
+        }
+
+    def claude_batch(request: Request, batch: MockBatch, canceling: bool = False) -> Dict[str, Any]:
+        ended = batch.ended and not canceling
+        succeeded, errored = batch.counts()
+        return {
+            "id": batch.id,
+            "type": "message_batch",
+            "processing_status": "canceling" if canceling else ("ended" if ended else "in_progress"),
+            "request_counts": {
+                "processing": 0 if ended else len(batch.results),
+                "succeeded": succeeded,
+                "errored": errored,
+                "canceled": len(batch.results) if ended and batch.cancelled_at is not None else 0,
+                "expired": 0,
+            },
+            "created_at": _iso(batch.created_at),
+            "expires_at": _iso(batch.created_at + 86400),
+            "ended_at": _iso(batch.ended_at) if ended else None,
+            "archived_at": None,
+            "cancel_initiated_at": _iso(batch.cancelled_at),
+            "results_url": f"{request.base_url}v1/messages/batches/{batch.id}/results" if ended else None,
+        }
+
+    def find_batch(batch_id: str, provider: str) -> Optional[MockBatch]:
+        batch = batches.get(batch_id)
+        if batch is None or batch.provider != provider:
+            return None
+        return batch
+
+    def not_found(provider: str) -> JSONResponse:
+        if provider == "openai":
+            body = {"error": {"message": "Not found", "type": "invalid_request_error", "code": None}}
+        else:
+            body = {"type": "error", "error": {"type": "not_found_error", "message": "Not found"}}
+        return JSONResponse(body, status_code=404)
+
+    @app.post("/v1/files")
+    async def upload_file(request: Request):
+        fields = _multipart_fields(request.headers.get("content-type", ""), await request.body())
+        if "file" not in fields:
+            return JSONResponse({"error": {"message": "Missing file", "type": "invalid_request_error"}},
+                                status_code=400)
+        filename, content = fields["file"]
+        purpose = fields.get("purpose", (None, b"batch"))[1].decode()
+        return store_file(filename or "upload.jsonl", purpose, content)
+
+    @app.get("/v1/files/{file_id}/content")
+    async def file_content(file_id: str):
+        if file_id not in files:
+            return not_found("openai")
+        return Response(files[file_id][1], media_type="application/octet-stream")
+
+    @app.post("/v1/batches")
+    async def create_openai_batch(request: Request):
+        body = await request.json()
+        if body.get("input_file_id") not in files:
+            return not_found("openai")
+        results = []
+        for line in files[body["input_file_id"]][1].decode().splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            params = entry.get("body", {})
+            response = None if settings.should_fail(params.get("model")) else _openai_completion(settings, params)
+            results.append((entry["custom_id"], response))
+        batch = MockBatch(f"batch_{uuid.uuid4().hex[:24]}", "openai", results, settings.batch_duration)
+        batch.input_file_id = body["input_file_id"]
+        batches[batch.id] = batch
+        return openai_batch(batch)
+
+    @app.get("/v1/batches/{batch_id}")
+    async def get_openai_batch(batch_id: str):
+        batch = find_batch(batch_id, "openai")
+        return not_found("openai") if batch is None else openai_batch(batch)
+
+    @app.post("/v1/batches/{batch_id}/cancel")
+    async def cancel_openai_batch(batch_id: str):
+        batch = find_batch(batch_id, "openai")
+        if batch is None:
+            return not_found("openai")
+        if batch.ended:
+            return openai_batch(batch)
+        batch.cancelled_at = time.time()
+        return openai_batch(batch, status="cancelling")
+
+    @app.post("/v1/messages/batches")
+    async def create_claude_batch(request: Request):
+        body = await request.json()
+        results = [
+            (entry["custom_id"],
+             None if settings.should_fail(entry["params"].get("model")) else _claude_message(settings, entry["params"]))
+            for entry in body.get("requests", [])
+        ]
+        batch = MockBatch(f"msgbatch_{uuid.uuid4().hex[:24]}", "claude", results, settings.batch_duration)
+        batches[batch.id] = batch
+        return claude_batch(request, batch)
+
+    @app.get("/v1/messages/batches/{batch_id}")
+    async def get_claude_batch(batch_id: str, request: Request):
+        batch = find_batch(batch_id, "claude")
+        return not_found("claude") if batch is None else claude_batch(request, batch)
+
+    @app.post("/v1/messages/batches/{batch_id}/cancel")
+    async def cancel_claude_batch(batch_id: str, request: Request):
+        batch = find_batch(batch_id, "claude")
+        if batch is None:
+            return not_found("claude")
+        if batch.ended:
+            return claude_batch(request, batch)
+        batch.cancelled_at = time.time()
+        return claude_batch(request, batch, canceling=True)
+
+    @app.get("/v1/messages/batches/{batch_id}/results")
+    async def claude_batch_results(batch_id: str):
+        batch = find_batch(batch_id, "claude")
+        if batch is None or not batch.ended:
+            return not_found("claude")
+        lines = []
+        for custom_id, message in batch.results:
+            if batch.cancelled_at is not None:
+                result = {"type": "canceled"}
+            elif message is None:
+                result = {"type": "errored", "error": {"type": "error", "error": {
+                    "type": "api_error", "message": f"Simulated error {settings.error_status}"}}}
+            else:
+                result = {"type": "succeeded", "message": message}
+            lines.append(json.dumps({"custom_id": custom_id, "result": result}))
+        return Response("\n".join(lines) + "\n", media_type="application/binary")
+
+    return app
+
+
+def main() -> None:
+    defaults = create_mock_settings_from_env()
+    parser = argparse.ArgumentParser(description="Server simulato delle API OpenAI e Anthropic")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=defaults.latency)
+    parser.add_argument("--jitter", type=float, default=defaults.jitter)
+    parser.add_argument("--token-interval", type=float, default=defaults.token_interval)
+    parser.add_argument("--output-tokens", type=int, default=defaults.output_tokens)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--error-status", type=int, default=defaults.error_status)
+    args = parser.parse_args()
+
+    import uvicorn
+    settings = MockSettings(
+        latency=args.latency,
+        jitter=args.jitter,
+        token_interval=args.token_interval,
+        output_tokens=args.output_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        rpm=defaults.rpm,
+        tpm=defaults.tpm,
+        error_models=defaults.error_models,
+        batch_duration=defaults.batch_duration,
+    )
+    uvicorn.run(create_mock_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
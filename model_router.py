@@ -0,0 +1,320 @@
+"""
+Instradamento delle richieste sui modelli, con scelta in base alla latenza e fallback
+
+Un file di configurazione JSON associa a ogni classe di richiesta (es. "openai",
+"claude-thinking", "auto") una lista ordinata di modelli candidati, anche di
+provider diversi. Per ogni candidato il router tiene una media mobile della
+latenza e il tasso di errore delle ultime chiamate: ogni richiesta va al
+candidato sano più veloce e, se la chiamata fallisce per un problema del
+provider, passa in modo trasparente al candidato successivo. Per gli stream
+il fallback è possibile solo prima che arrivi il primo evento.
+
+Formato del file (MODEL_ROUTES_PATH, default model_routes.json):
+
+    {
+      "routes": {
+        "auto": ["openai/gpt-4o", "claude/claude-sonnet-4-5-20250929"],
+        ...
+      }
+    }
+"""
+
+import json
+import os
+import time
+from collections import deque
+from typing import Optional, Dict, Any, AsyncGenerator, Awaitable, Callable, NamedTuple, TypeVar
+
+from api_client import openai_model_for
+from rate_limiter import RateLimitExceeded
+from resilience import CircuitOpenError, is_retryable
+import metrics
+
+
+T = TypeVar("T")
+
+
+class Candidate(NamedTuple):
+    """Un modello candidato di una rotta"""
+    provider: str
+    model: str
+
+    def __str__(self) -> str:
+        return f"{self.provider}/{self.model}"
+
+
+# Rotte usate se il file di configurazione non esiste (equivalenti ai modelli storici)
+DEFAULT_ROUTES: Dict[str, list[str]] = {
+    "openai": ["openai/gpt-4o"],
+    "openai-thinking": ["openai/o1"],
+    "claude": ["claude/claude-sonnet-4-5-20250929"],
+    "claude-thinking": ["claude/claude-sonnet-4-5-20250929"],
+    "auto": ["openai/gpt-4o", "claude/claude-sonnet-4-5-20250929"],
+    "auto-thinking": ["claude/claude-sonnet-4-5-20250929", "openai/o1"],
+}
+
+
+def parse_candidate(value: str) -> Candidate:
+    """Converte "provider/modello" in Candidate"""
+    provider, _, model = value.partition("/")
+    if provider not in ("openai", "claude") or not model:
+        raise ValueError(f"Candidato non valido: {value!r} (formato: openai/<modello> o claude/<modello>)")
+    return Candidate(provider, model)
+
+
+def route_for(name: str, thinking: bool) -> str:
+    """Rotta del router per una classe di richiesta (es. "claude" -> "claude-thinking")"""
+    return f"{name}-thinking" if thinking else name
+
+
+def should_fall_back(error: BaseException) -> bool:
+    """True se l'errore riguarda il provider o il modello e ha senso provare il candidato successivo"""
+    return isinstance(error, (RateLimitExceeded, CircuitOpenError)) or is_retryable(error)
+
+
+class _CandidateStats:
+    """Media mobile della latenza ed esiti recenti di un candidato"""
+
+    def __init__(self, window: int):
+        self.latency: Optional[float] = None
+        self.outcomes: deque = deque(maxlen=window)
+        self.calls = 0
+        self.failures = 0
+        self.last_failure = 0.0
+
+    def record(self, ok: bool, seconds: Optional[float], alpha: float) -> None:
+        self.calls += 1
+        self.outcomes.append(ok)
+        if not ok:
+            self.failures += 1
+            self.last_failure = time.monotonic()
+        elif seconds is not None:
+            self.latency = seconds if self.latency is None else alpha * seconds + (1 - alpha) * self.latency
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+
+class ModelRouter:
+    """
+    Sceglie il modello per ogni classe di richiesta
+
+    Args:
+        routes: Candidati ordinati per rotta, es. {"auto": [Candidate("openai", "gpt-4o"), ...]}
+        window: Chiamate recenti considerate per il tasso di errore
+        min_samples: Chiamate minime prima di giudicare un candidato non sano
+        max_error_rate: Tasso di errore oltre il quale un candidato è evitato
+        cooldown: Secondi dall'ultimo errore dopo i quali un candidato evitato torna a essere provato
+        alpha: Peso dell'ultima misura nella media mobile esponenziale della latenza
+    """
+
+    def __init__(
+        self,
+        routes: Dict[str, list[Candidate]],
+        window: int = 20,
+        min_samples: int = 5,
+        max_error_rate: float = 0.5,
+        cooldown: float = 30.0,
+        alpha: float = 0.2
+    ):
+        self.routes = routes
+        self.window = window
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.alpha = alpha
+        # La latenza dipende dalla rotta (es. con o senza thinking), la salute solo dal modello
+        self._latency: Dict[tuple[str, Candidate], _CandidateStats] = {}
+        self._health: Dict[Candidate, _CandidateStats] = {}
+        self.fallbacks = 0
+
+    def _stats(self, table: Dict, key: Any) -> _CandidateStats:
+        stats = table.get(key)
+        if stats is None:
+            stats = table[key] = _CandidateStats(self.window)
+        return stats
+
+    def is_healthy(self, candidate: Candidate) -> bool:
+        health = self._health.get(candidate)
+        if health is None or len(health.outcomes) < self.min_samples:
+            return True
+        if time.monotonic() - health.last_failure > self.cooldown:
+            return True
+        return health.error_rate <= self.max_error_rate
+
+    def candidates(self, route: str, provider: Optional[str] = None) -> list[Candidate]:
+        """
+        Candidati della rotta in ordine di preferenza
+
+        Prima i candidati sani, dal più veloce; quelli senza misure di latenza
+        vengono provati per primi (nell'ordine del file) così da misurarli. I
+        candidati non sani restano in coda come ultima risorsa.
+
+        Raises:
+            KeyError: se la rotta non esiste o non ha candidati del provider indicato
+        """
+        candidates = [c for c in self.routes[route] if provider is None or c.provider == provider]
+        if not candidates:
+            raise KeyError(f"Nessun candidato {provider} per la rotta {route!r}")
+
+        def preference(item: tuple[int, Candidate]) -> tuple:
+            position, candidate = item
+            stats = self._latency.get((route, candidate))
+            latency = stats.latency if stats is not None and stats.latency is not None else 0.0
+            return (not self.is_healthy(candidate), latency, position)
+
+        return [candidate for _, candidate in sorted(enumerate(candidates), key=preference)]
+
+    def select(self, route: str, provider: Optional[str] = None) -> Candidate:
+        """Il candidato preferito, per le chiamate senza fallback (es. streaming)"""
+        return self.candidates(route, provider)[0]
+
+    def record(self, route: str, candidate: Candidate, ok: bool, seconds: Optional[float] = None) -> None:
+        """Registra l'esito di una chiamata servita da un candidato"""
+        self._stats(self._health, candidate).record(ok, None, self.alpha)
+        if ok:
+            self._stats(self._latency, (route, candidate)).record(ok, seconds, self.alpha)
+
+    async def call(
+        self,
+        route: str,
+        attempt: Callable[[Candidate], Awaitable[T]],
+        provider: Optional[str] = None,
+        reused: Optional[Callable[[T], bool]] = None
+    ) -> tuple[Candidate, T]:
+        """
+        Esegue attempt(candidato) sul candidato migliore, passando al successivo in caso di errore
+
+        Args:
+            reused: Se indicata e restituisce True per il risultato (risposta dalla cache o
+                condivisa con una richiesta identica), la latenza non viene registrata
+
+        Returns:
+            Coppia (candidato che ha servito la richiesta, risultato)
+
+        Raises:
+            L'errore dell'ultimo candidato provato, o il primo errore non dovuto al provider
+        """
+        candidates = self.candidates(route, provider)
+        for index, candidate in enumerate(candidates):
+            started = time.monotonic()
+            try:
+                result = await attempt(candidate)
+            except Exception as e:
+                if not should_fall_back(e):
+                    raise
+                self.record(route, candidate, ok=False)
+                if index == len(candidates) - 1:
+                    raise
+                self.fallbacks += 1
+                metrics.ROUTE_FALLBACKS.inc(route=route, provider=candidate.provider, model=candidate.model)
+                continue
+            seconds = None if reused is not None and reused(result) else time.monotonic() - started
+            self.record(route, candidate, ok=True, seconds=seconds)
+            return candidate, result
+
+    async def open_stream(
+        self,
+        route: str,
+        open_events: Callable[[Candidate], AsyncGenerator[T, None]],
+        provider: Optional[str] = None
+    ) -> tuple[Candidate, AsyncGenerator[T, None]]:
+        """
+        Apre uno stream sul candidato migliore, con fallback fino al primo evento
+
+        Il fallback è possibile solo finché il client non ha ricevuto nulla: si
+        attende il primo evento di ogni candidato e, se la chiamata fallisce per un
+        problema del provider, si passa al successivo. Gli errori a stream avviato
+        arrivano al client.
+
+        Returns:
+            Coppia (candidato scelto, eventi dello stream a partire dal primo)
+        """
+        async def attempt(candidate: Candidate) -> AsyncGenerator[T, None]:
+            events = open_events(candidate)
+            try:
+                first = await events.__anext__()
+            except StopAsyncIteration:
+                return events
+            return _prepend(first, events)
+
+        # Il tempo al primo evento non è confrontabile con la latenza delle chiamate
+        # complete: per gli stream si registra solo l'esito
+        return await self.call(route, attempt, provider, reused=lambda _: True)
+
+    def stats(self) -> Dict[str, Any]:
+        """Candidati in ordine di preferenza per rotta, con latenza media e tasso di errore"""
+        routes = {}
+        for route in self.routes:
+            entries = []
+            for candidate in self.candidates(route):
+                latency = self._latency.get((route, candidate))
+                health = self._health.get(candidate)
+                entries.append({
+                    "candidate": str(candidate),
+                    "healthy": self.is_healthy(candidate),
+                    "latency": None if latency is None else latency.latency,
+                    "calls": 0 if health is None else health.calls,
+                    "failures": 0 if health is None else health.failures,
+                    "error_rate": 0.0 if health is None else round(health.error_rate, 4),
+                })
+            routes[route] = entries
+        return {"fallbacks": self.fallbacks, "routes": routes}
+
+
+async def _prepend(first: T, events: AsyncGenerator[T, None]) -> AsyncGenerator[T, None]:
+    """Produce first e poi il resto di events (chiudendo events alla fine)"""
+    try:
+        yield first
+        async for event in events:
+            yield event
+    finally:
+        await events.aclose()
+
+
+def load_routes(path: Optional[str]) -> Dict[str, list[Candidate]]:
+    """
+    Legge le rotte dal file JSON (o usa DEFAULT_ROUTES se il file non esiste)
+
+    Raises:
+        ValueError: se il file non rispetta il formato
+    """
+    routes = DEFAULT_ROUTES
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+        routes = {**DEFAULT_ROUTES, **config.get("routes", {})}
+
+    parsed = {name: [parse_candidate(value) for value in values] for name, values in routes.items()}
+    for name, candidates in parsed.items():
+        if name.endswith("-thinking"):
+            # Con thinking il client OpenAI sostituisce i modelli gpt-* con o1: il candidato
+            # deve essere il modello chiamato davvero, per le risposte e per le statistiche
+            parsed[name] = list(dict.fromkeys(
+                Candidate(c.provider, openai_model_for(c.model, True)) if c.provider == "openai" else c
+                for c in candidates
+            ))
+    empty = [name for name, candidates in parsed.items() if not candidates]
+    if empty:
+        raise ValueError(f"Rotte senza candidati: {', '.join(empty)}")
+    return parsed
+
+
+def create_model_router_from_env() -> ModelRouter:
+    """
+    Crea il router configurato con le variabili d'ambiente
+
+        MODEL_ROUTES_PATH: file JSON delle rotte (default model_routes.json)
+        ROUTER_MAX_ERROR_RATE: tasso di errore oltre il quale un modello è evitato (default 0.5)
+        ROUTER_WINDOW: chiamate recenti considerate per il tasso di errore (default 20)
+        ROUTER_COOLDOWN: secondi prima di riprovare un modello evitato (default 30)
+    """
+    return ModelRouter(
+        load_routes(os.getenv("MODEL_ROUTES_PATH", "model_routes.json")),
+        window=int(os.getenv("ROUTER_WINDOW", "20")),
+        max_error_rate=float(os.getenv("ROUTER_MAX_ERROR_RATE", "0.5")),
+        cooldown=float(os.getenv("ROUTER_COOLDOWN", "30")),
+    )
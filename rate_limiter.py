@@ -0,0 +1,230 @@
+"""
+Rate limiter lato client per le chiamate ai provider
+
+Ogni coppia provider+modello ha due token bucket: uno per le richieste al
+minuto e uno per i token al minuto (stimati prima della chiamata). Le
+chiamate che sforerebbero il budget attendono in coda, fino a un'attesa
+massima, invece di partire e ricevere un 429 dal provider. Il budget si
+adatta leggendo gli header di rate limit restituiti da OpenAI e Anthropic.
+"""
+
+import asyncio
+import json
+import math
+import os
+import re
+import time
+from datetime import datetime
+from typing import Optional, Dict, Any, Mapping
+
+from shared_state import SharedState, InProcessState
+
+
+class RateLimitExceeded(Exception):
+    """La chiamata dovrebbe attendere più dell'attesa massima consentita"""
+
+    def __init__(self, provider: str, model: str, retry_after: float):
+        super().__init__(
+            f"Rate limit for {provider}/{model}: retry in {retry_after:.1f}s"
+        )
+        self.provider = provider
+        self.model = model
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """
+    Rate limiter per provider e modello
+
+    I bucket vivono nello stato condiviso (vedi shared_state.py): con più
+    worker e un backend condiviso il budget è unico per tutto il deployment.
+
+    Args:
+        limits: Limiti di default per provider, es. {"openai": (rpm, tpm)}
+        max_wait: Attesa massima in coda (secondi) prima di rinunciare con RateLimitExceeded
+        state: Stato in cui tenere i bucket (default: in memoria del processo)
+    """
+
+    def __init__(
+        self,
+        limits: Dict[str, tuple[float, float]],
+        max_wait: float = 30.0,
+        state: Optional[SharedState] = None
+    ):
+        self.limits = limits
+        self.max_wait = max_wait
+        self.state = state if state is not None else InProcessState()
+        # Serializzano le attese del worker: le chiamate escono dalla coda in ordine di arrivo
+        self._locks: Dict[tuple[str, str], asyncio.Lock] = {}
+        self.waits = 0
+        self.rejections = 0
+
+    def _lock(self, provider: str, model: str) -> asyncio.Lock:
+        key = (provider, model)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    @staticmethod
+    def _bucket_key(provider: str, model: str, kind: str) -> str:
+        return f"ratelimit:{provider}/{model}:{kind}"
+
+    async def acquire(
+        self,
+        provider: str,
+        model: str,
+        estimated_tokens: int,
+        max_wait: Optional[float] = None
+    ) -> None:
+        """
+        Attende che ci sia budget per una richiesta da estimated_tokens token
+
+        Raises:
+            RateLimitExceeded: se l'attesa supererebbe max_wait
+        """
+        max_wait = self.max_wait if max_wait is None else max_wait
+        rpm, tpm = self.limits[provider]
+        request = [
+            (self._bucket_key(provider, model, "requests"), rpm, 1),
+            (self._bucket_key(provider, model, "tokens"), tpm, estimated_tokens),
+        ]
+        deadline = time.monotonic() + max_wait
+
+        async with self._lock(provider, model):
+            while True:
+                wait = await self.state.run(self.state.take_tokens, request)
+                if wait <= 0:
+                    return
+                if time.monotonic() + wait > deadline:
+                    self.rejections += 1
+                    raise RateLimitExceeded(provider, model, wait)
+                self.waits += 1
+                await asyncio.sleep(wait)
+
+    async def update_from_headers(self, provider: str, model: str, headers: Mapping[str, str]) -> None:
+        """Adatta il budget agli header di rate limit restituiti dal provider"""
+        self._lock(provider, model)
+        if provider == "openai":
+            parsed = _parse_openai_headers(headers)
+        else:
+            parsed = _parse_anthropic_headers(headers)
+
+        for kind, capacity in zip(("requests", "tokens"), self.limits[provider]):
+            limit, remaining, reset_in = parsed[kind]
+            if limit is not None or remaining is not None:
+                await self.state.run(
+                    self.state.update_bucket,
+                    self._bucket_key(provider, model, kind), capacity, limit, remaining, reset_in
+                )
+
+    def stats(self) -> Dict[str, Any]:
+        """Stato dei bucket e contatori di attese e rifiuti (questi ultimi per worker)"""
+        buckets = {}
+        for provider, model in self._locks:
+            requests = self.state.bucket(self._bucket_key(provider, model, "requests"))
+            tokens = self.state.bucket(self._bucket_key(provider, model, "tokens"))
+            if requests is None or tokens is None:
+                continue
+            buckets[f"{provider}/{model}"] = {
+                "requests_per_minute": requests["capacity"],
+                "requests_available": round(requests["tokens"], 2),
+                "tokens_per_minute": tokens["capacity"],
+                "tokens_available": round(tokens["tokens"], 2),
+            }
+        return {
+            "backend": type(self.state).__name__,
+            "waits": self.waits,
+            "rejections": self.rejections,
+            "buckets": buckets,
+        }
+
+
+def estimate_tokens(params: Dict[str, Any]) -> int:
+    """
+    Stima approssimativa dei token di una richiesta (circa 4 caratteri per token)
+
+    Include i token di output richiesti, che i provider conteggiano nel budget.
+    """
+    prompt_chars = len(json.dumps(params.get("messages", []), ensure_ascii=False))
+    prompt_chars += len(json.dumps(params.get("system", ""), ensure_ascii=False))
+    return prompt_chars // 4 + (params.get("max_tokens") or 1024)
+
+
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    """Converte durate OpenAI come "1s", "6m0s" o "20ms" in secondi"""
+    if not value:
+        return None
+    total = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|s|m|h)", value):
+        total += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total
+
+
+def _parse_reset_timestamp(value: Optional[str]) -> Optional[float]:
+    """Converte un timestamp RFC 3339 di Anthropic in secondi mancanti"""
+    if not value:
+        return None
+    try:
+        reset_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max(0.0, reset_at.timestamp() - time.time())
+
+
+def _number(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _parse_openai_headers(headers: Mapping[str, str]) -> Dict[str, tuple]:
+    return {
+        kind: (
+            _number(headers.get(f"x-ratelimit-limit-{kind}")),
+            _number(headers.get(f"x-ratelimit-remaining-{kind}")),
+            _parse_duration(headers.get(f"x-ratelimit-reset-{kind}")),
+        )
+        for kind in ("requests", "tokens")
+    }
+
+
+def _parse_anthropic_headers(headers: Mapping[str, str]) -> Dict[str, tuple]:
+    return {
+        kind: (
+            _number(headers.get(f"anthropic-ratelimit-{kind}-limit")),
+            _number(headers.get(f"anthropic-ratelimit-{kind}-remaining")),
+            _parse_reset_timestamp(headers.get(f"anthropic-ratelimit-{kind}-reset")),
+        )
+        for kind in ("requests", "tokens")
+    }
+
+
+def create_rate_limiter_from_env(state: Optional[SharedState] = None) -> Optional[RateLimiter]:
+    """
+    Crea il rate limiter configurato con le variabili d'ambiente
+
+        RATE_LIMIT: "on" (default) oppure "off"
+        OPENAI_RPM / OPENAI_TPM: limiti iniziali per OpenAI (default 500 / 200000)
+        ANTHROPIC_RPM / ANTHROPIC_TPM: limiti iniziali per Claude (default 50 / 40000)
+        RATE_LIMIT_MAX_WAIT: attesa massima in coda in secondi (default 30)
+
+    I limiti iniziali vengono poi corretti dagli header restituiti dai provider.
+    I bucket sono tenuti in state (default: in memoria del processo).
+    """
+    if os.getenv("RATE_LIMIT", "on").lower() == "off":
+        return None
+    return RateLimiter(
+        limits={
+            "openai": (float(os.getenv("OPENAI_RPM", "500")), float(os.getenv("OPENAI_TPM", "200000"))),
+            "claude": (float(os.getenv("ANTHROPIC_RPM", "50")), float(os.getenv("ANTHROPIC_TPM", "40000"))),
+        },
+        max_wait=float(os.getenv("RATE_LIMIT_MAX_WAIT", "30")),
+        state=state,
+    )
+
+
+def retry_after_header(error: RateLimitExceeded) -> Dict[str, str]:
+    """Header Retry-After (secondi interi) per una risposta 429"""
+    return {"Retry-After": str(max(1, math.ceil(error.retry_after)))}
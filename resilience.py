@@ -0,0 +1,362 @@
+"""
+Resilienza delle chiamate ai provider: retry, hedging e circuit breaker
+
+- Retry: solo per gli errori transitori (connessione, timeout, 408/409/429/5xx),
+  con backoff esponenziale con jitter che rispetta l'header Retry-After.
+- Hedging: per le chiamate brevi (senza thinking né streaming), se la risposta
+  tarda oltre il p95 delle latenze osservate parte una seconda richiesta
+  identica e vince la prima che risponde.
+- Circuit breaker: dopo troppi errori consecutivi di un provider le chiamate
+  falliscono subito per un periodo di raffreddamento, poi una chiamata di
+  prova decide se richiudere il circuito. I 429 vengono ritentati ma non
+  contano come errori: riguardano il budget di un modello (o della chiave),
+  non la salute del provider, e non devono chiudere anche gli altri modelli.
+"""
+
+import asyncio
+import math
+import os
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Any, Awaitable, Callable
+
+import httpx
+import openai
+import anthropic
+
+
+# Status HTTP che indicano un problema transitorio del provider
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class CircuitOpenError(Exception):
+    """Il provider è considerato degradato: la chiamata non viene nemmeno tentata"""
+
+    def __init__(self, provider: str, retry_after: float):
+        super().__init__(f"Circuit open for {provider}: retry in {retry_after:.1f}s")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+def is_retryable(error: BaseException) -> bool:
+    """True se l'errore è transitorio e ha senso ripetere la chiamata"""
+    if isinstance(error, (openai.APIConnectionError, anthropic.APIConnectionError,
+                          httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    status = getattr(error, "status_code", None)
+    return status in RETRYABLE_STATUS or (status is not None and status >= 500)
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    """True se il provider ha rifiutato la chiamata per rate limit (429)"""
+    return getattr(error, "status_code", None) == 429
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Legge Retry-After (o retry-after-ms) dalla risposta di errore, se presente"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker per un provider (stati: closed, open, half_open)
+
+    Args:
+        failure_threshold: Errori consecutivi che aprono il circuito
+        cooldown: Secondi di circuito aperto prima della chiamata di prova
+    """
+
+    def __init__(self, provider: str, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._probe_in_flight = False
+
+    def before_call(self) -> None:
+        """
+        Verifica che la chiamata possa partire
+
+        Raises:
+            CircuitOpenError: se il circuito è aperto (o è già in corso la chiamata di prova)
+        """
+        if self.state == "open":
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if remaining > 0:
+                raise CircuitOpenError(self.provider, remaining)
+            self.state = "half_open"
+            self._probe_in_flight = False
+
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                raise CircuitOpenError(self.provider, 1.0)
+            self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.opens += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """La chiamata è terminata senza dire nulla sulla salute del provider (es. errore 400)"""
+        self._probe_in_flight = False
+
+
+class LatencyTracker:
+    """Finestra mobile delle ultime latenze osservate, per calcolare i percentili"""
+
+    def __init__(self, window: int = 200):
+        self.samples: deque = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+        return ordered[index]
+
+
+class ResiliencePolicy:
+    """
+    Politica di resilienza condivisa dai client dei provider
+
+    Args:
+        max_retries: Tentativi aggiuntivi dopo il primo per gli errori transitori
+        base_delay: Ritardo base del backoff esponenziale (secondi)
+        max_delay: Ritardo massimo tra due tentativi (secondi)
+        max_retry_after: Oltre questo Retry-After (secondi) si rinuncia subito
+        hedging: Abilita le richieste di riserva (hedged requests)
+        hedge_quantile: Percentile di latenza oltre il quale parte la richiesta di riserva
+        hedge_min_samples: Campioni minimi prima di usare l'hedging
+        failure_threshold: Errori consecutivi che aprono il circuit breaker
+        cooldown: Durata (secondi) del circuito aperto
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 20.0,
+        max_retry_after: float = 60.0,
+        hedging: bool = True,
+        hedge_quantile: float = 0.95,
+        hedge_min_samples: int = 20,
+        failure_threshold: int = 5,
+        cooldown: float = 30.0
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.hedging = hedging
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.latencies: Dict[tuple[str, str], LatencyTracker] = {}
+        self.counters = {
+            "calls": 0,
+            "retries": 0,
+            "failures": 0,
+            "hedges_started": 0,
+            "hedges_won": 0,
+            "circuit_rejections": 0,
+        }
+
+    def breaker(self, provider: str) -> CircuitBreaker:
+        breaker = self.breakers.get(provider)
+        if breaker is None:
+            breaker = self.breakers[provider] = CircuitBreaker(
+                provider, self.failure_threshold, self.cooldown
+            )
+        return breaker
+
+    def _latency(self, provider: str, model: str) -> LatencyTracker:
+        tracker = self.latencies.get((provider, model))
+        if tracker is None:
+            tracker = self.latencies[(provider, model)] = LatencyTracker()
+        return tracker
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> Optional[float]:
+        """Ritardo prima del prossimo tentativo (None = non ritentare)"""
+        if retry_after is not None and retry_after > self.max_retry_after:
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    async def call(
+        self,
+        provider: str,
+        model: str,
+        attempt: Callable[[], Awaitable[Any]],
+        hedgeable: bool = False
+    ) -> Any:
+        """
+        Esegue attempt() con retry, hedging (se hedgeable) e circuit breaker
+
+        Raises:
+            CircuitOpenError: se il provider è degradato
+            L'ultimo errore del provider se i tentativi sono esauriti o l'errore non è transitorio
+        """
+        breaker = self.breaker(provider)
+        self.counters["calls"] += 1
+
+        for n in range(self.max_retries + 1):
+            try:
+                breaker.before_call()
+            except CircuitOpenError:
+                self.counters["circuit_rejections"] += 1
+                raise
+
+            started = time.monotonic()
+            try:
+                if hedgeable and self.hedging:
+                    result = await self._hedged(provider, model, attempt)
+                else:
+                    result = await attempt()
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    breaker.release()
+                    raise
+                if is_rate_limited(e):
+                    # Il provider è sano, è finito il budget: nessun effetto sul circuito
+                    breaker.release()
+                else:
+                    breaker.record_failure()
+                self.counters["failures"] += 1
+
+                delay = self._backoff(n, retry_after_seconds(e))
+                if n == self.max_retries or delay is None:
+                    raise
+                self.counters["retries"] += 1
+                await asyncio.sleep(delay)
+                continue
+
+            breaker.record_success()
+            if hedgeable:
+                self._latency(provider, model).record(time.monotonic() - started)
+            return result
+
+    async def _hedged(
+        self, provider: str, model: str, attempt: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """Avvia una richiesta di riserva se la prima supera il percentile di latenza"""
+        tracker = self._latency(provider, model)
+        threshold = None
+        if len(tracker.samples) >= self.hedge_min_samples:
+            threshold = tracker.quantile(self.hedge_quantile)
+        if threshold is None:
+            return await attempt()
+
+        primary = asyncio.ensure_future(attempt())
+        tasks = [primary]
+        error: Optional[BaseException] = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=threshold)
+            if done:
+                return primary.result()
+
+            self.counters["hedges_started"] += 1
+            backup = asyncio.ensure_future(attempt())
+            tasks.append(backup)
+            pending = {primary, backup}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            self.counters["hedges_won"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # Anche se il chiamante viene annullato durante un'attesa nessuna richiesta resta in corso
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """Contatori e stato dei circuit breaker"""
+        return {
+            **self.counters,
+            "circuits": {
+                provider: {"state": breaker.state, "failures": breaker.failures, "opens": breaker.opens}
+                for provider, breaker in self.breakers.items()
+            },
+            "hedge_thresholds": {
+                f"{provider}/{model}": tracker.quantile(self.hedge_quantile)
+                for (provider, model), tracker in self.latencies.items()
+                if len(tracker.samples) >= self.hedge_min_samples
+            },
+        }
+
+
+def create_resilience_from_env() -> Optional[ResiliencePolicy]:
+    """
+    Crea la politica di resilienza configurata con le variabili d'ambiente
+
+        RESILIENCE: "on" (default) oppure "off" (si usano i retry interni degli SDK)
+        RETRY_MAX_RETRIES: tentativi aggiuntivi (default 3)
+        RETRY_BASE_DELAY / RETRY_MAX_DELAY: backoff in secondi (default 0.5 / 20)
+        HEDGING: "on" (default) oppure "off"
+        HEDGE_QUANTILE: percentile di latenza per l'hedging (default 0.95)
+        CIRCUIT_FAILURE_THRESHOLD: errori consecutivi che aprono il circuito (default 5)
+        CIRCUIT_COOLDOWN: secondi di circuito aperto (default 30)
+    """
+    if os.getenv("RESILIENCE", "on").lower() == "off":
+        return None
+    return ResiliencePolicy(
+        max_retries=int(os.getenv("RETRY_MAX_RETRIES", "3")),
+        base_delay=float(os.getenv("RETRY_BASE_DELAY", "0.5")),
+        max_delay=float(os.getenv("RETRY_MAX_DELAY", "20")),
+        hedging=os.getenv("HEDGING", "on").lower() != "off",
+        hedge_quantile=float(os.getenv("HEDGE_QUANTILE", "0.95")),
+        failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")),
+        cooldown=float(os.getenv("CIRCUIT_COOLDOWN", "30")),
+    )
@@ -0,0 +1,285 @@
+"""
+Cache delle risposte per prompt deterministici (temperature=0)
+
+Le risposte vengono salvate come dizionari JSON, indicizzate da un hash dei
+parametri effettivamente inviati al provider (modello risolto, messaggi,
+temperatura, max_tokens, impostazioni di thinking...). Sono disponibili un
+backend in memoria (LRU + TTL), uno su disco basato su SQLite e uno sullo
+stato condiviso tra i worker (vedi shared_state.py). Dal codice asincrono si
+usano aget/aset, che eseguono in un thread le letture e scritture dei backend
+su disco o in rete.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+
+from shared_state import SharedState
+
+
+def make_cache_key(provider: str, params: Dict[str, Any]) -> str:
+    """
+    Calcola la chiave di cache per una chiamata a un provider
+
+    Args:
+        provider: Nome del provider ("openai" o "claude")
+        params: Parametri finali della chiamata (dopo la risoluzione del modello)
+
+    Returns:
+        Hash SHA-256 esadecimale dei parametri normalizzati
+    """
+    relevant = {k: v for k, v in params.items() if k != "stream"}
+    payload = json.dumps(
+        {"provider": provider, "params": relevant},
+        sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def is_cacheable(params: Dict[str, Any]) -> bool:
+    """Solo le chiamate non in streaming con temperature=0 sono deterministiche"""
+    return not params.get("stream") and params.get("temperature") == 0
+
+
+class ResponseCache:
+    """Interfaccia comune dei backend di cache"""
+
+    # False se get/set non fanno I/O e possono girare direttamente nell'event loop
+    blocking = True
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600):
+        """
+        Args:
+            max_entries: Numero massimo di risposte conservate (poi evizione LRU)
+            ttl: Durata in secondi di ogni risposta in cache
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Restituisce la risposta in cache (o None), aggiornando i contatori"""
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        """Salva una risposta in cache"""
+        self._set(key, value)
+
+    async def aget(self, key: str) -> Optional[Dict[str, Any]]:
+        """Come get(), senza bloccare l'event loop"""
+        if not self.blocking:
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, value: Dict[str, Any]) -> None:
+        """Come set(), senza bloccare l'event loop"""
+        if not self.blocking:
+            self.set(key, value)
+        else:
+            await asyncio.to_thread(self.set, key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        """Contatori di hit/miss e dimensione corrente"""
+        total = self.hits + self.misses
+        return {
+            "backend": type(self).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+        }
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Rilascia le risorse del backend (se presenti)"""
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class MemoryResponseCache(ResponseCache):
+    """Cache in memoria con evizione LRU e scadenza TTL"""
+
+    blocking = False
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600):
+        super().__init__(max_entries, ttl)
+        self._entries: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteResponseCache(ResponseCache):
+    """Cache su disco (SQLite) con evizione LRU e scadenza TTL, persistente tra i riavvii"""
+
+    def __init__(self, path: str = "response_cache.sqlite3", max_entries: int = 10000, ttl: float = 86400):
+        super().__init__(max_entries, ttl)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)"
+        )
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < now:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(value)
+
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at, last_access)"
+                " VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now + self.ttl, now)
+            )
+            self._conn.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+class SharedResponseCache(ResponseCache):
+    """
+    Cache sullo stato condiviso tra i worker, con scadenza TTL
+
+    Il backend dello stato non tiene l'ordine di accesso: max_entries non è
+    applicato e le risposte escono solo alla scadenza. I contatori di hit/miss
+    sono per worker.
+    """
+
+    PREFIX = "cache:"
+
+    def __init__(self, state: SharedState, max_entries: int = 1000, ttl: float = 3600):
+        super().__init__(max_entries, ttl)
+        self.state = state
+
+    @property
+    def blocking(self) -> bool:
+        return self.state.blocking
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self.state.get(self.PREFIX + key)
+        return None if value is None else json.loads(value)
+
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        self.state.set(self.PREFIX + key, json.dumps(value, ensure_ascii=False), ttl=self.ttl)
+
+    def clear(self) -> None:
+        for key in self.state.keys(self.PREFIX):
+            self.state.delete(key)
+
+    def __len__(self) -> int:
+        return self.state.count(self.PREFIX)
+
+
+def create_response_cache_from_env(state: Optional[SharedState] = None) -> Optional[ResponseCache]:
+    """
+    Crea la cache configurata con le variabili d'ambiente
+
+        RESPONSE_CACHE: "memory" (default), "sqlite", "shared" oppure "off"
+        RESPONSE_CACHE_MAX_ENTRIES: numero massimo di risposte (default 1000)
+        RESPONSE_CACHE_TTL: durata in secondi (default 3600)
+        RESPONSE_CACHE_PATH: file del database SQLite (default response_cache.sqlite3)
+
+    Con "shared" la cache usa state, lo stato condiviso tra i worker.
+
+    Returns:
+        Istanza di ResponseCache, oppure None se la cache è disabilitata
+    """
+    backend = os.getenv("RESPONSE_CACHE", "memory").lower()
+    max_entries = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+    ttl = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+
+    if backend == "off":
+        return None
+    if backend == "memory":
+        return MemoryResponseCache(max_entries=max_entries, ttl=ttl)
+    if backend == "sqlite":
+        path = os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+        return SQLiteResponseCache(path=path, max_entries=max_entries, ttl=ttl)
+    if backend == "shared":
+        if state is None:
+            raise ValueError("RESPONSE_CACHE=shared richiede lo stato condiviso (vedi SHARED_STATE)")
+        return SharedResponseCache(state, max_entries=max_entries, ttl=ttl)
+    raise ValueError(f"RESPONSE_CACHE non valido: {backend!r} (usa memory, sqlite, shared o off)")
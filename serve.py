@@ -0,0 +1,59 @@
+"""
+Avvio del server in produzione con più worker
+
+Ogni worker è un processo separato con i propri client e pool di connessioni.
+Cache delle risposte, rate limiter, consumi per API key e sessioni restano
+coerenti tra i worker solo con uno stato condiviso (SHARED_STATE=sqlite o
+redis, RESPONSE_CACHE=shared, SESSION_STORE=shared); le metriche di /metrics
+e i job batch di /jobs sono invece per worker.
+
+Uso:
+    python serve.py --workers 4 --port 8000
+"""
+
+import argparse
+import os
+import sys
+
+import uvicorn
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Avvia l'API server con più worker")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument(
+        "--workers", type=int,
+        default=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))),
+        help="Numero di processi worker (default WEB_CONCURRENCY o numero di CPU)"
+    )
+    parser.add_argument("--log-level", default=os.getenv("LOG_LEVEL", "info"))
+    args = parser.parse_args()
+
+    if args.workers > 1 and os.getenv("SHARED_STATE", "memory").lower() == "memory":
+        print(
+            "Attenzione: SHARED_STATE=memory con più worker, cache, rate limiter e"
+            " consumi saranno separati per worker (usa sqlite o redis)",
+            file=sys.stderr
+        )
+    if args.workers > 1:
+        # BatchJobManager tiene i job nella memoria del worker (e li salva in BATCH_JOBS_PATH)
+        print(
+            "Attenzione: con più worker i job batch (/jobs) sono per worker: un job è visibile"
+            " solo dal worker che l'ha creato e i worker sovrascrivono a vicenda BATCH_JOBS_PATH",
+            file=sys.stderr
+        )
+
+    uvicorn.run(
+        "api_server:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        log_level=args.log_level,
+        # Allo shutdown lascia terminare le richieste in corso (e lo scarico dei consumi)
+        timeout_graceful_shutdown=30,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""
+Sessioni di conversazione lato server
+
+Il client invia solo il nuovo turno a /sessions/{id}/messages e il server
+ricostruisce la storia salvata. Quando la storia supera il budget di token
+i turni più vecchi vengono scartati oppure riassunti, così le richieste ai
+provider non crescono senza limite. Sono disponibili un backend in memoria
+(LRU + TTL), uno su disco basato su SQLite e uno sullo stato condiviso tra i
+worker (vedi shared_state.py). Dal codice asincrono si usano aget, asave e
+adelete, che eseguono in un thread gli accessi ai backend su disco o in rete.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Awaitable, Callable
+
+from pydantic import BaseModel, Field
+
+from shared_state import SharedState
+from token_budget import count_text_tokens, message_tokens
+
+
+class Session(BaseModel):
+    """Stato di una conversazione"""
+    id: str
+    system: Optional[str] = Field(default=None, description="System prompt della conversazione")
+    summary: Optional[str] = Field(default=None, description="Riassunto dei turni non più in storia")
+    messages: list[Dict[str, str]] = Field(default_factory=list, description="Turni user/assistant in storia")
+    dropped_turns: int = Field(default=0, description="Turni scartati o riassunti per rispettare il budget")
+    created_at: float
+    updated_at: float
+
+
+def history_tokens(session: Session, family: str) -> int:
+    """
+    Token stimati di storia e riassunto di una sessione
+
+    Usa la stessa stima (e la stessa cache) del controllo della finestra di
+    contesto (vedi token_budget.py), così una storia compattata entro il budget
+    non viene poi ridotta o rifiutata prima dell'invio.
+
+    Args:
+        family: Famiglia del modello che riceverà la storia ("openai" o "claude")
+    """
+    tokens = sum(message_tokens(message["content"], family) for message in session.messages)
+    if session.summary:
+        tokens += count_text_tokens(session.summary, family)
+    return tokens
+
+
+# Riassume (riassunto precedente, turni scartati) in un nuovo riassunto
+Summarizer = Callable[[Optional[str], list[Dict[str, str]]], Awaitable[str]]
+
+
+async def compact_history(
+    session: Session,
+    budget: int,
+    family: str,
+    summarize: Optional[Summarizer] = None
+) -> bool:
+    """
+    Riporta la storia della sessione entro il budget di token
+
+    I turni vengono rimossi a coppie (domanda e risposta), dal più vecchio.
+    Senza summarize sono semplicemente scartati; con summarize confluiscono nel
+    riassunto della sessione, e la storia viene ridotta a metà budget per non
+    dover riassumere di nuovo al turno successivo.
+
+    Args:
+        family: Famiglia del modello che riceverà la storia (vedi history_tokens)
+
+    Returns:
+        True se la storia è stata ridotta
+    """
+    if history_tokens(session, family) <= budget:
+        return False
+
+    target = budget // 2 if summarize is not None else budget
+    dropped: list[Dict[str, str]] = []
+    while session.messages and history_tokens(session, family) > target:
+        dropped.extend(session.messages[:2])
+        session.messages = session.messages[2:]
+
+    if summarize is not None and dropped:
+        session.summary = await summarize(session.summary, dropped)
+    session.dropped_turns += len(dropped) // 2
+    return True
+
+
+class SessionStore:
+    """Interfaccia comune dei backend delle sessioni"""
+
+    # False se gli accessi non fanno I/O e possono girare direttamente nell'event loop
+    blocking = True
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 86400):
+        """
+        Args:
+            max_entries: Numero massimo di sessioni conservate (poi evizione LRU)
+            ttl: Secondi di inattività dopo i quali una sessione scade
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    def lock(self, key: str) -> asyncio.Lock:
+        """Lock per serializzare i turni concorrenti della stessa sessione"""
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    def get(self, key: str) -> Optional[Session]:
+        """Restituisce la sessione (o None se non esiste o è scaduta)"""
+        value = self._get(key)
+        return None if value is None else Session.model_validate(value)
+
+    def save(self, key: str, session: Session) -> None:
+        """Salva la sessione, rinnovandone la scadenza"""
+        session.updated_at = time.time()
+        self._set(key, session.model_dump(mode="json"))
+
+    async def _run(self, func: Callable[..., Any], *args: Any) -> Any:
+        if not self.blocking:
+            return func(*args)
+        return await asyncio.to_thread(func, *args)
+
+    async def aget(self, key: str) -> Optional[Session]:
+        """Come get(), senza bloccare l'event loop"""
+        return await self._run(self.get, key)
+
+    async def asave(self, key: str, session: Session) -> None:
+        """Come save(), senza bloccare l'event loop"""
+        await self._run(self.save, key, session)
+
+    async def adelete(self, key: str) -> bool:
+        """Come delete(), senza bloccare l'event loop"""
+        return await self._run(self.delete, key)
+
+    def stats(self) -> Dict[str, Any]:
+        """Backend, numero di sessioni e limiti"""
+        return {
+            "backend": type(self).__name__,
+            "size": len(self),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+        }
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> bool:
+        """Elimina una sessione; False se non esisteva"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Rilascia le risorse del backend (se presenti)"""
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """Sessioni in memoria con evizione LRU e scadenza per inattività"""
+
+    blocking = False
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 86400):
+        super().__init__(max_entries, ttl)
+        self._entries: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessioni su disco (SQLite) con evizione LRU e scadenza, persistenti tra i riavvii"""
+
+    def __init__(self, path: str = "sessions.sqlite3", max_entries: int = 10000, ttl: float = 86400):
+        super().__init__(max_entries, ttl)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access)"
+        )
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM sessions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < now:
+                self._conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+                return None
+            self._conn.execute(
+                "UPDATE sessions SET last_access = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(value)
+
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (key, value, expires_at, last_access)"
+                " VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now + self.ttl, now)
+            )
+            self._conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
+            self._conn.execute(
+                "DELETE FROM sessions WHERE key IN ("
+                " SELECT key FROM sessions ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+            return cursor.rowcount > 0
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+class SharedSessionStore(SessionStore):
+    """
+    Sessioni sullo stato condiviso tra i worker, con scadenza per inattività
+
+    max_entries non è applicato (nessun ordine di accesso nel backend) e il
+    lock dei turni concorrenti resta per worker.
+    """
+
+    PREFIX = "session:"
+
+    def __init__(self, state: SharedState, max_entries: int = 1000, ttl: float = 86400):
+        super().__init__(max_entries, ttl)
+        self.state = state
+
+    @property
+    def blocking(self) -> bool:
+        return self.state.blocking
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self.state.get(self.PREFIX + key)
+        return None if value is None else json.loads(value)
+
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        self.state.set(self.PREFIX + key, json.dumps(value, ensure_ascii=False), ttl=self.ttl)
+
+    def delete(self, key: str) -> bool:
+        return self.state.delete(self.PREFIX + key)
+
+    def __len__(self) -> int:
+        return self.state.count(self.PREFIX)
+
+
+def create_session_store_from_env(state: Optional[SharedState] = None) -> SessionStore:
+    """
+    Crea l'archivio delle sessioni configurato con le variabili d'ambiente
+
+        SESSION_STORE: "memory" (default), "sqlite" oppure "shared" (stato condiviso state)
+        SESSION_MAX_ENTRIES: numero massimo di sessioni (default 1000)
+        SESSION_TTL: secondi di inattività prima della scadenza (default 86400)
+        SESSION_STORE_PATH: file del database SQLite (default sessions.sqlite3)
+    """
+    backend = os.getenv("SESSION_STORE", "memory").lower()
+    max_entries = int(os.getenv("SESSION_MAX_ENTRIES", "1000"))
+    ttl = float(os.getenv("SESSION_TTL", "86400"))
+
+    if backend == "memory":
+        return MemorySessionStore(max_entries=max_entries, ttl=ttl)
+    if backend == "sqlite":
+        path = os.getenv("SESSION_STORE_PATH", "sessions.sqlite3")
+        return SQLiteSessionStore(path=path, max_entries=max_entries, ttl=ttl)
+    if backend == "shared":
+        if state is None:
+            raise ValueError("SESSION_STORE=shared richiede lo stato condiviso (vedi SHARED_STATE)")
+        return SharedSessionStore(state, max_entries=max_entries, ttl=ttl)
+    raise ValueError(f"SESSION_STORE non valido: {backend!r} (usa memory, sqlite o shared)")
@@ -0,0 +1,471 @@
+"""
+Stato condiviso tra i worker del server
+
+Con più worker (vedi serve.py) ogni processo ha la propria memoria: cache,
+rate limiter e contatori dei consumi devono quindi appoggiarsi a un archivio
+comune per restare coerenti. SharedState offre le poche primitive che servono:
+
+- chiave/valore con scadenza (cache delle risposte, sessioni)
+- contatori incrementali raggruppati per chiave (consumi per API key)
+- token bucket aggiornati in modo atomico (rate limiter)
+
+Backend disponibili: in-process (default, un solo worker), SQLite (più worker
+sulla stessa macchina) e Redis o compatibili (più macchine; richiede il
+pacchetto opzionale redis).
+
+I backend SQLite e Redis fanno I/O sincrono (un lock SQLite può attendere fino
+a 30 secondi): dal codice asincrono le primitive vanno chiamate con
+``await state.run(state.metodo, ...)``, che le esegue in un thread e lascia
+libero l'event loop. Lo stato in memoria viene eseguito direttamente.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional, Dict, Any, Iterable, Callable, TypeVar
+
+
+T = TypeVar("T")
+
+
+# Un bucket è un dizionario con capacity (limite al minuto), tokens, updated_at e
+# blocked_until (timestamp time.time(), confrontabili tra processi diversi).
+# La ricarica è sempre capacity / 60 token al secondo.
+
+def _new_bucket(capacity: float, now: float) -> Dict[str, float]:
+    return {"capacity": capacity, "tokens": capacity, "updated_at": now, "blocked_until": 0.0}
+
+
+def _refill(bucket: Dict[str, float], now: float) -> None:
+    elapsed = max(0.0, now - bucket["updated_at"])
+    bucket["tokens"] = min(bucket["capacity"], bucket["tokens"] + elapsed * bucket["capacity"] / 60.0)
+    bucket["updated_at"] = now
+
+
+def take_from_buckets(
+    buckets: list[Dict[str, float]], amounts: list[float], now: float
+) -> float:
+    """
+    Preleva amounts dai bucket solo se tutti hanno capienza sufficiente
+
+    Returns:
+        0 se il prelievo è avvenuto, altrimenti i secondi da attendere (nessun prelievo)
+    """
+    wait = 0.0
+    for bucket, amount in zip(buckets, amounts):
+        _refill(bucket, now)
+        amount = min(amount, bucket["capacity"])
+        blocked = max(0.0, bucket["blocked_until"] - now)
+        if bucket["tokens"] >= amount:
+            wait = max(wait, blocked)
+        else:
+            wait = max(wait, blocked, (amount - bucket["tokens"]) / (bucket["capacity"] / 60.0))
+    if wait <= 0:
+        for bucket, amount in zip(buckets, amounts):
+            bucket["tokens"] -= min(amount, bucket["capacity"])
+    return wait
+
+
+def update_bucket(
+    bucket: Dict[str, float],
+    limit: Optional[float],
+    remaining: Optional[float],
+    reset_in: Optional[float],
+    now: float
+) -> None:
+    """Allinea un bucket al limite e al saldo riportati dal provider"""
+    if limit is not None and limit != bucket["capacity"]:
+        bucket["capacity"] = limit
+        bucket["tokens"] = min(bucket["tokens"], limit)
+    if remaining is not None:
+        _refill(bucket, now)
+        bucket["tokens"] = min(bucket["tokens"], remaining)
+        if remaining <= 0 and reset_in:
+            bucket["blocked_until"] = now + reset_in
+
+
+class SharedState:
+    """Interfaccia comune dei backend di stato condiviso"""
+
+    # False se lo stato vive nella memoria del processo (non condiviso tra worker)
+    shared = True
+    # False se le primitive non fanno I/O e possono girare direttamente nell'event loop
+    blocking = True
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        """Esegue una primitiva dello stato senza bloccare l'event loop"""
+        if not self.blocking:
+            return func(*args)
+        return await asyncio.to_thread(func, *args)
+
+    def get(self, key: str) -> Optional[str]:
+        """Valore della chiave, None se assente o scaduta"""
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        """Imposta il valore, con scadenza opzionale in secondi"""
+        raise NotImplementedError
+
+    def delete(self, key: str) -> bool:
+        """Elimina la chiave; False se non esisteva"""
+        raise NotImplementedError
+
+    def keys(self, prefix: str) -> list[str]:
+        """Chiavi (non scadute) che iniziano con prefix"""
+        raise NotImplementedError
+
+    def count(self, prefix: str) -> int:
+        return len(self.keys(prefix))
+
+    def incr(self, key: str, fields: Dict[str, int]) -> None:
+        """Incrementa i contatori indicati del gruppo key"""
+        raise NotImplementedError
+
+    def counters(self, prefix: str) -> Dict[str, Dict[str, int]]:
+        """Tutti i gruppi di contatori le cui chiavi iniziano con prefix"""
+        raise NotImplementedError
+
+    def take_tokens(self, requests: list[tuple[str, float, float]]) -> float:
+        """
+        Prelievo atomico da più token bucket
+
+        Args:
+            requests: Terne (chiave del bucket, capacità iniziale, quantità)
+
+        Returns:
+            0 se il prelievo è avvenuto, altrimenti i secondi da attendere
+        """
+        raise NotImplementedError
+
+    def update_bucket(
+        self,
+        key: str,
+        capacity: float,
+        limit: Optional[float],
+        remaining: Optional[float],
+        reset_in: Optional[float]
+    ) -> None:
+        """Aggiorna un bucket con limite e saldo riportati dal provider"""
+        raise NotImplementedError
+
+    def bucket(self, key: str) -> Optional[Dict[str, float]]:
+        """Stato attuale (ricaricato) di un bucket, None se non esiste"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Rilascia le risorse del backend (se presenti)"""
+
+
+class InProcessState(SharedState):
+    """Stato nella memoria del processo: coerente solo con un singolo worker"""
+
+    shared = False
+    blocking = False
+
+    def __init__(self):
+        self._values: Dict[str, tuple[Optional[float], str]] = {}
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self._buckets: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def _alive(self, key: str, now: float) -> bool:
+        entry = self._values.get(key)
+        if entry is None:
+            return False
+        if entry[0] is not None and entry[0] < now:
+            del self._values[key]
+            return False
+        return True
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._values[key][1] if self._alive(key, time.time()) else None
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._values[key] = (time.time() + ttl if ttl else None, value)
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._values.pop(key, None) is not None
+
+    def keys(self, prefix: str) -> list[str]:
+        now = time.time()
+        with self._lock:
+            return [key for key in list(self._values) if key.startswith(prefix) and self._alive(key, now)]
+
+    def incr(self, key: str, fields: Dict[str, int]) -> None:
+        with self._lock:
+            group = self._counters.setdefault(key, {})
+            for field, amount in fields.items():
+                group[field] = group.get(field, 0) + amount
+
+    def counters(self, prefix: str) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {key: dict(group) for key, group in self._counters.items() if key.startswith(prefix)}
+
+    def take_tokens(self, requests: list[tuple[str, float, float]]) -> float:
+        now = time.time()
+        with self._lock:
+            buckets = [
+                self._buckets.setdefault(key, _new_bucket(capacity, now))
+                for key, capacity, _ in requests
+            ]
+            return take_from_buckets(buckets, [amount for _, _, amount in requests], now)
+
+    def update_bucket(self, key, capacity, limit, remaining, reset_in) -> None:
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.setdefault(key, _new_bucket(capacity, now))
+            update_bucket(bucket, limit, remaining, reset_in, now)
+
+    def bucket(self, key: str) -> Optional[Dict[str, float]]:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                return None
+            _refill(bucket, time.time())
+            return dict(bucket)
+
+
+class SQLiteState(SharedState):
+    """Stato in un database SQLite: condiviso dai worker sulla stessa macchina"""
+
+    def __init__(self, path: str = "shared_state.sqlite3"):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS counters ("
+            " key TEXT NOT NULL, field TEXT NOT NULL, value INTEGER NOT NULL,"
+            " PRIMARY KEY (key, field))"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._writes = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)",
+                (key, time.time())
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, now + ttl if ttl else None)
+            )
+            # Pulizia periodica delle chiavi scadute
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._conn.execute("DELETE FROM kv WHERE expires_at < ?", (now,))
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._conn.execute("DELETE FROM kv WHERE key = ?", (key,)).rowcount > 0
+
+    def keys(self, prefix: str) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key FROM kv WHERE substr(key, 1, ?) = ? AND (expires_at IS NULL OR expires_at >= ?)",
+                (len(prefix), prefix, time.time())
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def count(self, prefix: str) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM kv WHERE substr(key, 1, ?) = ? AND (expires_at IS NULL OR expires_at >= ?)",
+                (len(prefix), prefix, time.time())
+            ).fetchone()[0]
+
+    def incr(self, key: str, fields: Dict[str, int]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO counters (key, field, value) VALUES (?, ?, ?)"
+                " ON CONFLICT (key, field) DO UPDATE SET value = value + excluded.value",
+                [(key, field, amount) for field, amount in fields.items()]
+            )
+
+    def counters(self, prefix: str) -> Dict[str, Dict[str, int]]:
+        groups: Dict[str, Dict[str, int]] = {}
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, field, value FROM counters WHERE substr(key, 1, ?) = ?",
+                (len(prefix), prefix)
+            ).fetchall()
+        for key, field, value in rows:
+            groups.setdefault(key, {})[field] = value
+        return groups
+
+    def _transaction_buckets(self, keys: Iterable[str], capacities: Iterable[float], update) -> Any:
+        """Legge, modifica con update(buckets, now) e riscrive i bucket in una transazione esclusiva"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                buckets = []
+                for key, capacity in zip(keys, capacities):
+                    row = self._conn.execute("SELECT value FROM buckets WHERE key = ?", (key,)).fetchone()
+                    buckets.append(json.loads(row[0]) if row else _new_bucket(capacity, now))
+                result = update(buckets, now)
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO buckets (key, value) VALUES (?, ?)",
+                    [(key, json.dumps(bucket)) for key, bucket in zip(keys, buckets)]
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def take_tokens(self, requests: list[tuple[str, float, float]]) -> float:
+        return self._transaction_buckets(
+            [key for key, _, _ in requests],
+            [capacity for _, capacity, _ in requests],
+            lambda buckets, now: take_from_buckets(buckets, [amount for _, _, amount in requests], now)
+        )
+
+    def update_bucket(self, key, capacity, limit, remaining, reset_in) -> None:
+        self._transaction_buckets(
+            [key], [capacity],
+            lambda buckets, now: update_bucket(buckets[0], limit, remaining, reset_in, now)
+        )
+
+    def bucket(self, key: str) -> Optional[Dict[str, float]]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM buckets WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        bucket = json.loads(row[0])
+        _refill(bucket, time.time())
+        return bucket
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class RedisState(SharedState):
+    """
+    Stato su Redis (o un server compatibile, es. Valkey o KeyDB)
+
+    I bucket sono aggiornati con transazioni ottimistiche (WATCH/MULTI),
+    ritentate al massimo max_retries volte in caso di conflitto.
+    """
+
+    def __init__(
+        self,
+        url: str = "redis://localhost:6379/0",
+        namespace: str = "aiapi:",
+        max_retries: int = 50
+    ):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("SHARED_STATE=redis richiede il pacchetto redis (pip install redis)") from e
+        self._redis = redis
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+        self.namespace = namespace
+        self.max_retries = max_retries
+
+    def _key(self, key: str) -> str:
+        return self.namespace + key
+
+    def get(self, key: str) -> Optional[str]:
+        return self._client.get(self._key(key))
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        self._client.set(self._key(key), value, px=int(ttl * 1000) if ttl else None)
+
+    def delete(self, key: str) -> bool:
+        return self._client.delete(self._key(key)) > 0
+
+    def keys(self, prefix: str) -> list[str]:
+        start = len(self.namespace)
+        return [key[start:] for key in self._client.scan_iter(match=self._key(prefix) + "*", count=500)]
+
+    def incr(self, key: str, fields: Dict[str, int]) -> None:
+        pipeline = self._client.pipeline()
+        for field, amount in fields.items():
+            pipeline.hincrby(self._key("counters:" + key), field, amount)
+        pipeline.execute()
+
+    def counters(self, prefix: str) -> Dict[str, Dict[str, int]]:
+        start = len(self._key("counters:"))
+        return {
+            key[start:]: {field: int(value) for field, value in self._client.hgetall(key).items()}
+            for key in self._client.scan_iter(match=self._key("counters:" + prefix) + "*", count=500)
+        }
+
+    def _transaction_buckets(self, keys: list[str], capacities: list[float], update) -> Any:
+        redis_keys = [self._key("bucket:" + key) for key in keys]
+        with self._client.pipeline() as pipeline:
+            for _ in range(self.max_retries + 1):
+                try:
+                    pipeline.watch(*redis_keys)
+                    now = time.time()
+                    buckets = []
+                    for key, capacity in zip(redis_keys, capacities):
+                        value = pipeline.get(key)
+                        buckets.append(json.loads(value) if value else _new_bucket(capacity, now))
+                    result = update(buckets, now)
+                    pipeline.multi()
+                    for key, bucket in zip(redis_keys, buckets):
+                        # I bucket inattivi da un'ora scadono (si ricreano pieni)
+                        pipeline.set(key, json.dumps(bucket), ex=3600)
+                    pipeline.execute()
+                    return result
+                except self._redis.WatchError:
+                    continue
+        raise RuntimeError(f"Troppi conflitti aggiornando i bucket {keys} ({self.max_retries} tentativi)")
+
+    def take_tokens(self, requests: list[tuple[str, float, float]]) -> float:
+        return self._transaction_buckets(
+            [key for key, _, _ in requests],
+            [capacity for _, capacity, _ in requests],
+            lambda buckets, now: take_from_buckets(buckets, [amount for _, _, amount in requests], now)
+        )
+
+    def update_bucket(self, key, capacity, limit, remaining, reset_in) -> None:
+        self._transaction_buckets(
+            [key], [capacity],
+            lambda buckets, now: update_bucket(buckets[0], limit, remaining, reset_in, now)
+        )
+
+    def bucket(self, key: str) -> Optional[Dict[str, float]]:
+        value = self._client.get(self._key("bucket:" + key))
+        if value is None:
+            return None
+        bucket = json.loads(value)
+        _refill(bucket, time.time())
+        return bucket
+
+    def close(self) -> None:
+        self._client.close()
+
+
+def create_shared_state_from_env() -> SharedState:
+    """
+    Crea lo stato condiviso configurato con le variabili d'ambiente
+
+        SHARED_STATE: "memory" (default, un solo worker), "sqlite" oppure "redis"
+        SHARED_STATE_PATH: file del database SQLite (default shared_state.sqlite3)
+        SHARED_STATE_URL: URL di Redis (default redis://localhost:6379/0)
+    """
+    backend = os.getenv("SHARED_STATE", "memory").lower()
+    if backend == "memory":
+        return InProcessState()
+    if backend == "sqlite":
+        return SQLiteState(os.getenv("SHARED_STATE_PATH", "shared_state.sqlite3"))
+    if backend == "redis":
+        return RedisState(os.getenv("SHARED_STATE_URL", "redis://localhost:6379/0"))
+    raise ValueError(f"SHARED_STATE non valido: {backend!r} (usa memory, sqlite o redis)")
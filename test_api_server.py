@@ -3,9 +3,19 @@ Script di test per verificare gli endpoint dell'API server
 """
 
 import requests
+import json
 import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Iterator, Union
 from dotenv import load_dotenv
 
+from auth import hash_key
+
 # Carica variabili d'ambiente
 load_dotenv()
 
@@ -17,6 +27,10 @@ HEADERS = {
     "Content-Type": "application/json"
 }
 
+# Porte del provider simulato e dell'API server avviati dai test con una configurazione dedicata
+LOCAL_MOCK_PORT = int(os.getenv("TEST_MOCK_PORT", "9101"))
+LOCAL_SERVER_PORT = int(os.getenv("TEST_SERVER_PORT", "8101"))
+
 
 def test_health():
     """Test endpoint health check"""
@@ -109,6 +123,83 @@ def test_compare():
         return False
 
 
+def test_claude_chat_stream():
+    """Test endpoint Claude chat in streaming (SSE)"""
+    print("\n🔍 Test: Claude Chat Stream")
+    data = {
+        "prompt": "Conta da 1 a 5",
+        "thinking": False
+    }
+    response = requests.post(
+        f"{BASE_URL}/claude/chat/stream",
+        json=data,
+        headers=HEADERS,
+        stream=True
+    )
+    print(f"Status: {response.status_code}")
+    if response.status_code != 200:
+        print(f"Error: {response.text}")
+        return False
+
+    events = []
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event: "):
+            events.append(line[len("event: "):])
+    print(f"Eventi ricevuti: {len(events)} (ultimo: {events[-1] if events else None})")
+    return bool(events) and events[-1] == "done"
+
+
+def test_batch():
+    """Test endpoint batch (più prompt in una sola richiesta)"""
+    print("\n🔍 Test: Batch")
+    data = {
+        "items": [
+            {"provider": "openai", "prompt": "Cos'è JSON? Una frase.", "temperature": 0},
+            {"provider": "claude", "prompt": "Cos'è YAML? Una frase.", "temperature": 0},
+        ],
+        "concurrency": 2
+    }
+    response = requests.post(
+        f"{BASE_URL}/batch",
+        json=data,
+        headers=HEADERS
+    )
+    print(f"Status: {response.status_code}")
+    if response.status_code == 200:
+        result = response.json()
+        print(f"Riusciti: {result['succeeded']}, falliti: {result['failed']}")
+        for item in result["results"]:
+            print(f"[{item['index']}] {item['provider']}: {item['error'] or item['result']['response'][:60]}")
+        return result["failed"] == 0
+    else:
+        print(f"Error: {response.text}")
+        return False
+
+
+def test_session():
+    """Test sessione di conversazione (il server conserva la storia)"""
+    print("\n🔍 Test: Session")
+    session_url = f"{BASE_URL}/sessions/test-session"
+    requests.delete(session_url, headers=HEADERS)
+
+    turns = ["Ciao! Mi chiamo Marco.", "Come mi chiamo? Rispondi con una parola."]
+    for prompt in turns:
+        response = requests.post(
+            f"{session_url}/messages",
+            json={"prompt": prompt, "provider": "claude", "max_tokens": 200},
+            headers=HEADERS
+        )
+        print(f"Status: {response.status_code}")
+        if response.status_code != 200:
+            print(f"Error: {response.text}")
+            return False
+        result = response.json()
+        print(f"Turni in storia: {result['turns']}, risposta: {result['response'][:80]}")
+
+    requests.delete(session_url, headers=HEADERS)
+    return result["turns"] == 2 and "Marco" in result["response"]
+
+
 def test_unauthorized():
     """Test che l'autenticazione funzioni"""
     print("\n🔍 Test: Unauthorized Access")
@@ -127,6 +218,466 @@ def test_unauthorized():
         return False
 
 
+# Test con server locale: ognuno avvia mock_provider.py e un API server configurato
+# apposta (chiavi, quote, limiti), senza chiamare i provider reali
+
+def _wait_ready(url: str, timeout: float = 30.0) -> None:
+    """Attende che GET url risponda 200"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} non risponde dopo {timeout:.0f}s")
+
+
+class LocalServer:
+    """API server avviato da local_server, con le richieste usate dai test"""
+
+    def __init__(self, url: str, directory: str):
+        self.url = url
+        # File delle chiavi (AUTH_KEYS_PATH) del server; riscriverlo simula una modifica a caldo
+        self.keys_path = os.path.join(directory, "api_keys.json")
+
+    def request(self, method: str, path: str, key: Optional[str] = API_KEY, **kwargs: Any) -> requests.Response:
+        headers = dict(kwargs.pop("headers", {}))
+        if key is not None:
+            headers["Authorization"] = f"Bearer {key}"
+        return requests.request(method, f"{self.url}{path}", headers=headers, timeout=60, **kwargs)
+
+    def get(self, path: str, key: Optional[str] = API_KEY, **kwargs: Any) -> requests.Response:
+        return self.request("GET", path, key, **kwargs)
+
+    def post(self, path: str, key: Optional[str] = API_KEY, **kwargs: Any) -> requests.Response:
+        return self.request("POST", path, key, **kwargs)
+
+    def chat(self, provider: str = "openai", key: Optional[str] = API_KEY, **fields: Any) -> requests.Response:
+        """POST /{provider}/chat con un prompt di prova (fields sostituisce i campi della richiesta)"""
+        return self.post(f"/{provider}/chat", key, json={"prompt": "Ciao", **fields})
+
+    def stream(self, path: str, key: Optional[str] = API_KEY, **fields: Any) -> tuple[requests.Response, list[str]]:
+        """POST di uno stream SSE: la risposta e i tipi degli eventi ricevuti"""
+        response = self.post(path, key, json={"prompt": "Conta da 1 a 5", **fields}, stream=True)
+        return response, sse_events(response)
+
+    def write_keys(self, keys: Union[list[Dict[str, Any]], str]) -> None:
+        """Scrive il file delle chiavi (una lista di chiavi, oppure il contenuto grezzo)"""
+        with open(self.keys_path, "w", encoding="utf-8") as f:
+            f.write(keys if isinstance(keys, str) else json.dumps({"keys": keys}))
+
+
+def sse_events(response: requests.Response) -> list[str]:
+    """Tipi degli eventi di uno stream Server-Sent Events, in ordine"""
+    return [
+        line[len("event: "):]
+        for line in response.iter_lines(decode_unicode=True)
+        if line.startswith("event: ")
+    ]
+
+
+@contextmanager
+def local_server(
+    env: Optional[Dict[str, str]] = None,
+    mock_env: Optional[Dict[str, str]] = None,
+    keys: Optional[Union[list[Dict[str, Any]], str]] = None
+) -> Iterator[LocalServer]:
+    """
+    Avvia il provider simulato e un API server (un worker) che lo usa
+
+    Args:
+        env: Variabili d'ambiente aggiuntive dell'API server
+        mock_env: Variabili MOCK_* del provider simulato (vedi mock_provider.py)
+        keys: Contenuto iniziale del file delle chiavi (None = solo CUSTOM_GPT_API_KEY);
+            il file viene ricaricato ogni 0.1s
+
+    Yields:
+        Il server avviato
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    mock_url = f"http://127.0.0.1:{LOCAL_MOCK_PORT}"
+    with tempfile.TemporaryDirectory() as tmp:
+        server = LocalServer(f"http://127.0.0.1:{LOCAL_SERVER_PORT}", tmp)
+        server_env = {
+            **os.environ,
+            # Stato pulito: niente consumi, job, cache o chiavi salvati su disco
+            "USAGE_DB_PATH": "",
+            "BATCH_JOBS_PATH": "",
+            "BATCH_POLL_INTERVAL": "0",
+            "RESPONSE_CACHE": "off",
+            "AUTH": "on",
+            "AUTH_KEYS_PATH": "",
+            "CUSTOM_GPT_API_KEY": API_KEY,
+            "OPENAI_BASE_URL": f"{mock_url}/v1",
+            "ANTHROPIC_BASE_URL": mock_url,
+            "OPENAI_API_KEY": "mock",
+            "ANTHROPIC_API_KEY": "mock",
+        }
+        if keys is not None:
+            server.write_keys(keys)
+            server_env.update({"AUTH_KEYS_PATH": server.keys_path, "AUTH_RELOAD_INTERVAL": "0.1"})
+
+        processes = [subprocess.Popen(
+            [sys.executable, os.path.join(here, "mock_provider.py"), "--port", str(LOCAL_MOCK_PORT)],
+            env={**os.environ, "MOCK_LATENCY": "0.05", "MOCK_JITTER": "0", "MOCK_TOKEN_INTERVAL": "0",
+                 **(mock_env or {})}
+        )]
+        try:
+            processes.append(subprocess.Popen(
+                [
+                    sys.executable, os.path.join(here, "serve.py"),
+                    "--host", "127.0.0.1",
+                    "--port", str(LOCAL_SERVER_PORT),
+                    "--workers", "1",
+                    "--log-level", "warning",
+                ],
+                cwd=here,
+                env={**server_env, **(env or {})}
+            ))
+            _wait_ready(f"{mock_url}/health")
+            _wait_ready(f"{server.url}/health")
+            yield server
+        finally:
+            for process in reversed(processes):
+                process.terminate()
+            for process in processes:
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+
+def _statuses(*responses: requests.Response) -> list[int]:
+    return [response.status_code for response in responses]
+
+
+def test_api_keys():
+    """Test chiavi da file: valida, sconosciuta e revocata dopo il ricaricamento del file"""
+    print("\n🔍 Test: API Keys (valida, sconosciuta, revocata)")
+    key = "sk-test-valid"
+    with local_server(keys=[{"id": "tester", "hash": hash_key(key)}]) as server:
+        valid = server.chat(key=key)
+        unknown = server.chat(key="sk-test-unknown")
+        server.write_keys([{"id": "tester", "hash": hash_key(key), "disabled": True}])
+        time.sleep(0.5)
+        revoked = server.chat(key=key)
+    print(f"Valida, sconosciuta, revocata: {_statuses(valid, unknown, revoked)}")
+    return _statuses(valid, unknown, revoked) == [200, 401, 401]
+
+
+def test_key_quota():
+    """Test quota di token al minuto di una chiave (429 con Retry-After oltre la quota)"""
+    print("\n🔍 Test: Key Quota")
+    key = "sk-test-quota"
+    with local_server(keys=[{"id": "limited", "hash": hash_key(key), "tokens_per_minute": 1000}]) as server:
+        # Ogni richiesta riserva circa 800 token stimati: la seconda supera la quota
+        first = server.chat(key=key, max_tokens=800)
+        second = server.chat(key=key, max_tokens=800)
+    print(f"Status: {_statuses(first, second)}, Retry-After: {second.headers.get('Retry-After')}")
+    return _statuses(first, second) == [200, 429] and "Retry-After" in second.headers
+
+
+def test_corrupt_key_file():
+    """Test file delle chiavi illeggibile all'avvio: il server rifiuta tutto (503) finché non viene corretto"""
+    print("\n🔍 Test: Corrupt Key File")
+    key = "sk-test-valid"
+    with local_server(keys='{"keys": [') as server:
+        corrupt = server.chat(key=key)
+        legacy = server.chat()
+        server.write_keys([{"id": "tester", "hash": hash_key(key)}])
+        time.sleep(0.5)
+        fixed = server.chat(key=key)
+    print(f"File corrotto, chiave singola, file corretto: {_statuses(corrupt, legacy, fixed)}")
+    return _statuses(corrupt, legacy, fixed) == [503, 503, 200]
+
+
+def test_rate_limit():
+    """Test rate limiter: oltre il budget del provider la richiesta viene rifiutata con 429"""
+    print("\n🔍 Test: Rate Limit")
+    env = {"RATE_LIMIT": "on", "OPENAI_RPM": "1", "RATE_LIMIT_MAX_WAIT": "0"}
+    # Il provider simulato dichiara anche lui 1 richiesta al minuto negli header di rate limit
+    with local_server(env, {"MOCK_RPM": "1"}) as server:
+        first = server.chat()
+        second = server.chat()
+        stats = server.get("/rate-limits").json()
+    print(f"Status: {_statuses(first, second)}, Retry-After: {second.headers.get('Retry-After')}")
+    print(f"Rifiuti: {stats.get('rejections')}")
+    return (
+        _statuses(first, second) == [200, 429]
+        and "Retry-After" in second.headers
+        and stats.get("rejections", 0) >= 1
+    )
+
+
+def test_circuit_breaker():
+    """Test retry e circuit breaker: un provider che fallisce sempre apre il circuito (503)"""
+    print("\n🔍 Test: Retry e Circuit Breaker")
+    env = {
+        "RETRY_MAX_RETRIES": "1",
+        "RETRY_BASE_DELAY": "0.01",
+        "RETRY_MAX_DELAY": "0.05",
+        "CIRCUIT_FAILURE_THRESHOLD": "2",
+        "CIRCUIT_COOLDOWN": "60",
+        "HEDGING": "off",
+    }
+    with local_server(env, {"MOCK_ERROR_RATE": "1", "MOCK_ERROR_STATUS": "500"}) as server:
+        # Primo tentativo e retry falliscono: il secondo errore consecutivo apre il circuito
+        failed = server.chat()
+        rejected = server.chat()
+        stats = server.get("/resilience").json()
+    circuit = stats.get("circuits", {}).get("openai", {})
+    print(f"Status: {_statuses(failed, rejected)}, Retry-After: {rejected.headers.get('Retry-After')}")
+    print(f"Retry: {stats.get('retries')}, circuito: {circuit}")
+    return (
+        _statuses(failed, rejected) == [500, 503]
+        and "Retry-After" in rejected.headers
+        and stats.get("retries", 0) >= 1
+        and circuit.get("state") == "open"
+    )
+
+
+def test_compression():
+    """Test negoziazione della compressione: gzip se accettato, niente con identity o risposte piccole"""
+    print("\n🔍 Test: Compression")
+    with local_server() as server:
+        gzip = server.get("/openapi.json", None, headers={"Accept-Encoding": "gzip"})
+        identity = server.get("/openapi.json", None, headers={"Accept-Encoding": "identity"})
+        small = server.get("/health", None, headers={"Accept-Encoding": "gzip"})
+        # Gli stream sono sempre compressi, evento per evento
+        stream = server.post(
+            "/openai/chat/stream", json={"prompt": "Conta da 1 a 5"},
+            headers={"Accept-Encoding": "gzip"}, stream=True
+        )
+        events = sse_events(stream)
+    encodings = [r.headers.get("Content-Encoding") for r in (gzip, identity, small, stream)]
+    print(f"Content-Encoding (gzip, identity, /health, stream): {encodings}")
+    print(f"Eventi dello stream: {len(events)} (ultimo: {events[-1] if events else None})")
+    # requests decomprime in modo trasparente: i corpi devono restare identici
+    return (
+        encodings == ["gzip", None, None, "gzip"]
+        and gzip.json() == identity.json()
+        and bool(events) and events[-1] == "done"
+    )
+
+
+def test_admission():
+    """Test scarto del carico: oltre la concorrenza ammessa e senza coda si risponde 503"""
+    print("\n🔍 Test: Admission")
+    env = {"ADMISSION_MAX_CONCURRENCY": "1", "ADMISSION_QUEUE_SIZE": "0"}
+    # Risposte lente del provider: le richieste concorrenti trovano lo slot occupato
+    with local_server(env, {"MOCK_LATENCY": "1"}) as server:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            responses = list(executor.map(lambda _: server.chat(), range(4)))
+    statuses = sorted(_statuses(*responses))
+    shed = [r for r in responses if r.status_code == 503]
+    print(f"Status: {statuses}, Retry-After: {[r.headers.get('Retry-After') for r in shed]}")
+    return (
+        200 in statuses
+        and bool(shed)
+        and set(statuses) <= {200, 503}
+        and all("Retry-After" in r.headers for r in shed)
+    )
+
+
+def test_claude_paths():
+    """Test Claude sul provider simulato: chat, stream con ragionamento riassunto, /compare e sessioni"""
+    print("\n🔍 Test: Claude, Compare e Sessioni")
+    with local_server() as server:
+        chat = server.chat("claude", thinking=True)
+        stream, events = server.stream("/claude/chat/stream", thinking=True, include_thinking="summary")
+        compare = server.post("/compare", json={"prompt": "Ciao"})
+        turns = [
+            server.post("/sessions/local/messages", json={"prompt": prompt, "provider": "claude"})
+            for prompt in ("Mi chiamo Marco.", "Come mi chiamo?")
+        ]
+    print(f"Chat, stream, compare, sessione: {_statuses(chat, stream, compare, *turns)}")
+    if _statuses(chat, stream, compare, *turns) != [200] * 5:
+        return False
+    result, comparison, session = chat.json(), compare.json(), turns[-1].json()
+    print(f"Modello: {result['model']}, ragionamento: {bool(result['thinking'])}, usage: {result['usage']}")
+    print(f"Eventi dello stream: {events}")
+    print(f"Compare: {comparison['openai_model']} / {comparison['claude_model']}, sessione: {session['turns']} turni")
+    return (
+        result["model"].startswith("claude")
+        and bool(result["thinking"])
+        and result["usage"]["output_tokens"] > 0
+        # Con include_thinking="summary" i delta del ragionamento diventano un solo evento
+        and events.count("thinking") == 1
+        and events[-1] == "done"
+        and not comparison["openai_error"] and not comparison["claude_error"]
+        and session["turns"] == 2 and session["history_tokens"] > 0
+    )
+
+
+def test_response_cache():
+    """Test cache delle risposte: la seconda richiesta identica è marcata cached e non consuma token"""
+    print("\n🔍 Test: Response Cache")
+    with local_server({"RESPONSE_CACHE": "memory"}) as server:
+        # Solo le richieste con temperature=0 sono in cache
+        first = server.chat(temperature=0)
+        second = server.chat(temperature=0)
+        total = server.get("/usage").json()["total"]
+    print(f"Status: {_statuses(first, second)}")
+    if _statuses(first, second) != [200, 200]:
+        return False
+    usage, cached = first.json()["usage"], second.json()["usage"]
+    print(f"Usage: {usage} / {cached}, totale /usage: {total}")
+    return (
+        not usage["cached"] and cached["cached"]
+        and total["requests"] == 2
+        and total["input_tokens"] == usage["input_tokens"]
+        and total["output_tokens"] == usage["output_tokens"]
+    )
+
+
+def test_router_fallback():
+    """Test fallback del router: se il primo modello della rotta fallisce risponde il successivo"""
+    print("\n🔍 Test: Router Fallback")
+    with tempfile.TemporaryDirectory() as tmp:
+        routes = os.path.join(tmp, "model_routes.json")
+        with open(routes, "w", encoding="utf-8") as f:
+            json.dump({"routes": {"openai": ["openai/gpt-broken", "openai/gpt-4o"]}}, f)
+        env = {"MODEL_ROUTES_PATH": routes, "RETRY_MAX_RETRIES": "0", "HEDGING": "off"}
+        with local_server(env, {"MOCK_ERROR_MODELS": "gpt-broken"}) as server:
+            # Prima lo stream, quando gpt-broken è ancora il primo candidato: deve passare al
+            # successivo se il primo fallisce prima del primo evento
+            stream = server.post("/openai/chat/stream", json={"prompt": "Ciao"}, stream=True)
+            done = [
+                json.loads(line[len("data: "):])
+                for line in stream.iter_lines(decode_unicode=True)
+                if line.startswith("data: ") and '"done"' in line
+            ]
+            chat = server.chat()
+            routing = server.get("/routing").json()
+    print(f"Status: {_statuses(stream, chat)}, fallback: {routing.get('fallbacks')}")
+    if _statuses(stream, chat) != [200, 200]:
+        return False
+    print(f"Modello chat: {chat.json()['model']}, modello stream: {done[-1]['model'] if done else None}")
+    return (
+        chat.json()["model"] == "gpt-4o"
+        and bool(done) and done[-1]["model"] == "gpt-4o"
+        and routing.get("fallbacks", 0) >= 1
+    )
+
+
+def _metric_total(text: str, name: str, **labels: str) -> float:
+    """Somma dei campioni di una metrica Prometheus con le etichette indicate"""
+    total = 0.0
+    for line in text.splitlines():
+        if line.startswith(f"{name}{{") and all(f'{k}="{v}"' in line for k, v in labels.items()):
+            total += float(line.rsplit(" ", 1)[1])
+    return total
+
+
+def test_client_disconnect():
+    """Test disconnessione del client: chiamata al provider annullata, slot liberati e stato 499"""
+    print("\n🔍 Test: Client Disconnect")
+    key = "sk-test-admin"
+    # Una sola richiesta concorrente per la chiave: se lo slot non venisse liberato la successiva avrebbe 429
+    keys = [{"id": "ops", "hash": hash_key(key), "admin": True, "max_concurrency": 1}]
+    # Stream lento (circa 40s): viene chiuso dopo il primo evento di testo
+    mock_env = {"MOCK_TOKEN_INTERVAL": "0.2", "MOCK_OUTPUT_TOKENS": "200"}
+    with local_server(mock_env=mock_env, keys=keys) as server:
+        stream = server.post(
+            "/claude/chat/stream", key, json={"prompt": "Conta fino a 200"},
+            headers={"Accept-Encoding": "identity"}, stream=True
+        )
+        for line in stream.iter_lines(decode_unicode=True):
+            if line == "event: text":
+                break
+        stream.close()
+        time.sleep(1)
+
+        admission = server.get("/admission", key).json()
+        text = server.get("/metrics", None).text
+        after = server.chat("claude", key=key)
+    disconnects = _metric_total(text, "aiapi_http_requests_total", route="/claude/chat/stream", status="499")
+    cancelled = _metric_total(text, "aiapi_upstream_cancelled_total", provider="claude")
+    print(f"Stream: {stream.status_code}, richiesta successiva: {after.status_code}")
+    print(f"Slot occupati: {admission.get('active_total')}, 499: {disconnects}, chiamate annullate: {cancelled}")
+    return (
+        stream.status_code == 200
+        and admission.get("active_total") == 0
+        and disconnects >= 1
+        and cancelled >= 1
+        and after.status_code == 200
+    )
+
+
+def _wait_job(server: LocalServer, job_id: str, key: str, timeout: float = 20.0) -> Dict[str, Any]:
+    """Interroga GET /jobs/{id} finché il job non è concluso"""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = server.get(f"/jobs/{job_id}", key).json()
+        if job.get("status") in ("completed", "failed", "cancelled", "expired") or time.monotonic() > deadline:
+            return job
+        time.sleep(0.5)
+
+
+def test_batch_jobs():
+    """Test job batch: invio JSONL, attesa, download dei risultati, consumi, proprietà e annullamento"""
+    print("\n🔍 Test: Batch Jobs")
+    owner, other = "sk-test-owner", "sk-test-other"
+    keys = [{"id": "owner", "hash": hash_key(owner)}, {"id": "other", "hash": hash_key(other)}]
+    jsonl = "\n".join(json.dumps({"custom_id": f"q{i}", "prompt": f"Domanda {i}"}) for i in range(2))
+    headers = {"Content-Type": "application/x-ndjson"}
+    passed = True
+    with local_server(mock_env={"MOCK_BATCH_DURATION": "1"}, keys=keys) as server:
+        for provider in ("openai", "claude"):
+            created = server.post(f"/jobs?provider={provider}", owner, data=jsonl, headers=headers)
+            if created.status_code != 200:
+                print(f"{provider}: creazione fallita ({created.status_code}): {created.text}")
+                return False
+            job = _wait_job(server, created.json()["id"], owner)
+            hidden = server.get(f"/jobs/{job['id']}", other)
+            results = [
+                json.loads(line)
+                for line in server.get(f"/jobs/{job['id']}/results", owner).text.splitlines()
+                if line.strip()
+            ]
+
+            second = server.post(f"/jobs?provider={provider}", owner, data=jsonl, headers=headers).json()
+            cancelling = server.post(f"/jobs/{second['id']}/cancel", owner).json()
+            cancelled = _wait_job(server, second["id"], owner)
+
+            print(f"{provider}: stato {job['status']}, risultati {len(results)}, "
+                  f"altra chiave {hidden.status_code}, annullato {cancelling['status']} -> {cancelled['status']}")
+            passed = passed and (
+                job["status"] == "completed" and job["succeeded"] == 2
+                and sorted(r["custom_id"] for r in results) == ["q0", "q1"]
+                and all(r["response"] and r["usage"] and not r["error"] for r in results)
+                and hidden.status_code == 404
+                and cancelled["status"] == "cancelled"
+            )
+            # Token dei risultati scaricati, da ritrovare nei consumi della chiave
+            batch_tokens = sum(r["usage"]["output_tokens"] for r in results)
+            total = server.get("/usage", owner).json()["total"]
+            print(f"{provider}: token di output dei risultati {batch_tokens}, in /usage {total['output_tokens']}")
+            passed = passed and total["output_tokens"] >= batch_tokens > 0
+
+        listed = [job["id"] for job in server.get("/jobs", other).json()]
+    return passed and listed == []
+
+
+# Test con server locale, eseguiti dopo quelli sul server di BASE_URL
+LOCAL_TESTS = {
+    "API Keys": test_api_keys,
+    "Key Quota": test_key_quota,
+    "Corrupt Key File": test_corrupt_key_file,
+    "Rate Limit": test_rate_limit,
+    "Circuit Breaker": test_circuit_breaker,
+    "Compression": test_compression,
+    "Admission": test_admission,
+    "Claude e Compare": test_claude_paths,
+    "Response Cache": test_response_cache,
+    "Router Fallback": test_router_fallback,
+    "Client Disconnect": test_client_disconnect,
+    "Batch Jobs": test_batch_jobs,
+}
+
+
 def main():
     """Esegue tutti i test"""
     print("=" * 60)
@@ -164,6 +715,35 @@ def main():
         print(f"❌ Compare test failed: {e}")
         results["Compare Models"] = False
 
+    try:
+        results["Claude Chat Stream"] = test_claude_chat_stream()
+    except Exception as e:
+        print(f"❌ Claude stream test failed: {e}")
+        results["Claude Chat Stream"] = False
+
+    try:
+        results["Batch"] = test_batch()
+    except Exception as e:
+        print(f"❌ Batch test failed: {e}")
+        results["Batch"] = False
+
+    try:
+        results["Session"] = test_session()
+    except Exception as e:
+        print(f"❌ Session test failed: {e}")
+        results["Session"] = False
+
+    print("\n" + "=" * 60)
+    print(f"🧪 Test con provider simulato (porte {LOCAL_MOCK_PORT} e {LOCAL_SERVER_PORT})")
+    print("=" * 60)
+
+    for name, test in LOCAL_TESTS.items():
+        try:
+            results[name] = test()
+        except Exception as e:
+            print(f"❌ {name} test failed: {e}")
+            results[name] = False
+
     # Riepilogo
     print("\n" + "=" * 60)
     print("📊 Riepilogo Test")
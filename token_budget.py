@@ -0,0 +1,181 @@
+"""
+Stima locale dei token e controllo della finestra di contesto
+
+Prima di inviare una richiesta si stima quanti token occupa il prompt e si
+verifica che prompt, max_tokens e budget di ragionamento stiano nella finestra
+di contesto del modello. Le richieste troppo grandi vengono corrette
+(max_tokens e thinking_budget ridotti) oppure rifiutate subito, senza
+attendere l'errore del provider dopo un round-trip completo.
+
+La stima non usa i tokenizer ufficiali: conta parole e simboli con un rapporto
+caratteri/token calibrato per famiglia di modelli, ed è volutamente un po'
+pessimista. I conteggi dei testi già visti (system prompt, turni precedenti)
+sono tenuti in cache.
+"""
+
+import json
+import math
+import os
+import re
+from functools import lru_cache
+from typing import Optional, Dict, Any
+
+
+class ContextBudgetError(ValueError):
+    """La richiesta non può stare nella finestra di contesto del modello"""
+
+    def __init__(self, message: str, model: str, prompt_tokens: int):
+        super().__init__(message)
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+
+
+# (finestra di contesto, token massimi in output) per prefisso del nome del modello;
+# vince il prefisso più lungo
+MODEL_LIMITS: Dict[str, tuple[int, int]] = {
+    "gpt-4o": (128000, 16384),
+    "gpt-4.1": (1047576, 32768),
+    "gpt-4-turbo": (128000, 4096),
+    "o1": (200000, 100000),
+    "o1-mini": (128000, 65536),
+    "o3": (200000, 100000),
+    "o4-mini": (200000, 100000),
+    "claude-sonnet-4-5": (200000, 64000),
+    "claude-sonnet-4": (200000, 64000),
+    "claude-opus-4": (200000, 32000),
+    "claude-haiku-4-5": (200000, 64000),
+    "claude-3-7-sonnet": (200000, 64000),
+    "claude-3-5-sonnet": (200000, 8192),
+    "claude-3-5-haiku": (200000, 8192),
+}
+
+# Caratteri di una parola coperti da un token e token fissi per messaggio, per famiglia
+# (il tokenizer di Claude spezza le parole un po' più spesso di quello di OpenAI)
+_FAMILIES = {
+    "openai": {"chars_per_token": 6.0, "per_message": 4},
+    "claude": {"chars_per_token": 5.0, "per_message": 5},
+}
+
+# Budget minimo di ragionamento accettato da Anthropic
+MIN_THINKING_BUDGET = 1024
+
+_WORD_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+def model_limits(model: str) -> Optional[tuple[int, int]]:
+    """(finestra di contesto, output massimo) del modello, None se sconosciuto"""
+    matches = [prefix for prefix in MODEL_LIMITS if model.startswith(prefix)]
+    if not matches:
+        return None
+    return MODEL_LIMITS[max(matches, key=len)]
+
+
+@lru_cache(maxsize=4096)
+def count_text_tokens(text: str, family: str) -> int:
+    """
+    Stima i token di un testo per una famiglia di modelli ("openai" o "claude")
+
+    Ogni simbolo vale un token; le parole valgono un token ogni chars_per_token
+    caratteri (arrotondato per eccesso).
+    """
+    chars_per_token = _FAMILIES[family]["chars_per_token"]
+    return sum(math.ceil(len(token) / chars_per_token) for token in _WORD_RE.findall(text))
+
+
+def _content_tokens(content: Any, family: str) -> int:
+    if isinstance(content, str):
+        return count_text_tokens(content, family)
+    tokens = 0
+    for block in content or []:
+        if isinstance(block, dict) and isinstance(block.get("text"), str):
+            tokens += count_text_tokens(block["text"], family)
+        else:
+            # Immagini, tool_result e altri blocchi: stima sul JSON serializzato
+            tokens += count_text_tokens(json.dumps(block, ensure_ascii=False, default=str), family)
+    return tokens
+
+
+def message_tokens(content: Any, family: str) -> int:
+    """Token stimati di un messaggio: contenuto più i token fissi per messaggio"""
+    return _FAMILIES[family]["per_message"] + _content_tokens(content, family)
+
+
+def estimate_prompt_tokens(params: Dict[str, Any], family: str) -> int:
+    """Token stimati di messaggi, system prompt e definizioni dei tool di una richiesta"""
+    tokens = 3
+    for message in params.get("messages", []):
+        tokens += message_tokens(message.get("content"), family)
+    if params.get("system"):
+        tokens += message_tokens(params["system"], family)
+    if params.get("tools"):
+        tokens += count_text_tokens(json.dumps(params["tools"], ensure_ascii=False, sort_keys=True), family)
+    return tokens
+
+
+def enforce_context_budget(params: Dict[str, Any], family: str, policy: str = "clamp") -> Dict[str, Any]:
+    """
+    Verifica (e se serve corregge) max_tokens e budget di ragionamento di una richiesta
+
+    Args:
+        params: Parametri della chiamata, modificati sul posto
+        family: "openai" o "claude"
+        policy: "clamp" riduce max_tokens al massimo consentito, "reject" solleva
+            ContextBudgetError, "off" non esegue controlli; in entrambi i primi due
+            casi il budget di ragionamento viene ridotto sotto max_tokens
+
+    Returns:
+        I parametri (eventualmente corretti)
+
+    Raises:
+        ContextBudgetError: se il prompt da solo supera la finestra, o se policy="reject"
+            e l'output richiesto non ci sta
+    """
+    limits = model_limits(params["model"])
+    if policy == "off" or limits is None:
+        return params
+    context_window, max_output = limits
+
+    prompt_tokens = estimate_prompt_tokens(params, family)
+    available = min(max_output, context_window - prompt_tokens)
+    output_key = "max_completion_tokens" if "max_completion_tokens" in params else "max_tokens"
+    requested = params.get(output_key)
+    if available <= 0:
+        raise ContextBudgetError(
+            f"Prompt for {params['model']} needs ~{prompt_tokens} tokens,"
+            f" over the {context_window}-token context window",
+            params["model"], prompt_tokens
+        )
+
+    if requested is not None and requested > available:
+        if policy == "reject":
+            raise ContextBudgetError(
+                f"Prompt for {params['model']} needs ~{prompt_tokens} tokens: max_tokens"
+                f" can be at most {available} (requested {requested})",
+                params["model"], prompt_tokens
+            )
+        params[output_key] = requested = available
+
+    # Anthropic richiede budget_tokens >= 1024 e strettamente minore di max_tokens
+    # (che comprende anche il ragionamento): si lascia spazio almeno per 1024 token di risposta
+    thinking = params.get("thinking")
+    if thinking and requested is not None and thinking["budget_tokens"] >= requested:
+        budget = requested - MIN_THINKING_BUDGET
+        if budget < MIN_THINKING_BUDGET:
+            raise ContextBudgetError(
+                f"max_tokens must be at least {2 * MIN_THINKING_BUDGET} with extended thinking"
+                f" (got {requested})",
+                params["model"], prompt_tokens
+            )
+        params["thinking"] = {**thinking, "budget_tokens": budget}
+
+    return params
+
+
+def token_count_cache_stats() -> Dict[str, int]:
+    """Hit, miss e dimensione della cache dei conteggi di token"""
+    info = count_text_tokens.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "max_entries": info.maxsize}
+
+
+# Politica di default dei client: clamp, reject oppure off
+CONTEXT_BUDGET = os.getenv("CONTEXT_BUDGET", "clamp").lower()
@@ -0,0 +1,157 @@
+"""
+Contabilità dei token consumati per API key
+
+I consumi vengono accumulati in memoria (per API key, provider e modello) e
+scaricati periodicamente su un database SQLite locale, così l'endpoint
+/usage può riassumere i consumi anche dopo un riavvio del server. Con più
+worker e uno stato condiviso (vedi shared_state.py) i consumi vengono invece
+scaricati nei contatori condivisi, così ogni worker riporta i totali di tutti.
+"""
+
+import asyncio
+import os
+import sqlite3
+import threading
+from typing import Optional, Dict, Any
+
+from shared_state import SharedState
+
+
+# Contatori di token riportati dai provider (vedi extract_usage dei client)
+USAGE_FIELDS = (
+    "input_tokens",
+    "output_tokens",
+    "cached_input_tokens",
+    "cache_creation_input_tokens",
+    "reasoning_tokens",
+)
+
+
+def _empty_totals() -> Dict[str, int]:
+    return {"requests": 0, **{field: 0 for field in USAGE_FIELDS}}
+
+
+class UsageTracker:
+    """
+    Aggregatore dei consumi per (API key, provider, modello)
+
+    Args:
+        path: Database SQLite in cui salvare i totali (None = solo in memoria)
+        state: Stato condiviso tra i worker; se è condiviso sostituisce il database
+    """
+
+    COUNTERS_PREFIX = "usage:"
+
+    def __init__(self, path: Optional[str] = None, state: Optional[SharedState] = None):
+        self.path = path
+        self.state = state if state is not None and state.shared else None
+        self._pending: Dict[tuple[str, str, str], Dict[str, int]] = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        if path and self.state is None:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            columns = ", ".join(f"{field} INTEGER NOT NULL DEFAULT 0" for field in USAGE_FIELDS)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                " key_id TEXT NOT NULL, provider TEXT NOT NULL, model TEXT NOT NULL,"
+                f" requests INTEGER NOT NULL DEFAULT 0, {columns},"
+                " PRIMARY KEY (key_id, provider, model))"
+            )
+            self._conn.commit()
+
+    def record(self, key_id: str, provider: str, model: str, usage: Optional[Dict[str, int]]) -> None:
+        """Registra una richiesta servita e i token che ha consumato"""
+        with self._lock:
+            totals = self._pending.setdefault((key_id, provider, model), _empty_totals())
+            totals["requests"] += 1
+            for field in USAGE_FIELDS:
+                totals[field] += (usage or {}).get(field) or 0
+
+    def flush(self) -> None:
+        """Somma i consumi accumulati in memoria a quelli salvati su disco o nello stato condiviso"""
+        if self.state is not None:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for key, totals in pending.items():
+                self.state.incr(self.COUNTERS_PREFIX + "|".join(key), totals)
+            return
+        if self._conn is None:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            fields = ("requests",) + USAGE_FIELDS
+            updates = ", ".join(f"{field} = {field} + excluded.{field}" for field in fields)
+            self._conn.executemany(
+                f"INSERT INTO usage (key_id, provider, model, {', '.join(fields)})"
+                f" VALUES (?, ?, ?, {', '.join('?' for _ in fields)})"
+                f" ON CONFLICT (key_id, provider, model) DO UPDATE SET {updates}",
+                [key + tuple(totals[field] for field in fields) for key, totals in pending.items()]
+            )
+            self._conn.commit()
+
+    async def flush_forever(self, interval: float) -> None:
+        """Esegue flush() periodicamente (da eseguire come task di background)"""
+        while True:
+            await asyncio.sleep(interval)
+            # Il database o lo stato condiviso fanno I/O sincrono: fuori dall'event loop
+            await asyncio.to_thread(self.flush)
+
+    def summary(self, key_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Riepilogo dei consumi: totale generale e dettaglio per API key e modello
+
+        Args:
+            key_id: Se indicata, solo i consumi di questa API key (anche nel totale)
+
+        Returns:
+            {"total": {...}, "keys": {key_id: {"total": {...}, "models": {"provider/model": {...}}}}}
+        """
+        self.flush()
+        rows: Dict[tuple[str, str, str], Dict[str, int]] = {}
+        if self.state is not None:
+            start = len(self.COUNTERS_PREFIX)
+            for key, totals in self.state.counters(self.COUNTERS_PREFIX).items():
+                row_key, provider, model = key[start:].rsplit("|", 2)
+                rows[(row_key, provider, model)] = {**_empty_totals(), **totals}
+        elif self._conn is not None:
+            fields = ("requests",) + USAGE_FIELDS
+            with self._lock:
+                cursor = self._conn.execute(
+                    f"SELECT key_id, provider, model, {', '.join(fields)} FROM usage"
+                )
+                for row_key, provider, model, *values in cursor:
+                    rows[(row_key, provider, model)] = dict(zip(fields, values))
+        else:
+            with self._lock:
+                rows = {key: dict(totals) for key, totals in self._pending.items()}
+
+        total = _empty_totals()
+        keys: Dict[str, Any] = {}
+        for (row_key, provider, model), totals in sorted(rows.items()):
+            if key_id is not None and row_key != key_id:
+                continue
+            entry = keys.setdefault(row_key, {"total": _empty_totals(), "models": {}})
+            entry["models"][f"{provider}/{model}"] = totals
+            for field, value in totals.items():
+                entry["total"][field] += value
+                total[field] += value
+        return {"total": total, "keys": keys}
+
+    def close(self) -> None:
+        """Salva i consumi in sospeso e chiude il database"""
+        self.flush()
+        if self._conn is not None:
+            self._conn.close()
+
+
+def create_usage_tracker_from_env(state: Optional[SharedState] = None) -> UsageTracker:
+    """
+    Crea l'aggregatore dei consumi configurato con le variabili d'ambiente
+
+        USAGE_DB_PATH: database SQLite dei consumi (default usage.sqlite3, vuoto = solo in memoria)
+
+    Se state è uno stato condiviso tra worker, i consumi vengono salvati lì.
+    """
+    return UsageTracker(path=os.getenv("USAGE_DB_PATH", "usage.sqlite3") or None, state=state)